@@ -0,0 +1,177 @@
+from devices import UNKNOWN_DEVICE
+
+# =============================================================================
+# Device Allow-List
+# Approved devices (keyboards, security keys, docking stations, ...) are
+# listed one rule per line; blank lines and "#" comments are ignored.
+#
+#   046D:C52B             any device with this VID:PID
+#   1050:0407:0012345678  one specific device (VID:PID:SERIAL)
+#   1050:0407:00123*      VID:PID with a serial number prefix
+#   05AC:*                every product of a vendor
+#   class:03              devices whose every USB class is in an allowed class
+#
+# Rules are compiled into hash sets, so a lookup is a fixed handful of set
+# probes no matter how many rules the fleet-wide list contains. Serial
+# prefixes are looked up once per distinct prefix length in the list.
+# =============================================================================
+WILDCARD = "*"
+
+
+class AllowListError(ValueError):
+    pass
+
+
+def parse_rule(rule):
+    """
+    Parse one allow-list rule into a key:
+      ("class", code)              for class rules
+      ("exact", vid, pid, serial)  with "*" for wildcard fields
+      ("prefix", vid, pid, prefix) for serial prefixes
+    """
+    text = rule.strip().upper()
+    if text.startswith("CLASS:"):
+        code = text[6:]
+        try:
+            return ("class", format(int(code, 16), "02X"))
+        except ValueError:
+            raise AllowListError(f"Invalid class rule: {rule!r}")
+    parts = text.split(":")
+    if len(parts) not in (2, 3):
+        raise AllowListError(f"Invalid allow-list rule: {rule!r}")
+    fields = []
+    for part in parts[:2]:
+        if part == WILDCARD:
+            fields.append(WILDCARD)
+            continue
+        try:
+            fields.append(format(int(part, 16), "04X"))
+        except ValueError:
+            raise AllowListError(f"Invalid allow-list rule: {rule!r}")
+    vid, pid = fields
+    serial = parts[2] if len(parts) == 3 else WILDCARD
+    if vid == WILDCARD:
+        raise AllowListError(f"Allow-list rules need a vendor ID: {rule!r}")
+    if pid == WILDCARD and serial != WILDCARD:
+        raise AllowListError(f"Serial rules need a product ID: {rule!r}")
+    if serial.endswith(WILDCARD) and serial != WILDCARD:
+        return ("prefix", vid, pid, serial[:-1])
+    return ("exact", vid, pid, serial)
+
+
+def read_rules(path):
+    """
+    Read the rule lines of an allow-list file.
+    """
+    rules = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                rules.append(line)
+    return rules
+
+
+class AllowList:
+    """
+    Compiled allow-list. Instances are never modified once built: reloads
+    produce a new AllowList with updated(), which the monitor thread picks up
+    with a single reference swap.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = {}      # rule text -> parsed key
+        self.refcounts = {}  # parsed key -> number of rules producing it
+        self.exact = set()
+        self.prefixes = set()
+        self.prefix_lengths = ()
+        self.classes = set()
+        for rule in rules:
+            self._add_rule(rule)
+        self.freeze()
+
+    def _add_rule(self, rule):
+        if rule in self.rules:
+            return
+        key = parse_rule(rule)
+        self.rules[rule] = key
+        count = self.refcounts.get(key, 0)
+        self.refcounts[key] = count + 1
+        if count:
+            return
+        kind = key[0]
+        if kind == "class":
+            self.classes.add(key[1])
+        elif kind == "prefix":
+            self.prefixes.add(key[1:])
+        else:
+            self.exact.add(key[1:])
+
+    def _remove_rule(self, rule):
+        key = self.rules.pop(rule)
+        count = self.refcounts[key] - 1
+        if count:
+            self.refcounts[key] = count
+            return
+        del self.refcounts[key]
+        kind = key[0]
+        if kind == "class":
+            self.classes.discard(key[1])
+        elif kind == "prefix":
+            self.prefixes.discard(key[1:])
+        else:
+            self.exact.discard(key[1:])
+
+    def freeze(self):
+        self.prefix_lengths = tuple(sorted({len(prefix) for _, _, prefix in self.prefixes}))
+
+    def __len__(self):
+        return len(self.rules)
+
+    def updated(self, rules):
+        """
+        Return (allow_list, added, removed): a new AllowList for `rules` built
+        incrementally from this one. Only added rules are parsed; unchanged
+        rules are carried over. Raises AllowListError (leaving this list
+        untouched) if an added rule is invalid.
+        """
+        wanted = set(rules)
+        current = set(self.rules)
+        added = wanted - current
+        removed = current - wanted
+        new = AllowList.__new__(AllowList)
+        new.rules = dict(self.rules)
+        new.refcounts = dict(self.refcounts)
+        new.exact = set(self.exact)
+        new.prefixes = set(self.prefixes)
+        new.classes = set(self.classes)
+        for rule in removed:
+            new._remove_rule(rule)
+        for rule in added:
+            new._add_rule(rule)
+        new.freeze()
+        return new, len(added), len(removed)
+
+    def allows(self, identity):
+        """
+        True if the device identity matches any rule.
+        Devices without an identity are never allowed.
+        """
+        if identity is UNKNOWN_DEVICE:
+            return False
+        vid, pid, serial = identity.vid, identity.pid, identity.serial
+        exact = self.exact
+        if vid and ((vid, pid, serial) in exact or (vid, pid, WILDCARD) in exact
+                    or (vid, WILDCARD, WILDCARD) in exact):
+            return True
+        if serial:
+            for length in self.prefix_lengths:
+                if length <= len(serial) and (vid, pid, serial[:length]) in self.prefixes:
+                    return True
+        # Class rules only allow a device if all of its classes are allowed, so a
+        # composite keyboard + mass-storage device is still caught.
+        return bool(identity.classes) and identity.classes <= self.classes
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(read_rules(path))
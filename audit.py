@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import socket
+import threading
+from collections import deque
+
+# =============================================================================
+# Audit Log
+# Append-only record of what the blocker saw and did: device insertions, lock
+# screens, unlock attempts, stops. One JSON object per line, for example:
+#
+#   {"ts":1760000000.123,"host":"LAB-PC-07","event":"unlock_failure","source":"lock_screen"}
+#
+# record() only appends to a bounded in-memory buffer and never touches the
+# disk, so it is safe on the USBMonitor thread and in the Qt event loop. A
+# background writer thread flushes the buffer in batches and rotates the file
+# by size and age (usb_blocker_audit.jsonl -> .1 -> .2 ...). If the writer
+# falls behind (an event storm on a slow disk), new records are dropped and
+# counted rather than blocking the caller.
+# =============================================================================
+class AuditLog:
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, max_age=24 * 3600, backups=5,
+                 capacity=4096, batch_size=256, flush_interval=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.host = socket.gethostname()
+        self.buffer = deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closing = False
+        self.file = None
+        self.started_at = 0.0  # when the current file got its first record
+        # Counters
+        self.records = 0
+        self.dropped = 0
+        self.written = 0
+        self.write_errors = 0
+        self.rotations = 0
+        self.open_file()
+        self.writer = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self.writer.start()
+
+    def open_file(self):
+        self.file = open(self.path, "ab")
+        # Age counts from the file's start, not this process's: a monitor
+        # restarted more often than max_age must still rotate
+        self.started_at = self.first_record_time() if self.file.tell() else time.time()
+
+    def first_record_time(self):
+        """
+        Timestamp of the first record in the file, or its modification time
+        if that cannot be read.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                return float(json.loads(f.readline())["ts"])
+        except (OSError, ValueError, KeyError, TypeError):
+            try:
+                return os.stat(self.path).st_mtime
+            except OSError:
+                return time.time()
+
+    def record(self, event, **fields):
+        """
+        Queue one audit record. Returns False if the buffer was full and the
+        record was dropped. Safe to call from any thread.
+        """
+        entry = {"ts": round(time.time(), 3), "host": self.host, "event": event}
+        entry.update(fields)
+        with self.lock:
+            if len(self.buffer) >= self.capacity:
+                self.dropped += 1
+                return False
+            self.buffer.append(entry)
+            self.records += 1
+            pending = len(self.buffer)
+        # Wake the writer early for a full batch; otherwise it flushes on its timer
+        if pending == self.batch_size:
+            self.wakeup.set()
+        return True
+
+    def _run(self):
+        while not self.closing:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Write everything buffered so far. Called on the writer thread (and by
+        close() once the writer has stopped).
+        """
+        with self.lock:
+            if not self.buffer:
+                return
+            entries = list(self.buffer)
+            self.buffer.clear()
+        # One write per batch; each line is a complete record
+        data = "".join(json.dumps(entry, separators=(",", ":")) + "\n" for entry in entries).encode("utf-8")
+        try:
+            if self.needs_rotation(len(data)):
+                self.rotate()
+            self.file.write(data)
+            self.file.flush()
+            self.written += len(entries)
+        except OSError as e:
+            self.write_errors += 1
+            print(f"Audit log: cannot write {self.path}: {e}")
+
+    def needs_rotation(self, incoming):
+        # Batches are never split, so only a single batch larger than
+        # max_bytes can make a file exceed it
+        size = self.file.tell()
+        if not size:
+            return False
+        return size + incoming > self.max_bytes or time.time() - self.started_at >= self.max_age
+
+    def rotate(self):
+        self.file.close()
+        try:
+            for index in range(self.backups - 1, 0, -1):
+                source = f"{self.path}.{index}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{index + 1}")
+            if self.backups:
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+            self.rotations += 1
+        finally:
+            # Keep appending to the current file if the rename failed
+            self.open_file()
+
+    def close(self):
+        """
+        Stop the writer and flush what is left.
+        """
+        self.closing = True
+        self.wakeup.set()
+        self.writer.join()
+        self.flush()
+        self.file.close()
+
+    def stats(self):
+        return {
+            "audit_records": self.records,
+            "audit_written": self.written,
+            "audit_dropped": self.dropped,
+            "audit_write_errors": self.write_errors,
+            "audit_rotations": self.rotations,
+        }
+
+
+def tail_records(path, count=20, block_size=64 * 1024):
+    """
+    Return the last `count` records of an audit log, oldest first. Reads
+    backwards from the end of the file, so the cost does not depend on the
+    size of the log.
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        # count + 1 newlines guarantee `count` complete lines after the first
+        while position > 0 and data.count(b"\n") <= count:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    lines = data.splitlines()[-count:] if count else []
+    return [json.loads(line) for line in lines if line.strip()]
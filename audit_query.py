@@ -0,0 +1,258 @@
+import os
+import re
+import sys
+import json
+import mmap
+import glob
+import hashlib
+import argparse
+from datetime import datetime
+
+# =============================================================================
+# Audit Log Query Tool
+# Answers questions such as "which machines saw 0781:5567 last March" over
+# audit logs collected from many machines, without reading every file.
+#
+# Each log segment (usb_blocker_audit.jsonl, .1, .2, ...) gets a sidecar
+# index, <segment>.idx, splitting it into blocks of at most one hour (or
+# BLOCK_BYTES) with the time range and the VID:PID values seen in each block.
+# A query loads the indexes, picks the blocks that can match, and reads only
+# those byte ranges of the segment through mmap. Indexes are brought up to
+# date before every query: a segment that only grew is indexed from where
+# the last run stopped, and a rotated or replaced segment is re-indexed.
+#
+#   python audit_query.py logs/ --device 0781:5567 --since 2026-03-01 --until 2026-04-01
+#   python audit_query.py logs/*/usb_blocker_audit.jsonl* --device 0781:5567 --hosts
+# =============================================================================
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".idx"
+BLOCK_SECONDS = 3600
+BLOCK_BYTES = 4 * 1024 * 1024
+# Bytes of the segment start used to recognise a rotated or replaced file
+HEAD_BYTES = 256
+
+# AuditLog writes "ts" first and never escapes characters in these fields
+_TS = re.compile(rb'^\{"ts":(-?[0-9.]+)')
+_DEVICE = re.compile(rb'"device":"([0-9A-F]{4}:[0-9A-F]{4})')
+
+
+def device_key(device):
+    """
+    VID:PID part of a device as written by format_identity ("0781:5567:123").
+    """
+    return ":".join(device.upper().split(":")[:2])
+
+
+def segment_head(path, length=HEAD_BYTES):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read(length)).hexdigest()
+
+
+# =============================================================================
+# Section 1: Sidecar index
+# {"version": 1, "head": <sha1 of the first bytes>, "size": <bytes indexed>, "blocks": [
+#     [start_offset, end_offset, min_ts, max_ts, ["0781:5567", ...]], ...]}
+# =============================================================================
+def index_blocks(path, start, end):
+    """
+    Index the complete lines of `path` between byte offsets `start` and
+    `end`. Returns (blocks, indexed_end); a partial last line (the writer
+    may be mid-write) is left for the next run.
+    """
+    blocks = []
+    if end <= start:
+        return blocks, start
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        stop = mm.rfind(b"\n", start, end) + 1
+        if not stop:
+            return blocks, start
+        block = None
+        position = start
+        # Work through the mapping in large newline-aligned chunks; slicing
+        # line by line out of the mmap is several times slower
+        while position < stop:
+            chunk_end = mm.rfind(b"\n", position, min(position + BLOCK_BYTES, stop)) + 1 or stop
+            for line in mm[position:chunk_end].split(b"\n")[:-1]:
+                line_end = position + len(line) + 1
+                match = _TS.match(line)
+                if match:
+                    ts = float(match.group(1))
+                    bucket = int(ts // BLOCK_SECONDS)
+                    if block is None or bucket != block[5] or line_end - block[0] > BLOCK_BYTES:
+                        if block is not None:
+                            blocks.append(block)
+                        block = [position, line_end, ts, ts, set(), bucket]
+                    if ts < block[2]:
+                        block[2] = ts
+                    elif ts > block[3]:
+                        block[3] = ts
+                    device = _DEVICE.search(line)
+                    if device:
+                        block[4].add(device.group(1).decode("ascii"))
+                if block is not None:
+                    block[1] = line_end
+                position = line_end
+        if block is not None:
+            blocks.append(block)
+    return [[b[0], b[1], b[2], b[3], sorted(b[4])] for b in blocks], stop
+
+
+def load_index(path, save=True):
+    """
+    Return the up-to-date index of one segment, extending or rebuilding
+    its sidecar file as needed. With `save` False (or when the sidecar
+    cannot be written, e.g. read-only archives) the index is only kept in
+    memory.
+    """
+    size = os.path.getsize(path)
+    index_path = path + INDEX_SUFFIX
+    index = None
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        pass
+    # The index is only reusable for the same file, grown by appending: its
+    # first bytes (as many as were indexed, up to HEAD_BYTES) must not change
+    if (not isinstance(index, dict) or index.get("version") != INDEX_VERSION
+            or index.get("size", 0) > size
+            or index.get("head") != segment_head(path, min(index.get("size", 0), HEAD_BYTES))):
+        index = {"version": INDEX_VERSION, "head": segment_head(path, 0), "size": 0, "blocks": []}
+    if index["size"] == size:
+        return index
+    blocks, indexed = index_blocks(path, index["size"], size)
+    if indexed == index["size"]:
+        return index
+    index["blocks"].extend(blocks)
+    index["size"] = indexed
+    index["head"] = segment_head(path, min(indexed, HEAD_BYTES))
+    if save:
+        try:
+            temp_path = index_path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(index, f, separators=(",", ":"))
+            os.replace(temp_path, index_path)
+        except OSError as e:
+            print(f"Cannot write index '{index_path}', keeping it in memory: {e}", file=sys.stderr)
+    return index
+
+
+# =============================================================================
+# Section 2: Queries
+# =============================================================================
+def find_segments(paths):
+    """
+    Expand files, directories and glob patterns into audit log segments.
+    """
+    segments = []
+    for pattern in paths:
+        if os.path.isdir(pattern):
+            matches = glob.glob(os.path.join(pattern, "**", "*.jsonl*"), recursive=True)
+        else:
+            matches = glob.glob(pattern) or [pattern]
+        for path in matches:
+            if os.path.isfile(path) and not path.endswith((INDEX_SUFFIX, INDEX_SUFFIX + ".tmp")):
+                segments.append(path)
+    return sorted(set(segments))
+
+
+def query(paths, device=None, since=None, until=None, events=None, host=None, save_index=True):
+    """
+    Yield matching audit records (dicts, with the segment in "_segment"),
+    segment by segment in time order within each segment. `since`/`until`
+    are Unix timestamps, `device` a VID:PID or VID:PID:SERIAL.
+    """
+    key = device_key(device) if device else None
+    wanted_device = device.upper() if device else None
+    low = since if since is not None else float("-inf")
+    high = until if until is not None else float("inf")
+    for path in find_segments(paths):
+        index = load_index(path, save=save_index)
+        ranges = [(start, end) for start, end, min_ts, max_ts, devices in index["blocks"]
+                  if max_ts >= low and min_ts <= high and (key is None or key in devices)]
+        if not ranges:
+            continue
+        needle = f'"device":"{wanted_device}'.encode("ascii") if wanted_device else None
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for start, end in ranges:
+                for line in mm[start:end].splitlines():
+                    # Cheap byte filter before parsing the JSON
+                    if needle and needle not in line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    ts = record.get("ts", 0)
+                    if ts < low or ts > high:
+                        continue
+                    if events and record.get("event") not in events:
+                        continue
+                    if host and record.get("host") != host:
+                        continue
+                    if wanted_device and not (record.get("device", "") + ":").startswith(wanted_device + ":"):
+                        continue
+                    record["_segment"] = path
+                    yield record
+
+
+def parse_time(text):
+    """
+    Unix timestamp, or an ISO 8601 date/time (local time unless it has an
+    offset).
+    """
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid time: {text!r}")
+
+
+def format_record(record):
+    when = datetime.fromtimestamp(record["ts"]).isoformat(sep=" ", timespec="seconds")
+    details = " ".join(f"{k}={v}" for k, v in record.items()
+                       if k not in ("ts", "host", "event", "_segment"))
+    return f"{when}  {record.get('host', '?'):<20} {record.get('event', '?'):<16} {details}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query USB Blocker audit logs")
+    parser.add_argument("paths", nargs="+", help="Audit log files, directories or glob patterns")
+    parser.add_argument("--device", help="VID:PID or VID:PID:SERIAL to look for")
+    parser.add_argument("--since", type=parse_time, help="Start time (Unix time or ISO 8601)")
+    parser.add_argument("--until", type=parse_time, help="End time (Unix time or ISO 8601)")
+    parser.add_argument("--event", action="append", help="Only this event type (repeatable)")
+    parser.add_argument("--host", help="Only records from this machine")
+    parser.add_argument("--hosts", action="store_true", help="Only list the machines with matching records")
+    parser.add_argument("--json", action="store_true", help="Print matching records as JSON lines")
+    parser.add_argument("--no-save-index", dest="save_index", action="store_false",
+                        help="Do not write sidecar index files (read-only archives)")
+    args = parser.parse_args()
+
+    records = query(args.paths, device=args.device, since=args.since, until=args.until,
+                    events=set(args.event) if args.event else None, host=args.host,
+                    save_index=args.save_index)
+    try:
+        if args.hosts:
+            counts = {}
+            for record in records:
+                counts[record.get("host", "?")] = counts.get(record.get("host", "?"), 0) + 1
+            for host, count in sorted(counts.items()):
+                print(f"{host}\t{count}")
+            return
+        for record in records:
+            if args.json:
+                record.pop("_segment")
+                print(json.dumps(record, separators=(",", ":")))
+            else:
+                print(format_record(record))
+    except BrokenPipeError:
+        # Output piped into head/less that exited early
+        sys.stderr.close()
+
+
+if __name__ == '__main__':
+    main()
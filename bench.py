@@ -0,0 +1,1053 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import Counter, deque
+from statistics import median, pstdev
+from control import ControlError, ReadyListener, send_command
+from credentials import CodeVerifier, hash_code
+from event_sources import DeviceEvent, SelectableEventSource
+
+# =============================================================================
+# Benchmark and Soak Suite
+# Measures how quickly the blocker is protecting the machine after launch, and
+# how long the stdlib-only control commands take:
+#
+#   headless    monitor.py start --headless, launch to ready handshake
+#   fast_start  monitor.py start --fast-start (GUI), launch to ready handshake
+#   status      monitor.py status against the running instance
+#
+# Each scenario starts a fresh process per run. The first launch of each runs
+# with an empty bytecode cache (cold start); the rest reuse it (warm start).
+# The GUI scenarios are skipped when the selected interpreter has no PyQt5;
+# they run with the offscreen Qt platform so they work without a display.
+#
+# The verification scenario runs in-process: it times override code checks
+# (correct and incorrect codes should cost the same) and measures how many
+# guesses per second get hashed, without and with the attempt backoff.
+#
+# The remaining scenarios feed USBMonitor from a SyntheticEventSource:
+#
+#   latency     USBBlockerApp: insertion to every screen covered, percentiles
+#   throughput  USBMonitor alone: events per second the monitor thread keeps up
+#               with, for an insertion storm from one device and for many
+#               distinct devices
+#   soak        USBBlockerApp locking and unlocking for --soak_seconds (24 h
+#               for a release): RSS samples and growth per hour
+#
+# The schedule scenario loads --schedule_windows enforcement windows into a
+# Scheduler and runs it through a week on a virtual clock, timing each
+# wakeup.
+#
+# The delivery scenario checks that lock decisions arrive exactly once and
+# in order while --delivery_producers threads post to one EventChannel at
+# the same time: through a bounded and an unbounded channel drained by a
+# thread, and through LockEventBridge to a handler on the Qt thread (a GUI
+# worker). A failed check makes the run exit with status 1.
+#
+# The overlay scenario checks the lock screen itself under the offscreen Qt
+# platform (a GUI worker): an insertion covers every screen with a full-size
+# overlay on that screen, all shown in the same event-loop iteration; a
+# wrong code keeps the lock, the right one lifts it; relocking reuses the
+# pooled overlays; and a screen plugged in while locked is covered at once
+# (the pool's screenRemoved/screenAdded slots are driven directly, as the
+# offscreen platform has a fixed set of screens). A failed check makes the
+# run exit with status 1.
+#
+# The supervise scenario checks `monitor.py supervise` attaching to a
+# running headless monitor: one started without --state_file is refused
+# (its stops would never reach the supervisor), and for one with a state
+# file, a stop with the code ends supervision instead of being restarted.
+# A failed check makes the run exit with status 1.
+#
+# The rotation scenario reopens audit logs the way a restarted monitor does
+# and checks that age-based rotation counts from the file's first record
+# (or its modification time), not from the reopen. A failed check makes
+# the run exit with status 1.
+#
+# The volume scenario (Linux, root, only when asked for) stands a loop device
+# in for a USB stick: it is blocked through a StorageGuard, then mounted
+# repeatedly, timing mount to unmount (or read-only remount).
+#
+# Results are printed as JSON, with the commit they were measured on;
+# --compare checks them against an earlier results file and exits with
+# status 1 when a measurement regressed by more than --tolerance.
+# =============================================================================
+MONITOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "monitor.py")
+
+
+def summarize(samples):
+    return {
+        "runs": len(samples),
+        "median_ms": round(median(samples), 1),
+        "min_ms": round(min(samples), 1),
+        "max_ms": round(max(samples), 1),
+    }
+
+
+def has_pyqt5(python):
+    return subprocess.run([python, "-c", "import PyQt5.QtWidgets"], stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL).returncode == 0
+
+
+def bench_endpoint(env, name):
+    """
+    Absolute socket path for a monitor run with `env`, so this process and
+    the monitor agree on it whatever their runtime directories.
+    """
+    return name if os.name == "nt" else os.path.join(env["TEMP"], name + ".sock")
+
+
+def launch(python, extra_args, endpoint, env, timeout):
+    """
+    Start a monitor and wait for its ready handshake.
+    Returns (process, ready message or None).
+    """
+    listener = ReadyListener()
+    command = [python, MONITOR, "start", "--override", "bench", "--endpoint", endpoint,
+               "--backend", "replay", "--replay", os.devnull, "--notify", listener.address] + extra_args
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, env=env)
+    listener.watch_process(process)
+    return process, listener.wait(timeout)
+
+
+def shutdown(process, endpoint):
+    try:
+        send_command("stop", endpoint=endpoint, code="bench")
+    except ControlError:
+        pass
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def bench_startup(python, extra_args, runs, env, timeout, status_samples=None):
+    ready_samples = []
+    armed_samples = []
+    cold = None
+    # A bytecode cache of its own: empty for the first (cold) launch, and
+    # written even if the caller's environment disables bytecode files
+    env = dict(env, PYTHONPYCACHEPREFIX=tempfile.mkdtemp(prefix="pycache-", dir=env.get("TEMP")))
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    for run in range(runs + 1):
+        endpoint = bench_endpoint(env, f"usb_blocker_bench_{os.getpid()}_{run}")
+        process, ready = launch(python, extra_args, endpoint, env, timeout)
+        try:
+            if not ready:
+                raise RuntimeError(f"monitor did not become ready (exit code {process.poll()})")
+            if cold is None:
+                cold = ready
+                continue
+            ready_samples.append(ready["ready_ms"])
+            armed_samples.append(ready["startup_ms"])
+            if status_samples is not None:
+                started = time.perf_counter()
+                subprocess.run([python, MONITOR, "status", "--endpoint", endpoint], check=True,
+                               stdout=subprocess.DEVNULL, env=env)
+                status_samples.append((time.perf_counter() - started) * 1000.0)
+        finally:
+            shutdown(process, endpoint)
+    # ready_ms: launcher's view (process spawn to handshake)
+    # startup_ms: monitor's view (monitor.py imported to ready)
+    return {
+        "cold_launch_to_ready_ms": round(cold["ready_ms"], 1),
+        "cold_startup_in_process_ms": round(cold["startup_ms"], 1),
+        "launch_to_ready": summarize(ready_samples),
+        "startup_in_process": summarize(armed_samples),
+    }
+
+
+def summarize_spread(samples):
+    result = summarize(samples)
+    result["stdev_ms"] = round(pstdev(samples), 2)
+    return result
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+
+    def rank(p):
+        return round(ordered[min(len(ordered) - 1, len(ordered) * p // 100)], 3)
+
+    return {"samples": len(ordered), "p50_ms": rank(50), "p95_ms": rank(95), "p99_ms": rank(99),
+            "max_ms": round(ordered[-1], 3)}
+
+
+def guess_rate(verifier, duration):
+    """
+    Submit wrong codes back to back for `duration` seconds. Returns the
+    number of guesses that were actually hashed per second.
+    """
+    started = time.perf_counter()
+    attempts = 0
+    while time.perf_counter() - started < duration:
+        verifier.verify(f"guess-{attempts}")
+        attempts += 1
+    hashed = verifier.attempts - verifier.rejected
+    return round(hashed / (time.perf_counter() - started), 2)
+
+
+def bench_verification(runs, duration):
+    encoded = hash_code("correct horse")
+    # No backoff, to time the hash itself
+    verifier = CodeVerifier(encoded, free_attempts=float("inf"))
+    correct = []
+    wrong = []
+    for _ in range(runs):
+        for code, samples in (("correct horse", correct), ("correct hors3", wrong)):
+            started = time.perf_counter()
+            verifier.verify(code)
+            samples.append((time.perf_counter() - started) * 1000.0)
+    return {
+        "verify_correct": summarize_spread(correct),
+        "verify_wrong": summarize_spread(wrong),
+        "guesses_per_s_no_backoff": guess_rate(CodeVerifier(encoded, free_attempts=float("inf")), duration),
+        "guesses_per_s_with_backoff": guess_rate(CodeVerifier(encoded), duration),
+        "duration_s": duration,
+    }
+
+
+# =============================================================================
+# Section 1: Synthetic device events
+# =============================================================================
+class SyntheticEventSource(SelectableEventSource):
+    """
+    Generates "add" events for USB mass storage devices. With a `rate`
+    (events per second, or float("inf") for as fast as possible) it produces
+    `count` events by itself; otherwise events are only delivered when push()
+    is called, from any thread. Serial numbers cycle through `devices`
+    distinct values.
+    """
+    name = "synthetic"
+
+    def __init__(self, rate=0, count=None, devices=1):
+        super().__init__()
+        self.rate = rate
+        self.count = count
+        self.devices = devices
+        self.generated = 0
+        self.next_due = 0.0
+        self.pushed = deque()
+        self._feed_r, self._feed_w = socket.socketpair()
+        self._feed_r.setblocking(False)
+        self.watch(self._feed_r)
+
+    def push(self):
+        self.pushed.append(None)
+        self._feed_w.send(b"\0")
+
+    def make_event(self):
+        serial = self.generated % self.devices
+        self.generated += 1
+        return DeviceEvent("add", f"USB\\VID_0781&PID_5567\\SYN{serial:06d}", time.monotonic(),
+                           {"CompatibleID": "USB\\Class_08&SubClass_06&Prot_50"})
+
+    def wait(self):
+        if self.rate and (self.count is None or self.generated < self.count):
+            if self.rate != float("inf"):
+                delay = self.next_due - time.monotonic()
+                if delay > 0 and not self.sleep(delay):
+                    return None
+                self.next_due = max(self.next_due, time.monotonic() - 1.0) + 1.0 / self.rate
+            return None if self.cancelled else self.make_event()
+        if not self.wait_readable():
+            return None
+        self._feed_r.recv(1)
+        self.pushed.popleft()
+        return self.make_event()
+
+    def close(self):
+        self.unwatch(self._feed_r)
+        self._feed_r.close()
+        self._feed_w.close()
+        super().close()
+
+
+def rss_kb():
+    """
+    Resident set size of this process in KiB (Linux /proc; elsewhere the peak
+    RSS from getrusage).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak // 1024 if sys.platform == "darwin" else peak
+
+
+# =============================================================================
+# Section 2: Monitor throughput (in-process, no GUI)
+# =============================================================================
+def bench_throughput(events, devices, coalesce_window, audit_path):
+    from audit import AuditLog
+    from monitor import USBMonitor
+    from pipeline import EventChannel
+
+    consumed = [0]
+    wakeup = threading.Event()
+    channel = EventChannel(notify=wakeup.set)
+    source = SyntheticEventSource(rate=float("inf"), count=events, devices=devices)
+    audit = AuditLog(audit_path)
+    monitor = USBMonitor(channel.post, event_source=source, coalesce_window=coalesce_window, audit=audit)
+    stopping = threading.Event()
+
+    def consume():
+        # Stands in for the GUI thread draining lock decisions
+        while not stopping.is_set():
+            wakeup.wait(0.1)
+            wakeup.clear()
+            consumed[0] += len(channel.drain())
+
+    consumer = threading.Thread(target=consume, daemon=True)
+    consumer.start()
+    started = time.perf_counter()
+    monitor.start()
+    while monitor.coalescer.seen < events:
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    monitor.stop()
+    stopping.set()
+    consumer.join()
+    audit.close()
+    result = {"events": events, "devices": devices, "events_per_s": round(events / elapsed)}
+    result.update(monitor.coalescer.stats())
+    result.update(channel.stats())
+    result.update(audit.stats())
+    return result
+
+
+# =============================================================================
+# Section 3: GUI workers
+# Run in a child process (the --python interpreter, which needs PyQt5) as
+# "bench.py --worker latency|soak", writing their results to --output.
+# =============================================================================
+def build_gui_app(source, endpoint, temp_dir, capacity=512):
+    from audit import AuditLog
+    from gui import USBBlockerApp
+    from monitor import USBMonitor
+    from pipeline import EventChannel, LatencyProbe
+
+    audit = AuditLog(os.path.join(temp_dir, "bench_audit.jsonl"))
+    channel = EventChannel()
+    monitor = USBMonitor(channel.post, event_source=source, coalesce_window=0, audit=audit)
+    app = USBBlockerApp([sys.argv[0]], verifier=CodeVerifier(hash_code("bench")), custom_name="USB Blocker Bench",
+                        usb_monitor=monitor, lock_channel=channel, endpoint=endpoint, audit=audit)
+    app.lock_latency = LatencyProbe(capacity=capacity)
+    return app, monitor, audit
+
+
+def finish_gui_app(app, monitor):
+    app.control_server.close()
+    monitor.stop()
+    app.quit()
+
+
+def run_latency_worker(samples, gap_ms, temp_dir):
+    from PyQt5 import QtCore  # type: ignore
+
+    source = SyntheticEventSource(devices=1000)
+    app, monitor, audit = build_gui_app(source, f"usb_blocker_bench_{os.getpid()}", temp_dir, capacity=samples)
+    probe = app.lock_latency
+    record = probe.record
+
+    def recorded(started, finished):
+        # Every screen is covered: unlock, then insert the next device
+        latency = record(started, finished)
+        QtCore.QTimer.singleShot(0, app.unlock_screen)
+        if probe.count < samples:
+            QtCore.QTimer.singleShot(gap_ms, source.push)
+        else:
+            QtCore.QTimer.singleShot(gap_ms, lambda: finish_gui_app(app, monitor))
+        return latency
+
+    probe.record = recorded
+    app.launch(splash_seconds=0)
+    # Let the event loop settle after start-up before the first insertion
+    QtCore.QTimer.singleShot(500, source.push)
+    app.exec_()
+    audit.close()
+    latencies = list(probe.samples)
+    # The first lock also creates the native windows' surfaces
+    result = {"first_ms": round(latencies[0], 3)}
+    result.update(percentiles(latencies[1:] or latencies))
+    result["over_frame"] = probe.over_budget
+    return result
+
+
+def run_soak_worker(duration, rate, sample_interval, temp_dir):
+    from PyQt5 import QtCore  # type: ignore
+    import metrics
+
+    source = SyntheticEventSource(rate=rate, devices=1000)
+    app, monitor, audit = build_gui_app(source, f"usb_blocker_bench_{os.getpid()}", temp_dir)
+    probe = app.lock_latency
+    record = probe.record
+
+    def recorded(started, finished):
+        QtCore.QTimer.singleShot(0, app.unlock_screen)
+        return record(started, finished)
+
+    probe.record = recorded
+    started = time.monotonic()
+    rss = []
+
+    def sample():
+        rss.append((round(time.monotonic() - started, 1), rss_kb()))
+
+    sampler = QtCore.QTimer()
+    sampler.timeout.connect(sample)
+    sampler.start(int(sample_interval * 1000))
+    app.launch(splash_seconds=0)
+    sample()
+    QtCore.QTimer.singleShot(int(duration * 1000), lambda: (sample(), finish_gui_app(app, monitor)))
+    app.exec_()
+    audit.close()
+    # Growth after the first tenth of the run, so start-up allocations and
+    # warming caches do not count as a leak
+    steady = [point for point in rss if point[0] >= duration / 10] or rss
+    hours = (steady[-1][0] - steady[0][0]) / 3600.0
+    result = {
+        "duration_s": duration,
+        "events": source.generated,
+        "locks": metrics.LOCKS.value(),
+        "lock_latency": percentiles(list(probe.samples)) if probe.samples else None,
+        "rss_start_kb": rss[0][1],
+        "rss_end_kb": rss[-1][1],
+        "rss_max_kb": max(kb for _, kb in rss),
+        "rss_growth_kb_per_hour": round((steady[-1][1] - steady[0][1]) / hours, 1) if hours else 0.0,
+        "rss_samples": rss,
+    }
+    result.update(audit.stats())
+    return result
+
+
+def run_delivery_worker(producers, events, capacity):
+    from PyQt5 import QtCore  # type: ignore
+    from gui import LockEventBridge
+    from pipeline import EventChannel
+
+    app = QtCore.QCoreApplication([sys.argv[0]])
+    channel = EventChannel(capacity=capacity)
+    gui_thread = threading.get_ident()
+    delivered = []
+    off_thread = [0]
+
+    def handle(event):
+        if threading.get_ident() != gui_thread:
+            off_thread[0] += 1
+        delivered.append(event)
+
+    # Posted before the bridge attaches, as with fast start
+    accepted = {"early": [seq for seq in range(min(events, 100)) if channel.post(("early", seq))]}
+    bridge = LockEventBridge(handle, channel)
+    threads = start_producers(channel, producers, events, accepted)
+    expected = sum(len(seqs) for seqs in accepted.values())
+    deadline = time.monotonic() + 60
+    started = time.perf_counter()
+    elapsed = [0.0]
+
+    def check():
+        if any(thread.is_alive() for thread in threads):
+            return
+        if len(delivered) >= sum(len(seqs) for seqs in accepted.values()) or time.monotonic() > deadline:
+            poll.stop()
+            elapsed[0] = time.perf_counter() - started
+            # Anything delivered twice would arrive in this grace period
+            QtCore.QTimer.singleShot(100, app.quit)
+
+    poll = QtCore.QTimer()
+    poll.timeout.connect(check)
+    poll.start(5)
+    app.exec_()
+    result = delivery_check(accepted, delivered)
+    result.update({"producers": producers, "capacity": capacity, "early": expected,
+                   "events_per_s": round(len(delivered) / elapsed[0]) if elapsed[0] else 0,
+                   "handled_off_gui_thread": off_thread[0]})
+    result["exactly_once_in_order"] = result["exactly_once_in_order"] and not off_thread[0]
+    result.update(channel.stats())
+    del bridge
+    return result
+
+
+def settle(app, condition, timeout=5.0):
+    """
+    Process Qt events until condition() holds or `timeout` passes. Returns
+    condition().
+    """
+    from PyQt5 import QtCore  # type: ignore
+
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        app.processEvents(QtCore.QEventLoop.AllEvents, 10)
+    return bool(condition())
+
+
+def run_overlay_worker(temp_dir):
+    from PyQt5 import QtCore, QtWidgets  # type: ignore
+    from gui import LockOverlay
+
+    source = SyntheticEventSource(devices=10)
+    app, monitor, audit = build_gui_app(source, f"usb_blocker_bench_{os.getpid()}", temp_dir)
+    app.launch(splash_seconds=0)
+    checks = {}
+
+    def covered():
+        lock_screen = app.lock_screen
+        screens = app.screens()
+        return (lock_screen is not None and lock_screen.locked and set(lock_screen.overlays) == set(screens)
+                and all(overlay.isVisible() and overlay.windowState() & QtCore.Qt.WindowFullScreen
+                        and overlay.windowHandle().screen() is screen and overlay.geometry() == screen.geometry()
+                        for screen, overlay in lock_screen.overlays.items()))
+
+    def showing():
+        return sum(1 for widget in QtWidgets.QApplication.topLevelWidgets()
+                   if isinstance(widget, LockOverlay) and widget.isVisible())
+
+    def enter(code):
+        overlay = app.lock_screen.overlays[app.primaryScreen()]
+        overlay.input_field.setText(code)
+        overlay.input_field.returnPressed.emit()
+        return settle(app, lambda: not app.lock_screen.checking)
+
+    settle(app, lambda: False, 0.5)
+    # An insertion, end to end: monitor thread, channel, bridge, lock screen
+    source.push()
+    checks["covered"] = settle(app, covered)
+    checks["painted"] = settle(app, lambda: app.lock_screen.pending_since is None) and app.lock_latency.count == 1
+    checks["wrong_code_keeps_lock"] = (enter("wrong") and covered()
+                                       and app.lock_screen.overlays[app.primaryScreen()].label.text().startswith(
+                                           "Incorrect"))
+    checks["code_unlocks"] = enter("bench") and settle(app, lambda: not app.lock_screen_displayed) and not showing()
+    # Relock straight from the GUI thread: every overlay is shown before the
+    # event loop runs again
+    pool = dict(app.lock_screen.overlays)
+    app.show_lock_screen()
+    checks["same_iteration"] = covered()
+    checks["pooled"] = app.lock_screen.overlays == pool
+    # A screen coming back while locked is covered without waiting for an event
+    screen = app.primaryScreen()
+    app.lock_screen.remove_screen(screen)
+    app.lock_screen.add_screen(screen)
+    checks["hotplug_covered"] = covered() and app.lock_screen.overlays[screen] is not pool[screen]
+    settle(app, lambda: showing() == len(app.screens()))
+    checks["no_stray_overlays"] = showing() == len(app.screens())
+    app.unlock_screen()
+    checks["unlock_hides_all"] = settle(app, lambda: not showing())
+    result = {"screens": len(app.screens()), "platform": QtWidgets.QApplication.platformName(),
+              "lock_ms": round(app.lock_latency.samples[0], 3) if app.lock_latency.samples else None,
+              "checks": checks, "ok": all(checks.values())}
+    finish_gui_app(app, monitor)
+    audit.close()
+    return result
+
+
+def run_worker(python, arguments, env, timeout):
+    """
+    Run a GUI worker and return its results.
+    """
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False, dir=env.get("TEMP")) as f:
+        output = f.name
+    try:
+        worker = subprocess.run([python, os.path.abspath(__file__), "--output", output] + arguments,
+                                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                env=env, timeout=timeout)
+        if worker.returncode:
+            raise RuntimeError(f"{arguments[1]} worker failed:\n{worker.stderr.decode(errors='replace')}")
+        with open(output, encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        os.remove(output)
+
+
+# =============================================================================
+# Section 4: Volume blocking (Linux loop device)
+# =============================================================================
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.0005)
+    return True
+
+
+def bench_volume(mounts, action, temp_dir):
+    from storage import StorageGuard
+
+    if not sys.platform.startswith("linux") or os.geteuid() != 0:
+        print("The volume scenario needs root on Linux; skipping it.", file=sys.stderr)
+        return None
+    image = os.path.join(temp_dir, "volume.img")
+    mount_point = os.path.join(temp_dir, "volume")
+    os.makedirs(mount_point)
+    with open(image, "wb") as f:
+        f.truncate(16 * 1024 * 1024)
+    try:
+        subprocess.run(["mkfs.ext4", "-q", "-F", image], check=True, capture_output=True)
+        loop = subprocess.run(["losetup", "-f", "--show", image], check=True, capture_output=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Cannot set up a loop device ({e}); skipping the volume scenario.", file=sys.stderr)
+        return None
+    guard = StorageGuard("volume", action)
+    try:
+        devpath = os.path.realpath(os.path.join("/sys/class/block", os.path.basename(loop)))[len("/sys"):]
+        guard.submit(DeviceEvent("add", devpath, time.monotonic(), {}))
+        if not wait_for(lambda: guard.action is not None and guard.queued and not guard.queue, 5):
+            raise RuntimeError("the storage guard did not start")
+        end_to_end = []
+        for _ in range(mounts):
+            done = guard.blocked + guard.failures
+            started = time.perf_counter()
+            subprocess.run(["mount", loop, mount_point], check=True)
+            if not wait_for(lambda: guard.blocked + guard.failures > done, 5):
+                raise RuntimeError("the volume was not blocked")
+            end_to_end.append((time.perf_counter() - started) * 1000.0)
+            if action == "readonly":
+                subprocess.run(["umount", mount_point], check=True)
+        result = {"mounts": mounts, "action": guard.action.name, "failures": guard.failures,
+                  # From the mount showing up in the mount table to blocked
+                  "mount_to_block": percentiles(list(guard.samples)),
+                  # From running mount(8) to blocked
+                  "mount_command_to_block": summarize(end_to_end)}
+        return result
+    finally:
+        guard.close()
+        subprocess.run(["umount", "-l", mount_point], capture_output=True)
+        subprocess.run(["losetup", "-d", loop], capture_output=True)
+
+
+# =============================================================================
+# Section 5: Enforcement schedule (in-process, virtual clock)
+# =============================================================================
+def bench_schedule(windows, days):
+    import random
+    from schedule import Scheduler, parse_schedule
+
+    rng = random.Random(1)
+    rooms = ["A1", "A2", "B12", None]
+    data = {"default": "enforce", "windows": [
+        {"name": f"w{i}", "days": rng.choice(["mon-fri", "daily", "sat,sun", "tue"]),
+         "start": f"{rng.randrange(24):02d}:{rng.choice((0, 15, 30, 45)):02d}",
+         "end": f"{rng.randrange(24):02d}:{rng.choice((0, 15, 30, 45)):02d}",
+         "action": rng.choice(["enforce", "relax"]), "room": rng.choice(rooms)}
+        for i in range(windows)]}
+    clock = [time.time()]
+    scheduler = Scheduler(room="A1", clock=lambda: clock[0])
+    started = time.perf_counter()
+    schedule = parse_schedule(data)
+    parse_ms = (time.perf_counter() - started) * 1000.0
+    started = time.perf_counter()
+    scheduler.load(schedule)
+    load_ms = (time.perf_counter() - started) * 1000.0
+    # Jump the virtual clock from one transition to the next, as a host's
+    # single timer would
+    end = clock[0] + days * 86400
+    samples = []
+    wakeups = 0
+    started = time.perf_counter()
+    while True:
+        due = scheduler.next_due()
+        if due is None or due > end:
+            break
+        clock[0] = due
+        tick = time.perf_counter()
+        scheduler.advance()
+        samples.append((time.perf_counter() - tick) * 1000.0)
+        wakeups += 1
+    elapsed = time.perf_counter() - started
+    result = {"windows": windows, "days": days, "parse_ms": round(parse_ms, 1), "load_ms": round(load_ms, 1),
+              "wakeups": wakeups, "transitions_per_s": round(scheduler.transitions / elapsed),
+              "advance": percentiles(samples)}
+    result.update(scheduler.stats())
+    return result
+
+
+# =============================================================================
+# Section 6: Delivery under concurrent producers
+# Events are (producer, sequence number) pairs. For each producer, the
+# consumer must receive exactly the events post() accepted, in the order
+# they were posted; dropped events (bounded channel) must never arrive.
+# =============================================================================
+def start_producers(channel, producers, events, accepted):
+    """
+    Start `producers` threads posting `events` events each to `channel` at
+    once. Each records the sequence numbers accepted in `accepted`.
+    """
+    barrier = threading.Barrier(producers)
+
+    def produce(producer):
+        seqs = []
+        barrier.wait()
+        for seq in range(events):
+            if channel.post((producer, seq)):
+                seqs.append(seq)
+        accepted[producer] = seqs
+
+    threads = [threading.Thread(target=produce, args=(producer,), daemon=True) for producer in range(producers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def delivery_check(accepted, delivered):
+    """
+    Compare the events each producer had accepted with those delivered.
+    """
+    received = {}
+    for producer, seq in delivered:
+        received.setdefault(producer, []).append(seq)
+    result = {"accepted": sum(len(seqs) for seqs in accepted.values()), "delivered": len(delivered),
+              "missing": 0, "duplicated": 0, "reordered": 0, "unexpected": 0}
+    for producer, seqs in accepted.items():
+        got = received.pop(producer, [])
+        counts = Counter(got)
+        result["missing"] += len(set(seqs) - counts.keys())
+        result["duplicated"] += sum(count - 1 for count in counts.values())
+        result["reordered"] += sum(1 for before, after in zip(got, got[1:]) if after < before)
+        result["unexpected"] += len(counts.keys() - set(seqs))
+    result["unexpected"] += sum(len(got) for got in received.values())
+    result["exactly_once_in_order"] = not any(result[key] for key in ("missing", "duplicated", "reordered",
+                                                                      "unexpected"))
+    return result
+
+
+def bench_delivery(producers, events, capacity):
+    from pipeline import EventChannel
+
+    wakeup = threading.Event()
+    wakeups = [0]
+
+    def notify():
+        wakeups[0] += 1
+        wakeup.set()
+
+    channel = EventChannel(capacity=capacity, notify=notify)
+    delivered = []
+    done = threading.Event()
+
+    def consume():
+        # Stands in for the GUI thread: sleeps until notified, no polling, so
+        # a lost notification shows up as missing events
+        while True:
+            wakeup.wait()
+            wakeup.clear()
+            delivered.extend(channel.drain())
+            if done.is_set():
+                delivered.extend(channel.drain())
+                return
+
+    consumer = threading.Thread(target=consume, daemon=True)
+    consumer.start()
+    accepted = {}
+    started = time.perf_counter()
+    threads = start_producers(channel, producers, events, accepted)
+    for thread in threads:
+        thread.join()
+    # Only what arrived through notifications counts; events the final drain
+    # picks up after a missed wakeup are missing (and reported as late)
+    deadline = time.monotonic() + 10
+    while len(delivered) < sum(len(seqs) for seqs in accepted.values()) and time.monotonic() < deadline:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - started
+    notified = list(delivered)
+    done.set()
+    wakeup.set()
+    consumer.join()
+    result = delivery_check(accepted, notified)
+    result["late"] = len(delivered) - len(notified)
+    result.update({"producers": producers, "capacity": capacity, "wakeups": wakeups[0],
+                   "events_per_s": round(len(delivered) / elapsed)})
+    result.update(channel.stats())
+    return result
+
+
+# =============================================================================
+# Section 7: Supervision (attaching to a running monitor)
+# =============================================================================
+def responding(endpoint):
+    try:
+        send_command("status", endpoint=endpoint, timeout=1.0)
+        return True
+    except ControlError:
+        return False
+
+
+def bench_supervise(python, env, timeout, temp_dir):
+    endpoint = bench_endpoint(env, f"usb_blocker_bench_supervise_{os.getpid()}")
+    supervise = [python, MONITOR, "supervise", "--headless", "--override", "bench", "--backend", "replay",
+                 "--replay", os.devnull]
+    checks = {}
+    # A monitor without a state file: the supervisor must not attach
+    process, ready = launch(python, ["--headless"], endpoint, env, timeout)
+    if not ready:
+        shutdown(process, endpoint)
+        return {"checks": {"monitor_started": False}, "ok": False}
+    supervisor = subprocess.Popen(supervise, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL, env=env)
+    try:
+        refused = supervisor.wait(timeout) != 0
+    except subprocess.TimeoutExpired:
+        refused = False  # it attached and kept supervising
+    checks["refuses_without_state_file"] = refused and process.poll() is None
+    # Stopped with the code, it must stay stopped: an attached supervisor
+    # would not see the stop and restart it
+    shutdown(process, endpoint)
+    deadline = time.monotonic() + 5
+    respawned = False
+    while not respawned and time.monotonic() < deadline:
+        respawned = responding(endpoint)
+        time.sleep(0.1)
+    checks["stop_without_state_file"] = not respawned
+    if supervisor.poll() is None:
+        supervisor.kill()
+        supervisor.wait()
+    shutdown(process, endpoint)
+    # With a state file: attach, then stop it over the control channel
+    state_file = os.path.join(temp_dir, "bench_supervise_state.json")
+    process, ready = launch(python, ["--headless", "--state_file", state_file], endpoint, env, timeout)
+    listener = ReadyListener()
+    supervisor = subprocess.Popen(supervise + ["--notify", listener.address], stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+    listener.watch_process(supervisor)
+    attached = listener.wait(timeout)
+    checks["attaches_with_state_file"] = bool(ready and attached and attached.get("pid") == process.pid)
+    try:
+        send_command("stop", endpoint=endpoint, code="bench")
+        # Reap it: the attached supervisor watches the PID, and an unreaped
+        # child of this process would look alive forever
+        process.wait(10)
+        supervisor.wait(timeout)
+    except (ControlError, subprocess.TimeoutExpired):
+        pass
+    with open(state_file, encoding="utf-8") as f:
+        stopped = json.load(f).get("stopped")
+    checks["stop_ends_supervision"] = (supervisor.returncode == 0 and stopped == "control"
+                                       and not responding(endpoint))
+    # Whatever failed, leave nothing running
+    for leftover in (supervisor, process):
+        if leftover.poll() is None:
+            leftover.kill()
+            leftover.wait()
+    shutdown(process, endpoint)
+    return {"checks": checks, "ok": all(checks.values())}
+
+
+# =============================================================================
+# Section 8: Audit log rotation across restarts
+# =============================================================================
+def bench_rotation(temp_dir, max_age=3600):
+    from audit import AuditLog
+
+    path = os.path.join(temp_dir, "rotation_audit.jsonl")
+    old = time.time() - 2 * max_age
+
+    def reopen():
+        # What a restarted monitor does: open, record "start", close
+        audit = AuditLog(path, max_age=max_age)
+        audit.record("start")
+        audit.close()
+        return audit.rotations
+
+    checks = {}
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"ts": old, "event": "start"}) + "\n")
+    checks["old_file_rotated"] = reopen() == 1 and os.path.exists(path + ".1")
+    checks["young_file_kept"] = reopen() == 0
+    # No readable first record: the modification time stands in
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("not json\n")
+    os.utime(path, (old, old))
+    checks["unreadable_file_uses_mtime"] = reopen() == 1
+    return {"checks": checks, "ok": all(checks.values())}
+
+
+# =============================================================================
+# Section 9: Comparing results
+# =============================================================================
+# Compared measurements: key suffix -> True if higher is better
+COMPARED = {"median_ms": False, "p50_ms": False, "p95_ms": False, "p99_ms": False, "_per_s": True,
+            "cold_launch_to_ready_ms": False, "kb_per_hour": False}
+
+
+def flatten(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + key, value
+
+
+def compare(baseline, current, tolerance):
+    """
+    Return the measurements that got worse by more than `tolerance` (a
+    fraction), as (name, baseline, current) tuples.
+    """
+    before = dict(flatten(baseline))
+    regressions = []
+    for name, value in flatten(current):
+        higher_is_better = next((better for suffix, better in COMPARED.items() if name.endswith(suffix)), None)
+        if higher_is_better is None or name not in before or not before[name]:
+            continue
+        change = (value - before[name]) / abs(before[name])
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append((name, before[name], value))
+    return regressions
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(MONITOR),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="USB Blocker benchmark and soak suite")
+    parser.add_argument("--runs", type=int, default=5, help="Launches per startup scenario")
+    parser.add_argument("--python", default=sys.executable, help="Interpreter used to run monitor.py and the GUI")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for each ready handshake")
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    parser.add_argument("--scenario", choices=["all", "startup", "verification", "latency", "throughput", "soak",
+                                                   "schedule", "delivery", "overlay", "supervise",
+                                                   "rotation", "volume"],
+                        default="all", help="Which measurements to run (all includes soak only with --soak_seconds, "
+                                            "and never volume)")
+    parser.add_argument("--guess_seconds", type=float, default=10, help="Duration of each brute-force measurement")
+    parser.add_argument("--latency_samples", type=int, default=200, help="Insertions timed by the latency scenario")
+    parser.add_argument("--latency_gap_ms", type=int, default=20, help="Pause between unlock and the next insertion")
+    parser.add_argument("--events", type=int, default=100000, help="Events per throughput measurement")
+    parser.add_argument("--soak_seconds", type=float, default=0, help="Soak duration (86400 for the release soak)")
+    parser.add_argument("--soak_rate", type=float, default=1.0, help="Insertions per second during the soak")
+    parser.add_argument("--soak_sample_seconds", type=float, default=60, help="Interval between RSS samples")
+    parser.add_argument("--schedule_windows", type=int, default=10000, help="Windows loaded by the schedule scenario")
+    parser.add_argument("--delivery_producers", type=int, default=8,
+                        help="Threads posting at once in the delivery scenario")
+    parser.add_argument("--delivery_events", type=int, default=20000, help="Events posted by each producer")
+    parser.add_argument("--volume_mounts", type=int, default=50, help="Mounts timed by the volume scenario")
+    parser.add_argument("--volume_action", choices=["unmount", "readonly"], default="unmount",
+                        help="Storage action used by the volume scenario")
+    parser.add_argument("--compare", help="Earlier results file; exit with status 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative slowdown for --compare")
+    parser.add_argument("--worker", choices=["latency", "soak", "delivery", "overlay"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        temp_dir = os.environ.get("TEMP") or tempfile.gettempdir()
+        if args.worker == "latency":
+            results = run_latency_worker(args.latency_samples, args.latency_gap_ms, temp_dir)
+        elif args.worker == "overlay":
+            results = run_overlay_worker(temp_dir)
+        elif args.worker == "delivery":
+            results = run_delivery_worker(args.delivery_producers, args.delivery_events,
+                                          args.delivery_producers * args.delivery_events + 100)
+        else:
+            results = run_soak_worker(args.soak_seconds, args.soak_rate,
+                                      min(args.soak_sample_seconds, args.soak_seconds / 10), temp_dir)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f)
+        return
+
+    results = {"python": args.python, "platform": sys.platform, "commit": current_commit(),
+               "timestamp": round(time.time())}
+    gui = has_pyqt5(args.python)
+    if not gui:
+        print("PyQt5 is not available; skipping the GUI scenarios.", file=sys.stderr)
+    if args.scenario in ("all", "verification"):
+        results["verification"] = bench_verification(max(args.runs, 20), args.guess_seconds)
+    if args.scenario in ("all", "schedule"):
+        results["schedule"] = bench_schedule(args.schedule_windows, 7)
+    if args.scenario in ("all", "delivery"):
+        total = args.delivery_producers * args.delivery_events
+        results["delivery"] = {
+            # Room for everything: every event must be accepted and delivered
+            "unbounded": bench_delivery(args.delivery_producers, args.delivery_events, total),
+            # The default capacity under a flood: drops, but no losses of accepted events
+            "bounded": bench_delivery(args.delivery_producers, args.delivery_events, 256),
+        }
+    # A private TEMP keeps the benchmark clear of a real instance's lock file
+    with tempfile.TemporaryDirectory() as temp_dir:
+        env = dict(os.environ, TEMP=temp_dir, QT_QPA_PLATFORM="offscreen")
+        if args.scenario in ("all", "startup"):
+            status_samples = []
+            results["headless"] = bench_startup(args.python, ["--headless"], args.runs, env, args.timeout,
+                                                status_samples=status_samples)
+            results["status_command"] = summarize(status_samples)
+            results["fast_start"] = (bench_startup(args.python, ["--fast-start"], args.runs, env, args.timeout)
+                                     if gui else None)
+        if args.scenario in ("all", "throughput"):
+            audit_path = os.path.join(temp_dir, "throughput_audit.jsonl")
+            results["throughput"] = {
+                # One device flooding the monitor: nearly everything is coalesced
+                "storm": bench_throughput(args.events, 1, 0.5, audit_path),
+                # Distinct devices, no coalescing: every event becomes a lock decision
+                "distinct": bench_throughput(args.events, 1000, 0, audit_path),
+            }
+        if args.scenario in ("all", "latency"):
+            results["latency"] = (run_worker(args.python, ["--worker", "latency", "--latency_samples",
+                                                           str(args.latency_samples), "--latency_gap_ms",
+                                                           str(args.latency_gap_ms)], env, args.timeout * 10)
+                                  if gui else None)
+        if args.scenario == "soak" or (args.scenario == "all" and args.soak_seconds):
+            if not args.soak_seconds:
+                parser.error("the soak scenario needs --soak_seconds")
+            results["soak"] = (run_worker(args.python, ["--worker", "soak", "--soak_seconds", str(args.soak_seconds),
+                                                        "--soak_rate", str(args.soak_rate), "--soak_sample_seconds",
+                                                        str(args.soak_sample_seconds)],
+                                          env, args.soak_seconds + args.timeout * 10)
+                               if gui else None)
+        if args.scenario in ("all", "delivery"):
+            results["delivery"]["bridge"] = (run_worker(args.python, ["--worker", "delivery", "--delivery_producers",
+                                                                      str(args.delivery_producers),
+                                                                      "--delivery_events",
+                                                                      str(args.delivery_events)],
+                                                        env, args.timeout * 10)
+                                             if gui else None)
+        if args.scenario in ("all", "overlay"):
+            results["overlay"] = run_worker(args.python, ["--worker", "overlay"], env, args.timeout * 10) if gui else None
+        if args.scenario in ("all", "rotation"):
+            results["rotation"] = bench_rotation(temp_dir)
+        if args.scenario in ("all", "supervise"):
+            results["supervise"] = bench_supervise(args.python, env, args.timeout, temp_dir)
+        if args.scenario == "volume":
+            results["volume"] = bench_volume(args.volume_mounts, args.volume_action, temp_dir)
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    failed = [(f"delivery.{name}", check) for name, check in (results.get("delivery") or {}).items()
+              if check and not check["exactly_once_in_order"]]
+    for name in ("overlay", "supervise", "rotation"):
+        if results.get(name) and not results[name]["ok"]:
+            failed.append((name, results[name]["checks"]))
+    for name, check in failed:
+        print(f"CHECK FAILED ({name}): {check}", file=sys.stderr)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.tolerance)
+        for name, before, after in regressions:
+            print(f"REGRESSION {name}: {before} -> {after}", file=sys.stderr)
+        print(f"{len(regressions)} regression(s) against {args.compare} (commit {baseline.get('commit')})",
+              file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,60 +1,59 @@
 import argparse
 import subprocess
+import tempfile
+import json
+import time
 import sys
 import os
-import time
-from PyQt5.QtWidgets import QDialog, QVBoxLayout, QLabel, QTextEdit, QPushButton # type: ignore
-from PyQt5.QtWidgets import QApplication, QMessageBox  # type: ignore
+import socket
+from allowlist import AllowList, AllowListError
+from control import DEFAULT_ENDPOINT, ControlError, MonitorClient, endpoint_address, launch_monitor
+from credentials import TOTP_STEP, CredentialError, hash_code, mint_code, read_secret
+from fleet import DEFAULT_WORKERS, InventoryError, call_host, host_result, read_inventory, report, run_fleet
+from instance import find_endpoint, find_instance
+from policy import PolicyError, validate_policy
 
-# Global variables to store the running process and its PID.
+# PyQt5 is only imported for the dialogs of 'start' and 'stop'; 'code' and
+# 'fleet' run on machines without it.
+FLEET_COMMANDS = ("status", "start", "stop", "push", "reload", "unlock")
+
+# The monitor process started by this client, if any. Monitors started
+# elsewhere (or before this client) are found through the instance registry.
 running_process = None
 running_process_id = None
 
-def write_to_process(process, command):
-    """
-    Write a command to the process's standard input.
-    """
-    if process is not None:
-        try:
-            process.stdin.write(command + "\n")
-            process.stdin.flush()
-        except Exception as e:
-            print(f"Error writing to process: {e}")
-
-def read_from_process(process):
-    """
-    Read one line of output from the process's standard output.
-    """
-    if process is not None:
-        try:
-            return process.stdout.readline().strip()
-        except Exception as e:
-            print(f"Error reading from process: {e}")
-            return None
-    return None
+# Persistent connection to the monitor's control channel, opened on first use.
+monitor_client = None
 
-def send_to_process(process, command):
+def get_monitor_client(endpoint=DEFAULT_ENDPOINT):
     """
-    Write the command to the process and return its immediate response.
+    Return the shared MonitorClient for `endpoint`, reusing its connection.
     """
-    if process is not None and command is not None:
-        write_to_process(process, command)
-        return read_from_process(process)
-    elif command is None:
-        return "Cannot send empty command to process"
-    else:
-        return "USB Monitor is not running"
+    global monitor_client
+    if monitor_client is None or monitor_client.endpoint != endpoint:
+        if monitor_client is not None:
+            monitor_client.close()
+        monitor_client = MonitorClient(endpoint)
+    return monitor_client
 
-def evaluate_if_blocker_is_running():
+def evaluate_if_blocker_is_running(endpoint=DEFAULT_ENDPOINT):
     """
     Check whether the blocker process is running.
     Returns True if running, False otherwise.
     """
-    global running_process, running_process_id
     if running_process_id is not None and running_process is not None:
         # running_process.poll() returns None if still running.
-        return running_process.poll() is None
-    return False
+        if running_process.poll() is None:
+            return True
+    # Any monitor in this session registers itself (see instance.py)
+    if find_instance() is not None:
+        return True
+    # A monitor without a record (e.g. another TEMP): ask the control channel
+    try:
+        get_monitor_client(endpoint).call("status")
+        return True
+    except ControlError:
+        return False
 
 def resource_path(relative_path):
     try:
@@ -71,56 +70,67 @@ def get_blocker_runtime_path():
     """
     return resource_path("monitor.exe")
 
-def start_blocker(override_code, run_time=None):
+def get_blocker_command():
+    """
+    The command that runs the monitor: monitor.exe, or monitor.py with this
+    interpreter when running from a source checkout without the executable.
+    """
+    tool_path = get_blocker_runtime_path()
+    if getattr(sys, 'frozen', False) or os.path.exists(tool_path):
+        return [tool_path]
+    return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "monitor.py")]
+
+def start_blocker(override_code, run_time=None, endpoint=DEFAULT_ENDPOINT, ready_timeout=30, fast_start=False,
+                  totp_secret_file=None, supervised=False):
     """
     Starts monitor.exe as a subprocess if it's not already running.
-    Constructs the command line and spawns the process.
+    Constructs the command line, spawns the process and waits (up to
+    `ready_timeout` seconds) for its ready handshake. With `fast_start` the
+    monitor skips its splash countdown and arms device monitoring first.
+    With `totp_secret_file` the monitor also accepts one-time codes (see
+    mint_unlock_codes); `override_code` may then be None. With `supervised`
+    the monitor runs under its supervisor, which restarts it if it fails.
     """
+    from PyQt5.QtWidgets import QDialog, QVBoxLayout, QLabel, QTextEdit, QPushButton, QMessageBox  # type: ignore
     global running_process, running_process_id
 
-    if evaluate_if_blocker_is_running():
-        QMessageBox.information(None, "Info", "USB Monitor is already running.")
+    if evaluate_if_blocker_is_running(endpoint):
+        running = find_instance()
+        QMessageBox.information(None, "Info", "USB Monitor is already running"
+                                + (f" (PID {running['pid']})." if running else "."))
         return
 
-    tool_path = get_blocker_runtime_path()
-    print(f"Tool path: {tool_path}")
-    # Build the command using Windows’ start /B command (background, without a terminal)
-    # and the override code.
-    # The command is passed as a list to avoid shell injection issues.
-    command = [tool_path, "start", "--override", override_code]
+    tool_command = get_blocker_command()
+    print(f"Tool path: {tool_command[-1]}")
+    # The command is passed as a list (no shell) to avoid shell injection issues.
+    # Only a salted hash of the code goes on the command line, where other
+    # processes can read it.
+    command = tool_command + ["supervise" if supervised else "start", "--endpoint", endpoint]
+    if override_code:
+        command += ["--override_hash", hash_code(override_code)]
+    if totp_secret_file:
+        command += ["--totp_secret_file", os.path.abspath(totp_secret_file)]
     print(f"Command: {command}")
     if run_time:
         # If run_time is provided, append it to the command.
         command.append("--run_time")
         command.append(str(run_time))
+    if fast_start:
+        command.append("--fast-start")
 
     try:
-        # Start the monitor. shell=True is needed to run the "start" command.
-        running_process = subprocess.Popen(
-            command,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            text=True
-        )
-        
-        retry_count = 0
-        
-        details = f"USB Monitor started successfully with PID {running_process_id}\nRunning process: {running_process}" if running_process else "Failed to start USB Monitor"
-        
-        while running_process.poll() is None and retry_count < 10:
-            # Wait for the process to initialize.
-            time.sleep(100)  # Allow time for monitor.exe to initialize.
-            
-            # Read the output from the process to check if it started successfully.
-            output = read_from_process(running_process)
-            
-            details += "\nWaiting for process to initialize... retry count: {retry_count} \t Output: {output}"
-            
-            # Check if the process is still running.
-            retry_count += 1
-            
+        # Start the monitor and wait for its ready handshake. All further
+        # communication goes through its control channel.
+        running_process, ready = launch_monitor(command, ready_timeout)
+
+        if ready:
+            details = (f"USB Monitor ready in {ready['ready_ms']} ms\n"
+                       f"PID: {ready.get('pid')}\nBackend: {ready.get('backend')}\nVersion: {ready.get('version')}")
+        elif running_process.poll() is not None:
+            details = f"USB Monitor exited with code {running_process.returncode} before it was ready"
+        else:
+            details = f"USB Monitor did not report ready within {ready_timeout} seconds"
+        print(details)
 
         dialog = QDialog()
         dialog.setWindowTitle("USB Monitor Status")
@@ -141,8 +151,11 @@ def start_blocker(override_code, run_time=None):
         dialog.setLayout(layout)
         dialog.exec_()
         
-        if running_process.poll() is not None:
-            # Process terminated prematurely – it failed to start.
+        if running_process.poll() is not None or not ready:
+            # Process terminated prematurely or never became ready – it failed to start.
+            if running_process.poll() is None:
+                running_process.kill()
+                running_process.wait()
             QMessageBox.critical(None, "Error", "USB Monitor failed to start.")
             running_process = None
             running_process_id = None
@@ -155,26 +168,28 @@ def start_blocker(override_code, run_time=None):
         running_process = None
         running_process_id = None
 
-def stop_blocker():
+def stop_blocker(override_code, endpoint=DEFAULT_ENDPOINT):
     """
-    Stops monitor.exe. If the monitor supports a command interface,
-    attempt to send "STOP" via its stdin; otherwise, terminate it.
+    Stops monitor.exe. The stop command is sent over the monitor's control
+    channel; a child process we started ourselves is terminated if it does
+    not exit on its own.
     """
+    from PyQt5.QtWidgets import QMessageBox  # type: ignore
     global running_process, running_process_id
 
-    if not evaluate_if_blocker_is_running():
+    if not evaluate_if_blocker_is_running(endpoint):
         QMessageBox.information(None, "Info", "USB Monitor is not running.")
         return
 
     try:
-        # Option 1: If the monitor.exe is designed to read commands, try sending "STOP"
-        response = send_to_process(running_process, "STOP")
+        # Option 1: Ask the monitor to stop over its control channel
+        response = get_monitor_client(endpoint).call("stop", code=override_code)
         print("USB Monitor responded:", response)
-    except Exception as e:
-        print("Error sending STOP command:", e)
+    except ControlError as e:
+        print("Error sending stop command:", e)
     finally:
         # Option 2: Terminate the process if it is still alive.
-        if running_process.poll() is None:
+        if running_process is not None and running_process.poll() is None:
             running_process.terminate()
             try:
                 running_process.wait(timeout=5)
@@ -185,19 +200,185 @@ def stop_blocker():
         running_process_id = None
         QMessageBox.information(None, "Info", "USB Monitor stopped successfully.")
 
+def mint_unlock_codes(totp_secret_file, machines, at=None):
+    """
+    Mint a one-time unlock code for each machine name. Yields
+    (machine, code, seconds the code stays current); the monitor also
+    accepts a code for one step either side of that.
+    """
+    secret = read_secret(totp_secret_file)
+    for machine in machines:
+        code, remaining = mint_code(secret, machine, at)
+        yield machine, code, remaining
+
+def fleet_code(host, override_code, totp_secret):
+    """
+    The code sent to `host`: the override code if given, else a one-time
+    code minted for the machine's name.
+    """
+    if override_code:
+        return override_code
+    return mint_code(totp_secret, host.name)[0]
+
+def is_this_machine(host):
+    """
+    Whether the inventory entry `host` names the machine the client runs on.
+    """
+    hostname = socket.gethostname().lower()
+    return host.name.lower() in ("localhost", hostname, hostname.split(".")[0])
+
+def start_fleet_monitor(host, override_hash, runtime_dir, ready_timeout=30, timeout=5.0, totp_secret_file=None,
+                        supervised=False, headless=False, run_time=None, policy=None):
+    """
+    Start a monitor for `host` on this machine and wait for it to be ready.
+    There is nothing on a machine without a monitor to take a remote start,
+    so run_fleet_command() only calls this for this machine, or for every
+    host with --local (lab rigs, load tests). Each gets its own runtime directory under
+    `runtime_dir`, since one monitor runs per TEMP, for its audit log,
+    device snapshot and a policy file (seeded with `policy`) that policies
+    can be pushed to. Returns a fleet.host_result() dict.
+    """
+    started = time.perf_counter()
+    probe = call_host(host, "status", {}, timeout=timeout, retries=0)
+    if probe["ok"]:
+        return host_result(host, True, 1, started, result=f"already running (PID {probe['result'].get('pid')})")
+    instance_dir = os.path.abspath(os.path.join(runtime_dir, host.name))
+    os.makedirs(instance_dir, exist_ok=True)
+    policy_path = os.path.join(instance_dir, "policy.json")
+    if not os.path.exists(policy_path):
+        with open(policy_path, "w", encoding="utf-8") as f:
+            json.dump(policy or {}, f, indent=2)
+    # Fleet monitors start without the splash countdown and alert. The
+    # endpoint is resolved here: the monitor would look in its own TEMP.
+    command = get_blocker_command() + ["supervise" if supervised else "start",
+                                       "--endpoint", endpoint_address(host.endpoint), "--machine", host.name,
+                                       "--policy", policy_path, "--fast-start",
+                                       "--audit_log", os.path.join(instance_dir, "usb_blocker_audit.jsonl"),
+                                       "--snapshot_file", os.path.join(instance_dir, "usb_blocker_devices.snap")]
+    if override_hash:
+        command += ["--override_hash", override_hash]
+    if totp_secret_file:
+        command += ["--totp_secret_file", os.path.abspath(totp_secret_file)]
+    if run_time:
+        command += ["--run_time", str(run_time)]
+    if headless:
+        command.append("--headless")
+    process, ready = launch_monitor(command, ready_timeout, env=dict(os.environ, TEMP=instance_dir))
+    if ready:
+        return host_result(host, True, 1, started, result=ready)
+    if process.poll() is not None:
+        return host_result(host, False, 1, started, error=f"exited with code {process.returncode} before it was ready")
+    process.kill()
+    process.wait()
+    return host_result(host, False, 1, started, error=f"did not report ready within {ready_timeout} seconds")
+
+def run_fleet_command(args, parser):
+    """
+    'fleet': send args.fleet_command to every machine in args.inventory and
+    report the results. Returns the exit code (1 if any machine failed).
+    """
+    command = args.fleet_command
+    if not command or not args.inventory:
+        parser.error("'fleet' needs a command and --inventory")
+    if command in ("start", "stop", "unlock", "push") and not (args.override or args.totp_secret_file):
+        parser.error(f"'fleet {command}' needs --override or --totp_secret_file")
+    if command == "push" and not args.policy_file:
+        parser.error("'fleet push' needs --policy_file")
+    try:
+        hosts = read_inventory(args.inventory)
+        secret = read_secret(args.totp_secret_file) if args.totp_secret_file else None
+        policy = None
+        if args.policy_file:
+            with open(args.policy_file, "r", encoding="utf-8") as f:
+                policy = json.load(f)
+            # One local check instead of an error reply from every machine
+            AllowList(validate_policy(policy)["allow"])
+    except (InventoryError, CredentialError, PolicyError, AllowListError, OSError, ValueError) as e:
+        print(e)
+        return 1
+
+    if command == "start":
+        # Hashed once; the monitors only ever see the hash
+        override_hash = hash_code(args.override) if args.override else None
+
+        def task(host):
+            if not (args.local or is_this_machine(host)):
+                return host_result(host, False, 1, time.perf_counter(),
+                                   error="not this machine; 'fleet start' only starts monitors locally "
+                                         "(--local starts one here for every host)")
+            return start_fleet_monitor(host, override_hash, args.runtime_dir, ready_timeout=args.ready_timeout,
+                                       timeout=args.timeout, totp_secret_file=args.totp_secret_file,
+                                       supervised=args.supervised, headless=args.headless, run_time=args.run_time,
+                                       policy=policy)
+    else:
+        def task(host):
+            options = {}
+            if command in ("stop", "unlock", "push"):
+                options["code"] = fleet_code(host, args.override, secret)
+            if command == "push":
+                options["policy"] = policy
+            return call_host(host, command, options, timeout=args.timeout, retries=args.retries)
+
+    width = max(len("HOST"), *(len(host.name) for host in hosts))
+    summary = report(run_fleet(hosts, task, workers=args.workers), "json" if args.json else "table", width=width)
+    return 1 if summary["failed"] else 0
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="App Interface for USB Monitor tool")
-    parser.add_argument("action", choices=["start", "stop"], help="Action to perform")
-    parser.add_argument("--override", required=True, help="Override code for stopping/unlocking")
+    parser.add_argument("action", choices=["start", "stop", "code", "fleet"],
+                        help="Start or stop the monitor, mint one-time unlock codes, or control many monitors")
+    parser.add_argument("fleet_command", nargs="?", choices=FLEET_COMMANDS,
+                        help="Command 'fleet' sends to every machine in --inventory")
+    parser.add_argument("--override", help="Override code for stopping/unlocking")
+    parser.add_argument("--totp_secret_file", help="Fleet secret for one-time unlock codes")
+    parser.add_argument("--machine", action="append", help="Machine to mint a one-time code for (repeatable)")
     parser.add_argument("--run_time", type=int, help="Time in seconds to run the monitor")
+    parser.add_argument("--endpoint", help="Control endpoint of the monitor (default: the registered monitor's)")
+    parser.add_argument("--ready_timeout", type=float, default=30, help="Seconds to wait for the monitor to report ready")
+    parser.add_argument("--fast-start", dest="fast_start", action="store_true", help="Start the monitor without its splash countdown")
+    parser.add_argument("--supervised", action="store_true", help="Run the monitor under its restarting supervisor")
+    parser.add_argument("--inventory", help="'fleet': file of machines, one 'name [endpoint]' per line (see fleet.py)")
+    parser.add_argument("--policy_file", help="'fleet push': JSON policy to install (for 'fleet start': the initial one)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="'fleet': machines contacted at once")
+    parser.add_argument("--timeout", type=float, default=5, help="'fleet': seconds to wait for each machine's reply")
+    parser.add_argument("--retries", type=int, default=2, help="'fleet': retries for a machine that cannot be reached")
+    parser.add_argument("--json", action="store_true", help="'fleet': print JSON lines instead of a table")
+    parser.add_argument("--headless", action="store_true", help="'fleet start': start headless monitors")
+    parser.add_argument("--local", action="store_true",
+                        help="'fleet start': start a monitor on this machine for every host (lab rigs, load tests)")
+    parser.add_argument("--runtime_dir", default=os.path.join(tempfile.gettempdir(), "usb_blocker_fleet"),
+                        help="'fleet start': directory for the started monitors' runtime files")
     args = parser.parse_args()
+
+    if args.action == "fleet":
+        sys.exit(run_fleet_command(args, parser))
+
+    if args.action == "code":
+        # Helpdesk use: no GUI needed
+        if not args.totp_secret_file or not args.machine:
+            parser.error("'code' needs --totp_secret_file and at least one --machine")
+        try:
+            for machine, code, remaining in mint_unlock_codes(args.totp_secret_file, args.machine):
+                print(f"{machine}\t{code}\tvalid for about {remaining + TOTP_STEP:.0f} s")
+        except CredentialError as e:
+            print(e)
+            sys.exit(1)
+        sys.exit(0)
+    if args.action == "stop" and not args.override:
+        parser.error("--override is required for 'stop'")
+    if args.action == "start" and not (args.override or args.totp_secret_file):
+        parser.error("'start' needs --override and/or --totp_secret_file")
+    if not args.endpoint:
+        args.endpoint = find_endpoint(DEFAULT_ENDPOINT) if args.action == "stop" else DEFAULT_ENDPOINT
     print(f"Client started with Arguments: {args}")
     # Create a QApplication to support message boxes.
+    from PyQt5.QtWidgets import QApplication  # type: ignore
     app = QApplication(sys.argv)
 
     if args.action == "start":
-        start_blocker(args.override, args.run_time)
+        start_blocker(args.override, args.run_time, endpoint=args.endpoint, ready_timeout=args.ready_timeout,
+                      fast_start=args.fast_start, totp_secret_file=args.totp_secret_file, supervised=args.supervised)
     elif args.action == "stop":
-        stop_blocker()
+        stop_blocker(args.override, endpoint=args.endpoint)
 
     sys.exit(app.exec_())
@@ -0,0 +1,482 @@
+import os
+import json
+import stat
+import time
+import socket
+import struct
+import secrets
+import threading
+import subprocess
+from instance import registry_dir
+
+# =============================================================================
+# Control Channel
+# The running blocker listens on a local endpoint (a named pipe on Windows, a
+# Unix domain socket elsewhere; served by QLocalServer in monitor.py). This
+# module holds the protocol and the pure-stdlib client side, so tools talking
+# to the blocker do not need PyQt5 at all.
+#
+# Protocol: every message is a frame of a 4-byte big-endian length followed
+# by that many bytes of UTF-8 JSON.
+#   request:  {"id": 7, "cmd": "status", "args": {}}
+#   response: {"id": 7, "ok": true, "result": {...}}
+#             {"id": 7, "ok": false, "error": "invalid override code"}
+# Requests on one connection are answered in order, and clients may send
+# several requests before reading any reply (pipelining).
+# =============================================================================
+DEFAULT_ENDPOINT = "usb_blocker"
+MAX_FRAME_SIZE = 1 << 20
+_HEADER = struct.Struct(">I")
+
+
+class ControlError(Exception):
+    pass
+
+
+class ControlReplyError(ControlError):
+    """
+    The monitor answered the request with an error (e.g. a wrong code), as
+    opposed to not answering at all.
+    """
+
+
+def endpoint_address(name=DEFAULT_ENDPOINT):
+    """
+    Resolve an endpoint name to the address QLocalServer listens on:
+    \\\\.\\pipe\\<name> on Windows, <runtime dir>/<name>.sock elsewhere
+    (the user's private directory, see instance.py, so nobody else can bind
+    the name first). Absolute paths are used as given.
+    """
+    if os.name == "nt":
+        return name if name.startswith("\\\\") else "\\\\.\\pipe\\" + name
+    if os.path.isabs(name):
+        return name
+    try:
+        return os.path.join(registry_dir(), name + ".sock")
+    except OSError as e:
+        raise ControlError(f"No private directory for the control socket: {e}")
+
+
+def encode_frame(message):
+    payload = json.dumps(message, separators=(",", ":")).encode("utf-8")
+    return _HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """
+    Incremental frame parser: feed() raw bytes as they arrive and get back
+    the complete messages they finish.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= _HEADER.size:
+            (length,) = _HEADER.unpack_from(self.buffer)
+            if length > MAX_FRAME_SIZE:
+                raise ControlError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+            end = _HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            try:
+                messages.append(json.loads(self.buffer[_HEADER.size:end].decode("utf-8")))
+            except ValueError as e:
+                raise ControlError(f"Malformed frame: {e}")
+            del self.buffer[:end]
+        return messages
+
+
+# =============================================================================
+# Section 1: Transports
+# =============================================================================
+class _SocketTransport:
+    def __init__(self, address, timeout):
+        # Codes are only ever sent to a monitor run by this user
+        st = os.stat(address)
+        if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+            raise OSError(f"'{address}' is not a socket owned by this user")
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        if hasattr(socket, "SO_PEERCRED"):
+            _, uid, _ = struct.unpack("3i", self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                                 struct.calcsize("3i")))
+            if uid != os.getuid():
+                self.sock.close()
+                raise OSError(f"'{address}' is served by another user (UID {uid})")
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def recv(self, timeout):
+        self.sock.settimeout(timeout)
+        try:
+            return self.sock.recv(65536)
+        except socket.timeout:
+            raise TimeoutError("Timed out waiting for a reply")
+
+    def close(self):
+        self.sock.close()
+
+
+class _PipeTransport:
+    """
+    Windows named pipe client using overlapped I/O, so reads can time out
+    (the same approach as multiprocessing.connection.PipeConnection).
+    """
+
+    def __init__(self, address, timeout):
+        import _winapi
+        self._winapi = _winapi
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.handle = _winapi.CreateFile(
+                    address, _winapi.GENERIC_READ | _winapi.GENERIC_WRITE, 0, _winapi.NULL,
+                    _winapi.OPEN_EXISTING, _winapi.FILE_FLAG_OVERLAPPED, _winapi.NULL)
+                break
+            except OSError as e:
+                # All pipe instances busy: wait for the server to create another
+                remaining = deadline - time.monotonic()
+                if e.winerror != _winapi.ERROR_PIPE_BUSY or remaining <= 0:
+                    raise
+                _winapi.WaitNamedPipe(address, int(remaining * 1000))
+
+    def send(self, data):
+        ov, _ = self._winapi.WriteFile(self.handle, data, overlapped=True)
+        ov.GetOverlappedResult(True)
+
+    def recv(self, timeout):
+        _winapi = self._winapi
+        ov, _ = _winapi.ReadFile(self.handle, 65536, overlapped=True)
+        waited = _winapi.WaitForMultipleObjects(
+            [ov.event], False, _winapi.INFINITE if timeout is None else int(timeout * 1000))
+        if waited == _winapi.WAIT_TIMEOUT:
+            ov.cancel()
+            ov.GetOverlappedResult(True)
+            raise TimeoutError("Timed out waiting for a reply")
+        try:
+            ov.GetOverlappedResult(True)
+        except BrokenPipeError:
+            return b""
+        return ov.getbuffer().tobytes()
+
+    def close(self):
+        self._winapi.CloseHandle(self.handle)
+
+
+# =============================================================================
+# Section 2: Client
+# One MonitorClient keeps one connection open and reconnects on demand.
+# It is not thread-safe; use one client per thread.
+# =============================================================================
+class MonitorClient:
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, timeout=2.0):
+        self.endpoint = endpoint
+        self.address = endpoint_address(endpoint)
+        self.timeout = timeout
+        self.transport = None
+        self.decoder = None
+        self.next_id = 1
+        self.responses = {}  # replies that arrived while waiting for another id
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        if self.transport is not None:
+            return
+        transport_class = _PipeTransport if os.name == "nt" else _SocketTransport
+        try:
+            self.transport = transport_class(self.address, self.timeout)
+        except OSError as e:
+            raise ControlError(f"USB Blocker is not reachable at {self.address}: {e}")
+        self.decoder = FrameDecoder()
+        self.responses = {}
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def send(self, command, **args):
+        """
+        Send a request without waiting for the reply. Returns its request id,
+        to be passed to receive().
+        """
+        self.connect()
+        request_id = self.next_id
+        self.next_id += 1
+        try:
+            self.transport.send(encode_frame({"id": request_id, "cmd": command, "args": args}))
+        except OSError as e:
+            self.close()
+            raise ControlError(f"Lost connection to USB Blocker: {e}")
+        return request_id
+
+    def receive(self, request_id, timeout=None):
+        """
+        Wait for the reply to `request_id` and return its result.
+        Raises ControlError for error replies, timeouts and lost connections.
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while request_id not in self.responses:
+            if self.transport is None:
+                raise ControlError("Not connected to USB Blocker")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ControlError(f"Timed out waiting for reply {request_id}")
+            try:
+                data = self.transport.recv(remaining)
+            except TimeoutError:
+                continue
+            except OSError as e:
+                self.close()
+                raise ControlError(f"Lost connection to USB Blocker: {e}")
+            if not data:
+                self.close()
+                raise ControlError("USB Blocker closed the connection")
+            for message in self.decoder.feed(data):
+                self.responses[message.get("id")] = message
+        reply = self.responses.pop(request_id)
+        if not reply.get("ok"):
+            raise ControlReplyError(reply.get("error") or "Request failed")
+        return reply.get("result")
+
+    def call(self, command, timeout=None, **args):
+        """
+        Send one request and wait for its result. A connection that was closed
+        since the last call is re-established once.
+        """
+        try:
+            request_id = self.send(command, **args)
+        except ControlError:
+            request_id = self.send(command, **args)
+        return self.receive(request_id, timeout)
+
+    def call_many(self, requests, timeout=None):
+        """
+        Pipeline several (command, args) requests on the connection and return
+        their results in order. Failed requests yield their ControlError.
+        """
+        ids = [self.send(command, **args) for command, args in requests]
+        results = []
+        for request_id in ids:
+            try:
+                results.append(self.receive(request_id, timeout))
+            except ControlError as e:
+                if self.transport is None:
+                    raise
+                results.append(e)
+        return results
+
+
+def send_command(command, endpoint=DEFAULT_ENDPOINT, timeout=2.0, **args):
+    """
+    One-shot helper: connect, send `command`, return its result.
+    """
+    with MonitorClient(endpoint, timeout=timeout) as client:
+        return client.call(command, **args)
+
+
+# =============================================================================
+# Section 3: Server side
+# dispatch_request() turns one decoded request into its response and is shared
+# by every server: the QLocalServer in gui.py and StreamControlServer below.
+# StreamControlServer is the Qt-free server used in headless mode; it serves a
+# Unix domain socket from a background thread (POSIX only).
+# =============================================================================
+def dispatch_request(handlers, request):
+    """
+    Run the handler for `request` and build its response. `handlers` maps a
+    command name to a callable taking the args dict and returning a
+    JSON-serialisable result; handlers signal failures with ControlError.
+    Never raises: servers call this from Qt slots and connection threads,
+    where an escaping exception would kill the monitor or the connection.
+    """
+    if not isinstance(request, dict):
+        return {"id": None, "ok": False, "error": "request must be a JSON object"}
+    request_id = request.get("id")
+    command = request.get("cmd")
+    args = request.get("args") or {}
+    if not isinstance(args, dict):
+        return {"id": request_id, "ok": False, "error": "'args' must be a JSON object"}
+    try:
+        handler = handlers.get(command)
+    except TypeError:
+        handler = None  # unhashable command
+    if handler is None:
+        return {"id": request_id, "ok": False, "error": f"unknown command {command!r}"}
+    try:
+        return {"id": request_id, "ok": True, "result": handler(args)}
+    except ControlError as e:
+        return {"id": request_id, "ok": False, "error": str(e)}
+    except Exception as e:
+        print(f"Control channel: '{command}' failed: {type(e).__name__}: {e}")
+        return {"id": request_id, "ok": False, "error": f"internal error: {type(e).__name__}"}
+
+
+class StreamControlServer:
+    def __init__(self, handlers, endpoint=DEFAULT_ENDPOINT):
+        self.handlers = handlers
+        self.endpoint = endpoint
+        self.address = endpoint_address(endpoint)
+        self.sock = None
+
+    def listen(self):
+        if os.name == "nt":
+            print("The headless control channel is not available on Windows.")
+            return False
+        # The single-instance lock guarantees a leftover socket file is stale
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the user running the blocker may connect
+        old_umask = os.umask(0o177)
+        try:
+            self.sock.bind(self.address)
+        finally:
+            os.umask(old_umask)
+        self.sock.listen(16)
+        threading.Thread(target=self._accept, daemon=True).start()
+        return True
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.sock.accept()
+            except OSError:
+                return  # server closed
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        decoder = FrameDecoder()
+        with connection:
+            while True:
+                try:
+                    data = connection.recv(65536)
+                    if not data:
+                        return
+                    requests = decoder.feed(data)
+                    replies = b"".join(encode_frame(dispatch_request(self.handlers, r)) for r in requests)
+                    if replies:
+                        connection.sendall(replies)
+                except (OSError, ControlError):
+                    return
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+
+# =============================================================================
+# Section 4: Startup handshake
+# A launcher opens a ReadyListener on loopback and passes its address to the
+# monitor with --notify. Once the monitor is fully armed it connects back and
+# sends one frame:
+#   {"event": "ready", "token": ..., "pid": ..., "backend": ..., "version": ...}
+# The token stops other local processes from faking readiness.
+# launch_monitor() does both halves for launchers that start a monitor and
+# only need to know whether it came up.
+# =============================================================================
+class ReadyListener:
+    def __init__(self):
+        self.token = secrets.token_hex(16)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(4)
+        host, port = self.sock.getsockname()
+        self.address = f"{host}:{port}:{self.token}"
+        self.message = None
+        self.finished = threading.Event()
+        self.started = time.monotonic()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while not self.finished.is_set():
+            try:
+                connection, _ = self.sock.accept()
+            except OSError:
+                return  # listener closed
+            with connection:
+                connection.settimeout(2.0)
+                decoder = FrameDecoder()
+                try:
+                    messages = []
+                    while not messages:
+                        data = connection.recv(4096)
+                        if not data:
+                            break
+                        messages = decoder.feed(data)
+                except (OSError, ControlError):
+                    continue
+            for message in messages:
+                if isinstance(message, dict) and message.get("token") == self.token:
+                    message.pop("token")
+                    message["ready_ms"] = round((time.monotonic() - self.started) * 1000.0, 1)
+                    self.message = message
+                    self.finished.set()
+
+    def watch_process(self, process):
+        """
+        Stop waiting as soon as `process` exits (it will never become ready).
+        """
+        def wait_for_exit():
+            process.wait()
+            self.finished.set()
+        threading.Thread(target=wait_for_exit, daemon=True).start()
+
+    def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds for the ready message. Returns it (with
+        the measured start-to-ready time in "ready_ms"), or None.
+        """
+        self.finished.wait(timeout)
+        self.close()
+        return self.message
+
+    def close(self):
+        self.finished.set()
+        self.sock.close()
+
+
+def launch_monitor(command, ready_timeout, env=None):
+    """
+    Start the monitor `command` (--notify is appended here) without any
+    stdio pipes and wait up to `ready_timeout` seconds for its handshake.
+    Returns (process, ready message or None); a process that is not ready is
+    left to the caller to inspect or kill.
+    """
+    listener = ReadyListener()
+    try:
+        process = subprocess.Popen(command + ["--notify", listener.address], stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL, env=env)
+    except OSError:
+        listener.close()
+        raise
+    listener.watch_process(process)
+    return process, listener.wait(ready_timeout)
+
+
+def notify_ready(address, **details):
+    """
+    Monitor side of the handshake: report readiness to the launcher listening
+    at `address` ("host:port:token"). Failures are reported, never raised.
+    """
+    host, port, token = address.rsplit(":", 2)
+    try:
+        with socket.create_connection((host, int(port)), timeout=2.0) as sock:
+            sock.sendall(encode_frame(dict(details, event="ready", token=token)))
+    except (OSError, ValueError) as e:
+        print(f"Could not send the ready notification to {host}:{port}: {e}")
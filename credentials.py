@@ -0,0 +1,288 @@
+import os
+import hmac
+import time
+import base64
+import getpass
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# =============================================================================
+# Override Code Credentials
+# The monitor never keeps the override code itself, only a salted scrypt
+# hash of it:
+#
+#   scrypt$<n>$<r>$<p>$<salt, base64>$<hash, base64>
+#
+# Codes are checked by hashing the attempt and comparing with
+# hmac.compare_digest. Attempts are serialised (one hash at a time) and,
+# after a few failures in a row, refused outright for an exponentially
+# growing period, so guessing is capped no matter how fast attempts arrive.
+# Hashing takes tens of milliseconds on purpose; GUI code uses submit() to
+# run it on the verifier's worker thread.
+#
+# Machines can also accept one-time codes (see OneTimeCodes below) minted by
+# client.py from a fleet secret; those are checked first and cost
+# microseconds.
+# =============================================================================
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+HASH_BYTES = 32
+# Memory scrypt may use; must exceed 128 * n * r
+SCRYPT_MAXMEM = 64 * 1024 * 1024
+
+
+class CredentialError(ValueError):
+    pass
+
+
+def _scrypt(code, salt, n, r, p):
+    return hashlib.scrypt(code.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=SCRYPT_MAXMEM,
+                          dklen=HASH_BYTES)
+
+
+def hash_code(code, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    """
+    Encode `code` as a salted scrypt hash string.
+    """
+    salt = os.urandom(SALT_BYTES)
+    digest = _scrypt(code, salt, n, r, p)
+    return "$".join(["scrypt", str(n), str(r), str(p),
+                     base64.b64encode(salt).decode("ascii"), base64.b64encode(digest).decode("ascii")])
+
+
+def parse_hash(encoded):
+    """
+    Split an encoded hash into (n, r, p, salt, digest).
+    """
+    try:
+        scheme, n, r, p, salt, digest = encoded.split("$")
+        if scheme != "scrypt":
+            raise ValueError(f"unsupported scheme {scheme!r}")
+        return int(n), int(r), int(p), base64.b64decode(salt, validate=True), base64.b64decode(digest, validate=True)
+    except (AttributeError, ValueError) as e:
+        raise CredentialError(f"Invalid override code hash: {e}")
+
+
+# =============================================================================
+# Section 1: One-time codes
+# TOTP (RFC 6238, HMAC-SHA1) with a per-machine key derived from a shared
+# fleet secret, so a code only unlocks the machine it was minted for:
+#
+#   machine key = HMAC-SHA256(secret, "usb-blocker:" + MACHINE NAME)
+#
+# The secret is a base32 string (as used by authenticator apps) kept in a
+# file that only the helpdesk tooling and the monitor can read.
+# =============================================================================
+TOTP_STEP = 30
+TOTP_DIGITS = 8
+
+
+def new_secret():
+    return base64.b32encode(os.urandom(20)).decode("ascii")
+
+
+def read_secret(path):
+    """
+    Read a base32 fleet secret from a file.
+    """
+    try:
+        with open(path, "r", encoding="ascii") as f:
+            text = "".join(f.read().split()).upper()
+        return base64.b32decode(text + "=" * (-len(text) % 8))
+    except (OSError, ValueError) as e:
+        raise CredentialError(f"Cannot read one-time code secret '{path}': {e}")
+
+
+def machine_key(secret, machine):
+    return hmac.new(secret, b"usb-blocker:" + machine.upper().encode("utf-8"), hashlib.sha256).digest()
+
+
+def totp(key, counter, digits=TOTP_DIGITS):
+    digest = hmac.new(key, counter.to_bytes(8, "big"), hashlib.sha1).digest()
+    offset = digest[-1] & 0x0F
+    value = int.from_bytes(digest[offset:offset + 4], "big") & 0x7FFFFFFF
+    return str(value % 10 ** digits).zfill(digits)
+
+
+def mint_code(secret, machine, at=None, step=TOTP_STEP, digits=TOTP_DIGITS):
+    """
+    One-time code for `machine` at time `at` (default now). Returns
+    (code, seconds it stays current).
+    """
+    at = time.time() if at is None else at
+    counter = int(at // step)
+    return totp(machine_key(secret, machine), counter, digits), step - (at % step)
+
+
+class OneTimeCodes:
+    """
+    Offline checker for one machine's one-time codes. The codes of the
+    current time step and `window` steps either side are computed once per
+    step and cached, so a check is a handful of compare_digest calls. Each
+    code works once: after a successful unlock, codes from that step or
+    earlier are refused.
+    """
+
+    def __init__(self, secret, machine, step=TOTP_STEP, window=1, digits=TOTP_DIGITS):
+        self.key = machine_key(secret, machine)
+        self.machine = machine
+        self.step = step
+        self.window = window
+        self.digits = digits
+        self.cached_counter = None
+        self.valid = ()  # (counter, code) pairs for the cached step
+        self.last_used = -1
+        self.accepted = 0
+
+    def codes(self, now=None):
+        counter = int((time.time() if now is None else now) // self.step)
+        if counter != self.cached_counter:
+            self.valid = tuple((c, totp(self.key, c, self.digits))
+                               for c in range(counter - self.window, counter + self.window + 1))
+            self.cached_counter = counter
+        return self.valid
+
+    def verify(self, code, now=None):
+        if not isinstance(code, str) or len(code) != self.digits:
+            return False
+        attempt = code.encode("utf-8")
+        matched = None
+        # Compare against every valid code, so timing does not reveal which matched
+        for counter, valid in self.codes(now):
+            if hmac.compare_digest(attempt, valid.encode("ascii")) and counter > self.last_used:
+                matched = counter
+        if matched is None:
+            return False
+        self.last_used = matched
+        self.accepted += 1
+        return True
+
+
+# =============================================================================
+# Section 2: Verification
+# =============================================================================
+class CodeVerifier:
+    """
+    Checks override codes against an encoded hash and/or one-time codes,
+    with exponential backoff: the first `free_attempts` failures in a row
+    cost nothing extra, each one after that blocks all attempts for
+    `base_delay` * 2^k seconds (at most `max_delay`). A correct code resets
+    the count.
+    """
+
+    def __init__(self, encoded=None, one_time=None, free_attempts=3, base_delay=1.0, max_delay=300.0):
+        if encoded is None and one_time is None:
+            raise CredentialError("No override code hash or one-time code secret configured")
+        self.n = self.r = self.p = self.salt = self.digest = None
+        if encoded is not None:
+            self.n, self.r, self.p, self.salt, self.digest = parse_hash(encoded)
+            if len(self.digest) != HASH_BYTES:
+                raise CredentialError(f"Invalid override code hash: digest is {len(self.digest)} bytes, "
+                                      f"expected {HASH_BYTES}")
+            # Trial hash, so parameters scrypt rejects (n not a power of two,
+            # too much memory) fail at load time rather than on every unlock
+            try:
+                _scrypt("", self.salt, self.n, self.r, self.p)
+            except (ValueError, OverflowError, MemoryError) as e:
+                raise CredentialError(f"Invalid override code hash parameters: {e}")
+        self.one_time = one_time
+        self.free_attempts = free_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.executor = None
+        self.consecutive_failures = 0
+        self.blocked_until = 0.0
+        # Counters
+        self.attempts = 0
+        self.failures = 0
+        self.rejected = 0
+        self.last_hash_ms = 0.0
+
+    def retry_after(self):
+        """
+        Seconds until the next attempt will be considered (0 if now).
+        """
+        return max(0.0, self.blocked_until - time.monotonic())
+
+    def verify(self, code):
+        """
+        Check `code`. Returns (ok, retry_after): whether it was correct, and
+        how long further attempts are refused. Blocks for the hash; safe to
+        call from any thread.
+        """
+        with self.lock:
+            self.attempts += 1
+            wait = self.retry_after()
+            if wait > 0:
+                # Refused without hashing, so blocked attempts cost nothing
+                self.rejected += 1
+                return False, wait
+            # One-time codes first: they are cheap to check
+            ok = self.one_time is not None and self.one_time.verify(code)
+            if not ok and self.digest is not None:
+                started = time.perf_counter()
+                candidate = _scrypt(code, self.salt, self.n, self.r, self.p) if isinstance(code, str) else b""
+                ok = hmac.compare_digest(candidate, self.digest)
+                self.last_hash_ms = (time.perf_counter() - started) * 1000.0
+            if ok:
+                self.consecutive_failures = 0
+                return True, 0.0
+            self.failures += 1
+            self.consecutive_failures += 1
+            excess = self.consecutive_failures - self.free_attempts
+            if excess >= 0:
+                self.blocked_until = time.monotonic() + min(self.max_delay, self.base_delay * 2 ** excess)
+            return False, self.retry_after()
+
+    def submit(self, code, callback):
+        """
+        Verify `code` on the verifier's worker thread and call
+        callback(ok, retry_after) there when done. The callback always runs:
+        if verification raises, it gets a failed result.
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="code-verifier")
+
+        def done(future):
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Code check failed: {type(e).__name__}: {e}")
+                result = (False, self.retry_after())
+            callback(*result)
+
+        self.executor.submit(self.verify, code).add_done_callback(done)
+
+    def stats(self):
+        return {
+            "unlock_attempts": self.attempts,
+            "unlock_failures": self.failures,
+            "unlock_rejected": self.rejected,
+            "unlock_retry_after_s": round(self.retry_after(), 1),
+            "unlock_last_hash_ms": round(self.last_hash_ms, 1),
+            "unlock_one_time_accepted": self.one_time.accepted if self.one_time else 0,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create override code credentials for monitor.py")
+    parser.add_argument("command", nargs="?", choices=["hash", "secret"], default="hash",
+                        help="hash: hash an override code for --override_hash; "
+                             "secret: generate a fleet secret for --totp_secret_file")
+    args = parser.parse_args()
+    if args.command == "secret":
+        print(new_secret())
+        return
+    code = getpass.getpass("Override code: ")
+    if code != getpass.getpass("Repeat: "):
+        raise SystemExit("The codes do not match.")
+    print(hash_code(code))
+
+
+if __name__ == '__main__':
+    main()
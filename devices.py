@@ -0,0 +1,123 @@
+import os
+import re
+from collections import namedtuple
+
+# =============================================================================
+# Device Identity
+# Pulls VID/PID/serial/class information out of the backend-specific device
+# events, so policy decisions (allow-lists, storage blocking) can be made on
+# what was plugged in rather than on the fact that something was.
+# =============================================================================
+
+# vid/pid are 4-digit upper-case hex strings ("0781"), serial is upper-case
+# (empty if the device has none), and classes is a frozenset of 2-digit hex
+# USB class codes from the device and its interfaces ("08" = mass storage,
+# "03" = HID). Any field may be empty when the backend cannot provide it.
+DeviceIdentity = namedtuple("DeviceIdentity", ["vid", "pid", "serial", "classes"])
+
+UNKNOWN_DEVICE = DeviceIdentity("", "", "", frozenset())
+
+# USB\VID_0781&PID_5567\4C530001230512345678
+_PNP_ID = re.compile(r"VID_([0-9A-F]{4})&PID_([0-9A-F]{4})(?:[^\\]*)(?:\\(.*))?$")
+# USB\Class_08&SubClass_06&Prot_50
+_PNP_CLASS = re.compile(r"\\CLASS_([0-9A-F]{2})")
+
+SYSFS_ROOT = "/sys"
+
+
+def _hex(value, width):
+    try:
+        return format(int(value, 16), "0%dX" % width)
+    except (TypeError, ValueError):
+        return ""
+
+
+def _read_sysfs(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def identity_from_pnp(device_id, compatible_ids=()):
+    """
+    Identity of a Windows PnP device instance ID. Instance IDs generated by
+    Windows for devices without a serial number contain "&" in the last part.
+    """
+    upper = device_id.upper()
+    match = _PNP_ID.search(upper)
+    if not match:
+        return UNKNOWN_DEVICE
+    vid, pid, serial = match.group(1), match.group(2), match.group(3) or ""
+    if "&" in serial:
+        serial = ""
+    classes = frozenset(_PNP_CLASS.findall(" ".join(compatible_ids).upper()))
+    return DeviceIdentity(vid, pid, serial, classes)
+
+
+def identity_from_uevent(properties, sysfs_root=SYSFS_ROOT):
+    """
+    Identity of a Linux USB uevent. PRODUCT and TYPE/INTERFACE come from the
+    event itself; the serial number and the interface classes are read from
+    sysfs when the device is still present.
+    """
+    product = properties.get("PRODUCT", "").split("/")
+    vid = _hex(product[0], 4) if len(product) >= 2 else ""
+    pid = _hex(product[1], 4) if len(product) >= 2 else ""
+    classes = set()
+    for key in ("TYPE", "INTERFACE"):
+        code = properties.get(key, "").split("/")[0]
+        if code and code != "0":
+            classes.add(_hex(code, 2))
+    serial = ""
+    devpath = properties.get("DEVPATH", "")
+    if devpath:
+        device_dir = os.path.join(sysfs_root, devpath.lstrip("/"))
+        if properties.get("DEVTYPE") == "usb_interface":
+            device_dir = os.path.dirname(device_dir)
+        serial = _read_sysfs(os.path.join(device_dir, "serial")).upper()
+        try:
+            entries = os.listdir(device_dir)
+        except OSError:
+            entries = []
+        for entry in entries:
+            if ":" in entry:
+                code = _read_sysfs(os.path.join(device_dir, entry, "bInterfaceClass"))
+                if code:
+                    classes.add(_hex(code, 2))
+    return DeviceIdentity(vid, pid, serial, frozenset(classes))
+
+
+def device_identity(event):
+    """
+    Best-effort identity for any DeviceEvent. Replay recordings may carry
+    VID/PID/SERIAL/CLASS properties directly, a PnP instance ID, or raw
+    uevent properties.
+    """
+    properties = event.properties or {}
+    if "VID" in properties:
+        classes = properties.get("CLASS", "")
+        return DeviceIdentity(
+            _hex(properties.get("VID"), 4),
+            _hex(properties.get("PID"), 4),
+            properties.get("SERIAL", "").upper(),
+            frozenset(_hex(c, 2) for c in classes.split(",") if c) if classes else frozenset(),
+        )
+    if "PRODUCT" in properties:
+        return identity_from_uevent(properties)
+    if event.device_id:
+        return identity_from_pnp(event.device_id, properties.get("CompatibleID", "").split(";"))
+    return UNKNOWN_DEVICE
+
+
+def format_identity(identity):
+    """
+    Human-readable VID:PID:SERIAL form used in logs and allow-list files.
+    """
+    if not identity.vid:
+        return "unknown"
+    text = f"{identity.vid}:{identity.pid}"
+    if identity.serial:
+        text += f":{identity.serial}"
+    return text
@@ -0,0 +1,303 @@
+import os
+import time
+import signal
+import asyncio
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from control import ControlError, FrameDecoder, dispatch_request, encode_frame, endpoint_address
+
+# =============================================================================
+# Asyncio Engine
+# Runs a headless blocker (monitor.HeadlessRunner) on a single asyncio event
+# loop instead of one thread per concern (`monitor.py start --engine asyncio`):
+#
+#   event sources   sources that can be polled (kernel uevents) are watched
+#                   with loop.add_reader() and read on the loop; sources whose
+#                   wait() blocks (WMI's COM sink, replay recordings) each get
+#                   one pump thread (a pool sized to the sources) that only
+#                   forwards their events
+#   decisions       USBMonitor.process() on the loop (allow-list, storage,
+#                   coalescing), lock decisions through the runner's
+#                   EventChannel, drained on the loop
+#   control server  asyncio.start_unix_server() with the same framing and
+#                   handlers; "stop", "unlock" and "push" hash a code and
+#                   run on a one-thread command executor, like the GUI's
+#                   offloaded commands, so a pump never holds them up
+#   timers          the run time and the next schedule transition
+#                   (call_later), policy polling (a task), signals
+#                   (add_signal_handler)
+#
+# Several event sources can be served at once (Engine(runner, sources=[...])).
+# The audit writer and the storage guard keep their own threads: they do
+# blocking disk and mount work that asyncio has no non-blocking form of.
+# The GUI keeps the Qt event loop; this engine is for headless runs and
+# in-process tests.
+# =============================================================================
+# Control commands that verify an override code (a deliberately slow hash)
+OFFLOADED_COMMANDS = ("stop", "unlock", "push")
+
+
+class _LoopWakeup:
+    """
+    Stands in for the runner's threading.Event wakeup: set() from any thread
+    schedules `callback` on the loop.
+    """
+
+    def __init__(self, loop, callback):
+        self.loop = loop
+        self.callback = callback
+
+    def set(self):
+        try:
+            self.loop.call_soon_threadsafe(self.callback)
+        except RuntimeError:
+            pass  # loop already closed
+
+
+class Engine:
+    def __init__(self, runner, sources=None):
+        self.runner = runner
+        self.usb_monitor = runner.usb_monitor
+        self.sources = list(sources or [self.usb_monitor.event_source])
+        self.handlers = dict(runner.control_server.handlers, status=self.control_status)
+        self.address = endpoint_address(runner.endpoint)
+        self.loop = None
+        self.done = None
+        self.server = None
+        self.pumps = []
+        self.pump_executor = None
+        self.command_executor = None
+        self.watched = []
+        self.schedule_timer = None
+        self.closing = False  # read by the pump threads
+        self.idle_clients = set()
+        self.busy_clients = set()
+        # Counters
+        self.connections = 0
+        self.requests = 0
+        self.events = 0
+
+    def run(self):
+        """
+        Serve until stopped. Returns the process exit code.
+        """
+        return asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.done = asyncio.Event()
+        runner = self.runner
+        runner.wakeup = _LoopWakeup(self.loop, self.wake)
+        runner.lock_channel.notify = runner.wakeup.set
+        # Pumps never return while their source is open, so they get their
+        # own threads rather than the loop's default executor
+        self.pump_executor = ThreadPoolExecutor(max_workers=max(1, len(self.sources)),
+                                                thread_name_prefix="engine-pump")
+        self.command_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="engine-command")
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signum, runner.stop, "signal")
+            except (NotImplementedError, RuntimeError):
+                signal.signal(signum, lambda *_: runner.stop("signal"))
+        attached = await asyncio.gather(*(self.open_source(source) for source in self.sources))
+        if self.usb_monitor.snapshot:
+            self.usb_monitor.reconcile([event for events in attached for event in events])
+        runner.prepare()
+        if runner.run_time:
+            self.loop.call_later(runner.run_time, runner.stop, "run_time")
+        policy_task = self.loop.create_task(self.poll_policy()) if runner.policy_manager else None
+        await self.listen()
+        runner.ready()
+        # Lock decisions posted before the loop was watching
+        self.wake()
+        await self.done.wait()
+        if policy_task:
+            policy_task.cancel()
+        if self.schedule_timer:
+            self.schedule_timer.cancel()
+        await self.close()
+        return runner.finish()
+
+    def wake(self):
+        for event in self.runner.lock_channel.drain():
+            self.runner.lock(event)
+        if self.runner.stopping.is_set():
+            self.done.set()
+        else:
+            # A policy reload may have moved the next schedule transition
+            self.arm_schedule()
+
+    def arm_schedule(self):
+        scheduler = self.runner.scheduler
+        if self.schedule_timer:
+            self.schedule_timer.cancel()
+            self.schedule_timer = None
+        delay = scheduler.sleep_time() if scheduler else None
+        if delay is not None:
+            self.schedule_timer = self.loop.call_later(delay, self.schedule_due)
+
+    def schedule_due(self):
+        self.schedule_timer = None
+        if self.runner.scheduler.advance():
+            self.runner.apply_schedule()
+        self.arm_schedule()
+
+    async def open_source(self, source):
+        """
+        Start reading `source`. Returns its attached devices, for the
+        snapshot reconciliation.
+        """
+        opened = self.loop.create_future()
+        try:
+            # Sources are opened on the thread that reads them (COM needs it)
+            self.pumps.append(self.loop.run_in_executor(self.pump_executor, self.pump, source, opened))
+            return await opened
+        except Exception as e:
+            metrics.MONITOR_ERRORS["event_source"].inc()
+            print(f"Engine: cannot open event source '{source.name}': {e}")
+            return []
+
+    def pump(self, source, opened):
+        """
+        Pump thread: open `source`, then either hand it to the loop (if
+        it can be polled) or forward its events until it is cancelled.
+        """
+        try:
+            source.open()
+            attached = self.usb_monitor.attached_devices(source)
+        except Exception as e:
+            self.loop.call_soon_threadsafe(opened.set_exception, e)
+            return
+        files = source.pollable()
+        if files:
+            self.loop.call_soon_threadsafe(self.watch, source, files, opened, attached)
+            return
+        self.loop.call_soon_threadsafe(opened.set_result, attached)
+        try:
+            while not self.closing:
+                try:
+                    event = source.wait()
+                except Exception as e:
+                    metrics.MONITOR_ERRORS["event_source"].inc()
+                    print(f"Engine: error reading device events from '{source.name}': {e}")
+                    # Back off briefly so a broken backend cannot spin the CPU
+                    time.sleep(1.0)
+                    continue
+                if event:
+                    self.loop.call_soon_threadsafe(self.process, event)
+        finally:
+            source.close()
+
+    def watch(self, source, files, opened, attached):
+        for f in files:
+            self.loop.add_reader(f, self.readable, source)
+        self.watched.append((source, files))
+        opened.set_result(attached)
+
+    def readable(self, source):
+        try:
+            event = source.wait()
+        except Exception as e:
+            metrics.MONITOR_ERRORS["event_source"].inc()
+            print(f"Engine: error reading device events from '{source.name}': {e}")
+            return
+        if event:
+            self.process(event)
+
+    def process(self, event):
+        self.events += 1
+        self.usb_monitor.process(event)
+
+    def sources_alive(self):
+        watched = {id(source) for source, _ in self.watched}
+        return all(id(source) in watched or not pump.done() for source, pump in zip(self.sources, self.pumps))
+
+    async def listen(self):
+        if os.name == "nt":
+            print("The headless control channel is not available on Windows.")
+            return
+        # The single-instance lock guarantees a leftover socket file is stale
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        # Only the user running the blocker may connect
+        old_umask = os.umask(0o177)
+        try:
+            self.server = await asyncio.start_unix_server(self.serve_client, path=self.address)
+        finally:
+            os.umask(old_umask)
+
+    async def serve_client(self, reader, writer):
+        self.connections += 1
+        task = asyncio.current_task()
+        decoder = FrameDecoder()
+        try:
+            while not self.closing:
+                # Idle connections are cancelled at shutdown; busy ones finish
+                self.idle_clients.add(task)
+                try:
+                    data = await reader.read(65536)
+                finally:
+                    self.idle_clients.discard(task)
+                if not data:
+                    return
+                self.busy_clients.add(task)
+                for request in decoder.feed(data):
+                    self.requests += 1
+                    if isinstance(request, dict) and request.get("cmd") in OFFLOADED_COMMANDS:
+                        response = await self.loop.run_in_executor(self.command_executor, dispatch_request,
+                                                                   self.handlers, request)
+                    else:
+                        response = dispatch_request(self.handlers, request)
+                    writer.write(encode_frame(response))
+                await writer.drain()
+                self.busy_clients.discard(task)
+        except (OSError, ControlError, asyncio.CancelledError):
+            return
+        finally:
+            self.busy_clients.discard(task)
+            writer.close()
+
+    def control_status(self, args):
+        status = self.runner.control_status(args)
+        status["monitoring"] = self.sources_alive()
+        status.update(self.stats())
+        return status
+
+    async def poll_policy(self):
+        manager = self.runner.policy_manager
+        while True:
+            await asyncio.sleep(self.runner.POLICY_POLL_INTERVAL)
+            if manager.changed() and manager.reload():
+                self.runner.apply_policy()
+
+    async def close(self):
+        self.closing = True
+        if self.server:
+            self.server.close()
+            for task in list(self.idle_clients):
+                task.cancel()
+            # Let replies in progress (e.g. to "stop") reach their clients
+            await asyncio.gather(*self.busy_clients, *self.idle_clients, return_exceptions=True)
+            await self.server.wait_closed()
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+        for source, files in self.watched:
+            for f in files:
+                self.loop.remove_reader(f)
+            source.close()
+        for source in self.sources:
+            source.cancel()
+        await asyncio.gather(*self.pumps, return_exceptions=True)
+        self.pump_executor.shutdown(wait=False)
+        self.command_executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            "engine": "asyncio",
+            "engine_sources": len(self.sources),
+            "engine_events": self.events,
+            "engine_connections": self.connections,
+            "engine_requests": self.requests,
+        }
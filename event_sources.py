@@ -0,0 +1,456 @@
+import sys
+import os
+import time
+import json
+import stat
+import socket
+import selectors
+from collections import deque, namedtuple
+
+# =============================================================================
+# Device Event Sources
+# USBMonitor does not talk to WMI directly any more. It reads DeviceEvent
+# records from an EventSource, which hides where the events come from:
+#   - WMIEventSource:     Win32_DeviceChangeEvent via WMI (Windows desktops)
+#   - UeventEventSource:  kernel uevents from a netlink socket (Linux)
+#   - ReplayEventSource:  recorded events from a file or pipe (CI, load tests)
+# =============================================================================
+
+# A single device notification.
+#   kind       - "add" or "remove"
+#   device_id  - backend specific device identifier (PNP id, sysfs path, ...)
+#   timestamp  - time.monotonic() when the event was received
+#   properties - raw backend properties as a dict of strings
+#   identity   - devices.DeviceIdentity, filled in by USBMonitor
+DeviceEvent = namedtuple("DeviceEvent", ["kind", "device_id", "timestamp", "properties", "identity"],
+                         defaults=(None,))
+
+
+class EventSource:
+    """
+    Base class for device event backends.
+    open(), wait() and close() are called from the monitor thread, so backends
+    that need per-thread setup (e.g. COM) can do it there. cancel() is the
+    only method called from other threads.
+    """
+    name = "base"
+
+    def open(self):
+        pass
+
+    def wait(self):
+        """
+        Block until the next device event arrives and return it.
+        Returns None once cancel() has been called. Backends may also return
+        None for notifications that are not device events.
+        """
+        raise NotImplementedError
+
+    def cancel(self):
+        """
+        Wake up a blocked wait() and make every later wait() return None.
+        """
+        raise NotImplementedError
+
+    def pollable(self):
+        """
+        Files (after open()) whose readability means the next wait() returns
+        without blocking, for engine.Engine to watch on its event loop. []
+        means wait() may block and has to run on a thread of its own.
+        """
+        return []
+
+    def snapshot(self):
+        """
+        "add" events for the devices attached right now, after open(). Used
+        to reconcile against the devices attached at the previous run (see
+        snapshot.py). Backends that cannot enumerate return [].
+        """
+        return []
+
+    def close(self):
+        pass
+
+
+class SelectableEventSource(EventSource):
+    """
+    Base for backends that can block on a file descriptor.
+    A socket pair acts as the cancellation handle: cancel() writes to one end,
+    which wakes the selector without any timeout-based polling.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._wake_selector = selectors.DefaultSelector()
+        self._wake_selector.register(self._wake_r, selectors.EVENT_READ)
+
+    def watch(self, fileobj):
+        self._selector.register(fileobj, selectors.EVENT_READ)
+
+    def unwatch(self, fileobj):
+        self._selector.unregister(fileobj)
+
+    def wait_readable(self, timeout=None):
+        """
+        Block until a watched descriptor is readable (True), or until the
+        source is cancelled or `timeout` seconds pass (False).
+        """
+        if self.cancelled:
+            return False
+        ready = self._selector.select(timeout)
+        if self.cancelled or not ready:
+            return False
+        return any(key.fileobj is not self._wake_r for key, _ in ready)
+
+    def sleep(self, timeout):
+        """
+        Sleep for `timeout` seconds, returning early (False) if cancelled.
+        """
+        if not self.cancelled:
+            self._wake_selector.select(timeout)
+        return not self.cancelled
+
+    def cancel(self):
+        self.cancelled = True
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass
+
+    def close(self):
+        self._selector.close()
+        self._wake_selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+
+# =============================================================================
+# Section 1: WMI backend (Windows)
+# Subscribes to Win32_DeviceChangeEvent asynchronously through an SWbemSink.
+# The monitor thread then sleeps in MsgWaitForMultipleObjects on a Win32 event
+# (the cancellation handle) plus its COM message queue, so it only wakes up
+# when WMI delivers a notification or stop() is requested.
+# Win32_DeviceChangeEvent does not say which device arrived, so on each
+# arrival the attached USB PnP devices are listed and one "add" event is
+# reported per new device instance ID.
+# =============================================================================
+WMI_QUERY = "SELECT * FROM Win32_DeviceChangeEvent"
+WMI_USB_DEVICES_QUERY = "SELECT DeviceID, CompatibleID FROM Win32_PnPEntity WHERE DeviceID LIKE 'USB%'"
+
+# Win32_DeviceChangeEvent.EventType values
+WMI_EVENT_KINDS = {1: "change", 2: "add", 3: "remove", 4: "docking"}
+
+
+class WMIEventSource(EventSource):
+    name = "wmi"
+
+    def __init__(self):
+        # The cancellation handle is created up front so that cancel() works
+        # even if stop() races with open() on the monitor thread.
+        import win32event  # type: ignore # Requires: pip install pypiwin32
+        self._win32event = win32event
+        self.cancel_handle = win32event.CreateEvent(None, True, False, None)
+        self.pending = deque()
+        self.new_devices = deque()
+        self.known_devices = {}
+        self.services = None
+        self.sink = None
+
+    def open(self):
+        # Imported here so the module can be loaded on machines without pywin32
+        import pythoncom  # type: ignore
+        import win32com.client  # type: ignore
+        self._pythoncom = pythoncom
+        pythoncom.CoInitialize()  # Initialize COM for the monitor thread
+        pending = self.pending
+
+        class _Sink:
+            def OnObjectReady(self, wmi_object, context):
+                pending.append(wmi_object)
+
+        self.services = win32com.client.GetObject("winmgmts:{impersonationLevel=impersonate}!\\\\.\\root\\cimv2")
+        self.known_devices = self.list_usb_devices()
+        self.sink = win32com.client.DispatchWithEvents("WbemScripting.SWbemSink", _Sink)
+        self.services.ExecNotificationQueryAsync(self.sink, WMI_QUERY)
+
+    def list_usb_devices(self):
+        """
+        Map of PnP device instance ID -> ";"-joined compatible IDs for every
+        attached USB device.
+        """
+        devices = {}
+        for entity in self.services.ExecQuery(WMI_USB_DEVICES_QUERY):
+            compatible = entity.CompatibleID or ()
+            devices[entity.DeviceID] = ";".join(compatible)
+        return devices
+
+    def snapshot(self):
+        # open() has just listed them
+        now = time.monotonic()
+        return [DeviceEvent("add", device_id, now, {"EventType": "2", "CompatibleID": compatible})
+                for device_id, compatible in self.known_devices.items()]
+
+    def wait(self):
+        if self.new_devices:
+            return self.new_devices.popleft()
+        win32event = self._win32event
+        while not self.pending:
+            result = win32event.MsgWaitForMultipleObjects(
+                [self.cancel_handle], False, win32event.INFINITE, win32event.QS_ALLINPUT)
+            if result == win32event.WAIT_OBJECT_0:
+                return None  # cancelled
+            # A COM message is waiting: dispatching it runs _Sink.OnObjectReady
+            self._pythoncom.PumpWaitingMessages()
+        event = self.pending.popleft()
+        event_type = int(getattr(event, "EventType", 0) or 0)
+        kind = WMI_EVENT_KINDS.get(event_type, "change")
+        now = time.monotonic()
+        properties = {"EventType": str(event_type)}
+        if kind != "add":
+            self.known_devices = self.list_usb_devices()
+            return DeviceEvent(kind, "", now, properties)
+        attached = self.list_usb_devices()
+        for device_id, compatible in attached.items():
+            if device_id not in self.known_devices:
+                self.new_devices.append(DeviceEvent(
+                    "add", device_id, now, dict(properties, CompatibleID=compatible)))
+        self.known_devices = attached
+        if self.new_devices:
+            return self.new_devices.popleft()
+        # Nothing new on the USB bus: a later notification of the same burst
+        # (or a non-USB device) that has already been reported
+        return None
+
+    def cancel(self):
+        self._win32event.SetEvent(self.cancel_handle)
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.Cancel()
+            self.sink = None
+        self.services = None
+        # Uninitialize COM on the same thread that initialized it
+        self._pythoncom.CoUninitialize()
+
+
+# =============================================================================
+# Section 2: Kernel uevent backend (Linux)
+# Listens on the NETLINK_KOBJECT_UEVENT multicast group, which is the same
+# feed udev itself consumes. Only USB device events are reported.
+# =============================================================================
+NETLINK_KOBJECT_UEVENT = 15
+SYSFS_ROOT = "/sys"
+SYSFS_USB_DEVICES = "/sys/bus/usb/devices"
+
+
+def parse_uevent(data):
+    """
+    Parse a raw kernel uevent ("action@devpath\\0KEY=VALUE\\0...") into a dict.
+    Returns None for messages that are not kernel uevents (e.g. udev's own
+    "libudev" rebroadcasts).
+    """
+    parts = data.split(b"\0")
+    if not parts or b"@" not in parts[0]:
+        return None
+    properties = {}
+    for part in parts[1:]:
+        key, sep, value = part.partition(b"=")
+        if sep:
+            properties[key.decode("utf-8", "replace")] = value.decode("utf-8", "replace")
+    return properties
+
+
+def parse_uevent_file(data):
+    """
+    Parse a sysfs "uevent" file (KEY=VALUE lines) into a dict.
+    """
+    properties = {}
+    for line in data.decode("utf-8", "replace").splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            properties[key] = value
+    return properties
+
+
+class UeventEventSource(SelectableEventSource):
+    name = "uevent"
+
+    def __init__(self, subsystems=("usb",)):
+        super().__init__()
+        self.subsystems = set(subsystems)
+        self.sock = None
+
+    def open(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        # Group 1 carries kernel-originated uevents
+        self.sock.bind((0, 1))
+        self.watch(self.sock)
+
+    def wait(self):
+        if not self.wait_readable():
+            return None
+        properties = parse_uevent(self.sock.recv(65536))
+        if not properties or properties.get("SUBSYSTEM") not in self.subsystems:
+            return None
+        kind = properties.get("ACTION", "")
+        if kind not in ("add", "remove"):
+            return None
+        return DeviceEvent(kind, properties.get("DEVPATH", ""), time.monotonic(), properties)
+
+    def pollable(self):
+        # One datagram per wait()
+        return [self.sock]
+
+    def snapshot(self):
+        events = []
+        now = time.monotonic()
+        try:
+            entries = os.listdir(SYSFS_USB_DEVICES)
+        except OSError:
+            return events
+        for entry in sorted(entries):
+            link = os.path.join(SYSFS_USB_DEVICES, entry)
+            try:
+                # One readlink instead of realpath's lstat per path component
+                device_dir = os.path.normpath(os.path.join(SYSFS_USB_DEVICES, os.readlink(link)))
+            except OSError:
+                continue
+            try:
+                with open(os.path.join(device_dir, "uevent"), "rb") as f:
+                    properties = parse_uevent_file(f.read())
+            except OSError:
+                continue  # removed while scanning
+            devpath = device_dir[len(SYSFS_ROOT):]
+            properties.update(ACTION="add", DEVPATH=devpath, SUBSYSTEM="usb")
+            events.append(DeviceEvent("add", devpath, now, properties))
+        return events
+
+    def close(self):
+        if self.sock is not None:
+            self.unwatch(self.sock)
+            self.sock.close()
+            self.sock = None
+        super().close()
+
+
+# =============================================================================
+# Section 3: Replay backend
+# Reads recorded events, one JSON object per line, from a file, a named pipe
+# or "-" for stdin. Each line looks like:
+#   {"kind": "add", "device_id": "USB\\VID_0781&PID_5567\\01", "properties": {...}}
+# `rate` limits delivery to that many events per second (0 = as fast as
+# possible), so the same recording can be used for latency and load runs.
+# =============================================================================
+class ReplayEventSource(SelectableEventSource):
+    name = "replay"
+
+    def __init__(self, path, rate=0):
+        super().__init__()
+        self.path = path
+        self.rate = rate
+        self.stream = None
+        self.selectable = False
+        self.next_due = 0.0
+        self.pending = b""  # read but not yet returned
+
+    def open(self):
+        if self.path == "-":
+            self.stream = sys.stdin.buffer
+        else:
+            self.stream = open(self.path, "rb")
+        # Pipes are waited on so that stop() can interrupt an idle feed. Regular
+        # files are always readable, and Windows can only select() on sockets.
+        self.selectable = os.name != "nt" and not stat.S_ISREG(os.fstat(self.stream.fileno()).st_mode)
+        if self.selectable:
+            try:
+                self.watch(self.stream)
+            except OSError:
+                # Not pollable (e.g. /dev/null): reads never block anyway
+                self.selectable = False
+        self.next_due = time.monotonic()
+
+    def wait(self):
+        if self.stream is None:
+            # End of the recording: stay idle until the monitor is stopped
+            self.wait_readable()
+            return None
+        if self.rate:
+            delay = self.next_due - time.monotonic()
+            if delay > 0 and not self.sleep(delay):
+                return None
+            self.next_due = max(self.next_due, time.monotonic() - 1.0) + 1.0 / self.rate
+        line = self.read_line()
+        if line is None:
+            return None
+        if not line:
+            self._close_stream()
+            return None
+        line = line.strip()
+        if not line:
+            return None
+        record = json.loads(line)
+        return DeviceEvent(
+            record.get("kind", "add"),
+            record.get("device_id", ""),
+            time.monotonic(),
+            record.get("properties", {}),
+        )
+
+    def read_line(self):
+        """
+        The next line of the recording, b"" at its end, None if cancelled.
+        Lines are split here from os.read() chunks rather than with a
+        buffered readline(), which can pull several lines out of a pipe at
+        once and leave them waiting until the fd is readable again.
+        """
+        while b"\n" not in self.pending:
+            if self.selectable and not self.wait_readable():
+                return None
+            chunk = os.read(self.stream.fileno(), 65536)
+            if not chunk:
+                line, self.pending = self.pending, b""
+                return line
+            self.pending += chunk
+        line, newline, self.pending = self.pending.partition(b"\n")
+        return line + newline
+
+    def _close_stream(self):
+        if self.stream is None:
+            return
+        if self.selectable:
+            self.unwatch(self.stream)
+        if self.stream is not sys.stdin.buffer:
+            self.stream.close()
+        self.stream = None
+
+    def close(self):
+        self._close_stream()
+        super().close()
+
+
+# =============================================================================
+# Section 4: Backend selection
+# =============================================================================
+BACKENDS = ("auto", "wmi", "uevent", "replay")
+
+
+def create_event_source(backend="auto", replay_path=None, replay_rate=0):
+    """
+    Build the event source for the requested backend.
+    "auto" picks WMI on Windows and kernel uevents elsewhere.
+    """
+    if backend == "auto":
+        backend = "wmi" if os.name == "nt" else "uevent"
+    if backend == "wmi":
+        return WMIEventSource()
+    if backend == "uevent":
+        return UeventEventSource()
+    if backend == "replay":
+        if not replay_path:
+            raise ValueError("The replay backend needs a recording (--replay PATH)")
+        return ReplayEventSource(replay_path, rate=replay_rate)
+    raise ValueError(f"Unknown event source backend: {backend}")
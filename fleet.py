@@ -0,0 +1,168 @@
+import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from control import ControlError, ControlReplyError, MonitorClient
+
+# =============================================================================
+# Fleet Control
+# Sends one command to the monitors of many machines at once (`client.py
+# fleet`). The inventory is a text file with one machine per line:
+#
+#   # name      control endpoint (default: the name)
+#   lab-a-01    /run/usb_blocker/lab-a-01.sock
+#   lab-a-02
+#
+# The name is also the machine name one-time codes are minted for. Endpoints
+# are monitor control endpoints (see control.py); a remote machine's is
+# reached through a forwarded Unix socket (ssh -L local.sock:remote.sock).
+#
+# Every machine is one task in a bounded thread pool, and every attempt has
+# its own timeout. Only machines that cannot be connected to are retried,
+# with backoff: once the request is written, the monitor may act on it (a
+# stop or unlock that timed out may still have happened), so timeouts, lost
+# connections and error replies (a wrong code, an invalid policy) are final.
+# Results stream out as they arrive, as a table or as JSON lines.
+# =============================================================================
+DEFAULT_WORKERS = 32
+# Seconds before the first retry, doubled for each further one
+RETRY_BACKOFF = 0.25
+# Result fields shown in the table's detail column
+SUMMARY_KEYS = ("pid", "backend", "locked", "lock_enabled", "schedule_state", "policy_rules", "policy_reloads",
+                "ready_ms")
+
+
+class InventoryError(ValueError):
+    pass
+
+
+class Host:
+    __slots__ = ("name", "endpoint")
+
+    def __init__(self, name, endpoint=None):
+        self.name = name
+        self.endpoint = endpoint or name
+
+
+def read_inventory(path):
+    """
+    Parse an inventory file into a list of Hosts, in file order.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+    except OSError as e:
+        raise InventoryError(f"Cannot read inventory '{path}': {e}")
+    hosts = []
+    seen = set()
+    for number, line in enumerate(lines, 1):
+        fields = line.split("#", 1)[0].split()
+        if not fields:
+            continue
+        if len(fields) > 2:
+            raise InventoryError(f"{path}:{number}: expected 'name [endpoint]'")
+        if fields[0] in seen:
+            raise InventoryError(f"{path}:{number}: '{fields[0]}' is listed twice")
+        seen.add(fields[0])
+        hosts.append(Host(*fields))
+    if not hosts:
+        raise InventoryError(f"Inventory '{path}' lists no machines")
+    return hosts
+
+
+def host_result(host, ok, attempts, started, result=None, error=None):
+    entry = {"host": host.name, "endpoint": host.endpoint, "ok": ok, "attempts": attempts,
+             "ms": round((time.perf_counter() - started) * 1000.0, 1)}
+    if ok:
+        entry["result"] = result
+    else:
+        entry["error"] = error
+    return entry
+
+
+def call_host(host, command, args, timeout=5.0, retries=2):
+    """
+    Send one control command to `host`, retrying failures to connect up to
+    `retries` times. Nothing is retried after the request was written.
+    Returns a host_result() dict.
+    """
+    started = time.perf_counter()
+    attempts = 0
+    while True:
+        attempts += 1
+        with MonitorClient(host.endpoint, timeout=timeout) as client:
+            try:
+                client.connect()
+            except ControlError as e:
+                if attempts > retries:
+                    return host_result(host, False, attempts, started, error=str(e))
+                time.sleep(RETRY_BACKOFF * 2 ** (attempts - 1))
+                continue
+            try:
+                return host_result(host, True, attempts, started, result=client.receive(client.send(command, **args)))
+            except ControlReplyError as e:
+                return host_result(host, False, attempts, started, error=str(e))
+            except ControlError as e:
+                return host_result(host, False, attempts, started, error=f"{e} (not retried; the request may have "
+                                                                          f"been carried out)")
+
+
+def run_fleet(hosts, task, workers=DEFAULT_WORKERS):
+    """
+    Run task(host) for every host on at most `workers` threads, yielding the
+    results in the order they complete. A task that raises is reported as a
+    failed result for its host.
+    """
+    def guarded(host):
+        started = time.perf_counter()
+        try:
+            return task(host)
+        except Exception as e:
+            return host_result(host, False, 1, started, error=f"{type(e).__name__}: {e}")
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(hosts))), thread_name_prefix="fleet") as pool:
+        # Completion order, not map()'s submission order: the output keeps
+        # moving while a slow machine times out
+        for future in as_completed([pool.submit(guarded, host) for host in hosts]):
+            yield future.result()
+
+
+def describe(result):
+    """
+    One line for the table's detail column.
+    """
+    if not result["ok"]:
+        return result["error"]
+    value = result["result"]
+    if isinstance(value, dict):
+        return " ".join(f"{key}={value[key]}" for key in SUMMARY_KEYS if key in value)
+    return str(value)
+
+
+def report(results, output_format="table", width=24, out=sys.stdout):
+    """
+    Write `results` to `out` as they arrive, then a summary. `width` is the
+    table's host column width. Returns the summary dict.
+    """
+    started = time.perf_counter()
+    summary = {"hosts": 0, "ok": 0, "failed": 0, "retried": 0}
+    if output_format != "json":
+        out.write(f"{'HOST':<{width}} {'RESULT':<6} {'TRIES':>5} {'MS':>8}  DETAIL\n")
+    for result in results:
+        summary["hosts"] += 1
+        summary["ok" if result["ok"] else "failed"] += 1
+        summary["retried"] += result["attempts"] > 1
+        if output_format == "json":
+            out.write(json.dumps(result) + "\n")
+        else:
+            out.write(f"{result['host']:<{width}} {'ok' if result['ok'] else 'FAIL':<6} "
+                      f"{result['attempts']:>5} {result['ms']:>8.1f}  {describe(result)}\n")
+        out.flush()
+    summary["elapsed_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+    if output_format == "json":
+        out.write(json.dumps({"summary": summary}) + "\n")
+    else:
+        out.write(f"{summary['ok']}/{summary['hosts']} ok, {summary['failed']} failed, "
+                  f"{summary['retried']} retried, {summary['elapsed_ms'] / 1000.0:.2f} s\n")
+    out.flush()
+    return summary
@@ -0,0 +1,800 @@
+import sys
+import os
+import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5 import QtWidgets, QtCore, QtGui, QtNetwork # type: ignore
+from pipeline import LatencyProbe
+import metrics
+from supervisor import supervisor_stats
+from devices import format_identity
+from policy import PolicyError
+from control import DEFAULT_ENDPOINT, ControlError, FrameDecoder, dispatch_request, encode_frame, endpoint_address
+
+# =============================================================================
+# USB Blocker GUI
+# Everything that needs PyQt5 lives here. monitor.py only imports this module
+# when a GUI is actually needed, so the stop/status commands and the headless
+# mode never load Qt.
+# =============================================================================
+
+def resource_path(relative_path):
+    try:
+        # PyInstaller creates a temp folder and stores path in _MEIPASS
+        base_path = sys._MEIPASS
+    except Exception:
+        base_path = os.path.abspath(".")
+    return os.path.join(base_path, relative_path)
+
+
+# =============================================================================
+# Section 1: Splash Screen
+# This widget displays a full-screen splash with a 10-second countdown before
+# the main application starts.
+# =============================================================================
+class SplashScreen(QtWidgets.QWidget):
+    def __init__(self, countdown=30):
+        super().__init__()
+        self.countdown = countdown
+        self.total_time = countdown
+        self.initUI()
+
+    def initUI(self):
+        # Frameless and always on top
+        self.setWindowFlags(QtCore.Qt.FramelessWindowHint | QtCore.Qt.WindowStaysOnTopHint)
+
+        # Get screen dimensions and center the splash screen
+        screen = QtWidgets.QApplication.primaryScreen().geometry()
+        width, height = 800, 400  # Increased size for better visibility
+        self.setGeometry(
+            (screen.width() - width) // 2,
+            (screen.height() - height) // 2,
+            width,
+            height
+        )
+
+        # Logo on the left
+        self.logo = QtWidgets.QLabel(self)
+        logo_path = resource_path('tut_logo.png')  # Ensure the file exists in the working directory
+        if os.path.exists(logo_path):
+            pixmap = QtGui.QPixmap(logo_path)
+            self.logo.setPixmap(pixmap.scaled(200, 200, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation))
+            self.logo.setGeometry(50, 100, 200, 200)  # Adjusted position and size for the larger splash
+        else:
+            print(f"Logo file '{logo_path}' not found. Please ensure it exists in the working directory.")
+
+        # Label for countdown text
+        self.label = QtWidgets.QLabel(self)
+        self.label.setAlignment(QtCore.Qt.AlignCenter)
+        self.label.setStyleSheet("font-size: 32px;")
+        self.label.setGeometry(280, 100, 450, 150)  # Adjusted to leave space for the larger logo
+        self.label.setText(f"USB Blocker \nStarting in {self.countdown} seconds...")
+
+        # Progress bar
+        self.progress_bar = QtWidgets.QProgressBar(self)
+        self.progress_bar.setGeometry(280, 280, 450, 30)  # Adjusted to align with the larger label
+        self.progress_bar.setMaximum(self.total_time)
+        self.progress_bar.setValue(self.total_time - self.countdown)
+
+        # Timer to update the countdown every second
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.updateCountdown)
+        self.timer.start(1000)
+
+    def updateCountdown(self):
+        self.countdown -= 1
+        self.progress_bar.setValue(self.total_time - self.countdown)
+        if self.countdown <= 0:
+            self.timer.stop()
+            self.close()  # Close splash when countdown ends
+        else:
+            self.label.setText(f"USB Blocker \nStarting in {self.countdown} seconds...")
+
+
+# =============================================================================
+# Section 2: Lock Screen (Modal Overlay)
+# Full-screen windows that lock the UI when a USB is inserted: one
+# LockOverlay per display, each showing an input field for the override code.
+# The windows are borderless, always on top, and (as far as possible) hidden
+# from Alt+Tab and normal close events.
+# LockScreen keeps the overlays in a pool that follows screens being plugged
+# in and out. They are built once and then only shown and hidden, so an
+# insertion costs a show() per screen instead of constructing and styling
+# windows.
+# =============================================================================
+class LockOverlay(QtWidgets.QWidget):
+    """
+    The lock window for one screen. Code entry and closing are handled by
+    the owning LockScreen.
+    """
+
+    def __init__(self, lock_screen, screen):
+        super().__init__()
+        self.lock_screen = lock_screen
+        self.target_screen = screen
+        self.initUI()
+
+    def initUI(self):
+        # Create a full-screen, borderless window
+        self.setWindowFlags(QtCore.Qt.FramelessWindowHint | QtCore.Qt.WindowStaysOnTopHint | QtCore.Qt.Tool)
+        self.setStyleSheet("background-color: black;")
+        # Display a message
+        self.label = QtWidgets.QLabel(self)
+        self.label.setText(LockScreen.MESSAGE)
+        self.label.setStyleSheet("font-size: 24px; color: white;")
+        self.label.setAlignment(QtCore.Qt.AlignCenter)
+        # Input field for the override code
+        self.input_field = QtWidgets.QLineEdit(self)
+        self.input_field.setEchoMode(QtWidgets.QLineEdit.Password)
+        self.input_field.setAlignment(QtCore.Qt.AlignCenter)
+        self.input_field.setStyleSheet("font-size: 20px;")
+        self.input_field.returnPressed.connect(lambda: self.lock_screen.checkOverrideCode(self))
+        # Polish and lay out now, while nothing is waiting on the screen
+        self.ensurePolished()
+        self.label.ensurePolished()
+        self.input_field.ensurePolished()
+        # Create the native window too, so the first lock is as fast as the rest
+        self.winId()
+        self.place()
+        self.target_screen.geometryChanged.connect(self.place)
+
+    def place(self, *args):
+        # Pin the window to its screen, so showFullScreen() covers that display
+        self.windowHandle().setScreen(self.target_screen)
+        self.setGeometry(self.target_screen.geometry())
+
+    def resizeEvent(self, event):
+        self.label.setGeometry(0, 200, self.width(), 100)
+        self.input_field.setGeometry(self.width() // 2 - 100, 350, 200, 40)
+        super().resizeEvent(event)
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        self.lock_screen.exposed(self)
+
+    def keyPressEvent(self, event):
+        # Override to ignore key events for Alt+Tab or Alt+F4, etc.
+        if event.key() in (QtCore.Qt.Key_Alt, QtCore.Qt.Key_Tab):
+            pass
+        else:
+            super().keyPressEvent(event)
+
+    def closeEvent(self, event):
+        # Overlays are only ever hidden (by LockScreen.unlock()); closing would
+        # destroy the pre-built window
+        event.ignore()
+
+
+class LockScreen(QtCore.QObject):
+    MESSAGE = "USB inserted. System is locked.\nEnter override code to unlock:"
+    # Emitted after the screens have been unlocked and hidden
+    unlockedSignal = QtCore.pyqtSignal()
+    # Emitted from the verifier's worker thread with (ok, retry_after)
+    codeChecked = QtCore.pyqtSignal(bool, float)
+
+    def __init__(self, verifier, latency_probe=None, audit=None, parent=None):
+        super().__init__(parent)
+        self.verifier = verifier
+        self.latency_probe = latency_probe
+        self.audit = audit
+        self.locked = False
+        self.overlays = {}  # QScreen -> LockOverlay
+        # Monotonic time of the event being shown, and the overlays that have
+        # not painted since, for the latency probe
+        self.pending_since = None
+        self.unexposed = set()
+        self.checking = False
+        self.codeChecked.connect(self.code_checked, QtCore.Qt.QueuedConnection)
+        # Re-enables code entry when a backoff period is over
+        self.retry_timer = QtCore.QTimer(self)
+        self.retry_timer.setSingleShot(True)
+        self.retry_timer.timeout.connect(lambda: self.set_input_enabled(True))
+        app = QtWidgets.QApplication.instance()
+        for screen in app.screens():
+            self.add_screen(screen)
+        app.screenAdded.connect(self.add_screen)
+        app.screenRemoved.connect(self.remove_screen)
+
+    def add_screen(self, screen):
+        if screen in self.overlays:
+            return
+        overlay = LockOverlay(self, screen)
+        self.overlays[screen] = overlay
+        # A display plugged in while locked is covered straight away
+        if self.locked:
+            overlay.showFullScreen()
+
+    def remove_screen(self, screen):
+        overlay = self.overlays.pop(screen, None)
+        if overlay is None:
+            return
+        self.unexposed.discard(overlay)
+        overlay.hide()
+        overlay.deleteLater()
+
+    def lock(self, received_at=None):
+        """
+        Cover every screen. `received_at` is the monotonic time the triggering
+        device event was received, for the latency probe.
+        """
+        # Reset whatever the previous use left behind
+        self.locked = True
+        overlays = list(self.overlays.values())
+        for overlay in overlays:
+            overlay.input_field.clear()
+        self.set_input_enabled(not self.verifier.retry_after())
+        self.pending_since = received_at if received_at is not None else time.monotonic()
+        self.unexposed = set(overlays)
+        # Show them all in one go, so every display is covered in the same
+        # event-loop iteration
+        for overlay in overlays:
+            overlay.showFullScreen()
+        for overlay in overlays:
+            overlay.raise_()
+        primary = self.overlays.get(QtWidgets.QApplication.primaryScreen())
+        if primary:
+            primary.activateWindow()
+            primary.input_field.setFocus()
+
+    def exposed(self, overlay):
+        # The first paint of each overlay after lock() is when it is on screen;
+        # the lock is complete once the last screen is covered
+        if self.pending_since is None or overlay not in self.unexposed:
+            return
+        self.unexposed.discard(overlay)
+        if not self.unexposed:
+            now = time.monotonic()
+            metrics.LOCK_LATENCY.observe(now - self.pending_since)
+            if self.latency_probe:
+                self.latency_probe.record(self.pending_since, now)
+            self.pending_since = None
+
+    def set_input_enabled(self, enabled, message=None):
+        for overlay in self.overlays.values():
+            overlay.input_field.setEnabled(enabled)
+            overlay.label.setText(message or self.MESSAGE)
+        if enabled:
+            self.retry_timer.stop()
+
+    def checkOverrideCode(self, overlay):
+        # The code is hashed on the verifier's worker thread; input stays
+        # disabled until the answer comes back through codeChecked
+        if self.checking:
+            return
+        code = overlay.input_field.text()
+        overlay.input_field.clear()
+        self.checking = True
+        self.set_input_enabled(False, "Checking override code...")
+        self.verifier.submit(code, self.codeChecked.emit)
+
+    def code_checked(self, ok, retry_after):
+        self.checking = False
+        metrics.UNLOCK_ATTEMPTS["lock_screen", "success" if ok else "failure"].inc()
+        if not self.locked:
+            return  # unlocked over the control channel meanwhile
+        if ok:
+            # Correct code: unlock the screens
+            if self.audit:
+                self.audit.record("unlock_success", source="lock_screen")
+            self.unlock()
+            return
+        if self.audit:
+            self.audit.record("unlock_failure", source="lock_screen", retry_after=round(retry_after, 1))
+        if retry_after > 0:
+            # Too many wrong codes: refuse input until the backoff is over
+            self.set_input_enabled(False, f"Too many incorrect codes.\nTry again in {math.ceil(retry_after)} seconds.")
+            self.retry_timer.start(int(retry_after * 1000) + 1)
+        else:
+            self.set_input_enabled(True, "Incorrect override code.\nEnter override code to unlock:")
+
+    def unlock(self):
+        # Called for a correct code, or over the control channel (the code was checked there)
+        self.locked = False
+        self.pending_since = None
+        self.unexposed = set()
+        for overlay in self.overlays.values():
+            overlay.input_field.clear()
+            overlay.hide()
+        self.unlockedSignal.emit()
+
+
+# =============================================================================
+# Section 3: Confirmation Screen
+# When the app is stopped (via command line or tray), this screen displays a
+# confirmation message and auto-closes after a few seconds.
+# =============================================================================
+class ConfirmationScreen(QtWidgets.QWidget):
+    def __init__(self, message="Application stopped."):
+        super().__init__()
+        self.message = message
+        self.initUI()
+
+    def initUI(self):
+        # Frameless and on top
+        self.setWindowFlags(QtCore.Qt.FramelessWindowHint | QtCore.Qt.WindowStaysOnTopHint)
+        self.setGeometry(400, 400, 300, 100)
+        label = QtWidgets.QLabel(self.message, self)
+        label.setAlignment(QtCore.Qt.AlignCenter)
+        label.setStyleSheet("font-size: 18px;")
+        label.setGeometry(0, 0, 300, 100)
+        # Auto-close after 3 seconds
+        QtCore.QTimer.singleShot(3000, self.close)
+
+
+# =============================================================================
+# Section 4: System Tray Icon
+# This class creates a system tray icon with a context menu. The menu includes a
+# "Stop" option which shuts the app down through its stop callback.
+# =============================================================================
+class SystemTrayIcon(QtWidgets.QSystemTrayIcon):
+    def __init__(self, icon, parent=None, stop_callback=None):
+        super(SystemTrayIcon, self).__init__(icon, parent)
+        self.stop_callback = stop_callback
+        menu = QtWidgets.QMenu(parent)
+        stop_action = menu.addAction("Stop")
+        stop_action.triggered.connect(self.stop_app)
+        exit_action = menu.addAction("Exit")
+        exit_action.triggered.connect(QtWidgets.qApp.quit)
+        self.setContextMenu(menu)
+
+    def stop_app(self):
+        if self.stop_callback:
+            self.stop_callback()
+
+
+# =============================================================================
+# Section 5: Monitor-to-GUI Bridge
+# Lock decisions from the USBMonitor thread arrive through an EventChannel.
+# =============================================================================
+class LockEventBridge(QtCore.QObject):
+    """
+    Delivers events posted to an EventChannel from the monitor thread to a
+    handler on the GUI thread. The bridge lives on the GUI thread, so emitting
+    eventsPending from the monitor thread is a queued (thread-safe) call.
+    The channel may already be in use (fast start arms the monitor before the
+    GUI exists); anything queued before the bridge attached is delivered too.
+    """
+    eventsPending = QtCore.pyqtSignal()
+
+    def __init__(self, handler, channel, parent=None):
+        super().__init__(parent)
+        self.handler = handler
+        self.channel = channel
+        self.eventsPending.connect(self.deliver, QtCore.Qt.QueuedConnection)
+        channel.notify = self.eventsPending.emit
+        # Events posted before notify was set did not signal anyone
+        self.eventsPending.emit()
+
+    def deliver(self):
+        for event in self.channel.drain():
+            self.handler(event)
+
+
+# =============================================================================
+# Section 6: Control Channel Server
+# Serves the local control endpoint (named pipe on Windows, Unix domain socket
+# elsewhere) from the Qt event loop; see control.py for the protocol and the
+# client side. Most requests are answered straight away. Commands listed in
+# `offload` (those that check the override code, which takes a deliberately
+# slow hash) run on a worker thread so the lock screen stays responsive;
+# replies still go out in request order.
+# =============================================================================
+class ControlServer(QtCore.QObject):
+    # Emitted from the worker thread when an offloaded request has its reply
+    replyReady = QtCore.pyqtSignal(object)
+
+    def __init__(self, handlers, endpoint=DEFAULT_ENDPOINT, offload=(), parent=None):
+        super().__init__(parent)
+        self.handlers = handlers  # command -> callable(args dict) returning a JSON-serialisable result
+        self.endpoint = endpoint
+        self.offload = set(offload)
+        self.executor = None
+        self.decoders = {}  # connection -> FrameDecoder
+        self.pending = {}  # connection -> deque of reply slots, oldest first
+        self.server = QtNetwork.QLocalServer(self)
+        # Only the user running the blocker may connect
+        self.server.setSocketOptions(QtNetwork.QLocalServer.UserAccessOption)
+        self.server.newConnection.connect(self.accept_connections)
+        self.replyReady.connect(self.flush, QtCore.Qt.QueuedConnection)
+
+    def listen(self):
+        address = endpoint_address(self.endpoint)
+        # A previous instance that crashed may have left its socket file behind;
+        # the single-instance lock guarantees nobody else is serving it
+        QtNetwork.QLocalServer.removeServer(address)
+        if not self.server.listen(address):
+            print(f"Control channel unavailable at {address}: {self.server.errorString()}")
+            return False
+        return True
+
+    def close(self):
+        self.server.close()
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+    def accept_connections(self):
+        while self.server.hasPendingConnections():
+            connection = self.server.nextPendingConnection()
+            self.decoders[connection] = FrameDecoder()
+            self.pending[connection] = deque()
+            connection.readyRead.connect(lambda c=connection: self.serve(c))
+            connection.disconnected.connect(lambda c=connection: self.drop(c))
+
+    def drop(self, connection):
+        self.decoders.pop(connection, None)
+        self.pending.pop(connection, None)
+        connection.deleteLater()
+
+    def serve(self, connection):
+        decoder = self.decoders.get(connection)
+        if decoder is None:
+            return
+        try:
+            requests = decoder.feed(bytes(connection.readAll()))
+        except ControlError as e:
+            print(f"Control channel: dropping client: {e}")
+            connection.abort()
+            return
+        pending = self.pending[connection]
+        for request in requests:
+            # A slot is [reply frame or None while the worker is busy]
+            slot = [None]
+            pending.append(slot)
+            if isinstance(request, dict) and request.get("cmd") in self.offload:
+                self.dispatch_offloaded(connection, slot, request)
+            else:
+                slot[0] = encode_frame(dispatch_request(self.handlers, request))
+        self.flush(connection)
+
+    def dispatch_offloaded(self, connection, slot, request):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="control")
+
+        def run():
+            slot[0] = encode_frame(dispatch_request(self.handlers, request))
+            self.replyReady.emit(connection)
+        self.executor.submit(run)
+
+    def flush(self, connection):
+        # Pipelined requests are answered in order, with one write per batch
+        pending = self.pending.get(connection)
+        if pending is None:
+            return  # client went away
+        replies = []
+        while pending and pending[0][0] is not None:
+            replies.append(pending.popleft()[0])
+        if replies:
+            connection.write(b"".join(replies))
+            connection.flush()
+
+
+# =============================================================================
+# Section 7: Main Application Class
+# This class sets up the main functionalities: splash screen, system tray, USB
+# monitoring, and timed execution if specified. The USBMonitor thread is built
+# by monitor.main() and may already be running (fast start).
+# =============================================================================
+class USBBlockerApp(QtWidgets.QApplication):
+    # Control handlers that check the override code run on a worker thread
+    # and hand their effects to the GUI thread through these signals
+    stopRequested = QtCore.pyqtSignal(str)
+    unlockRequested = QtCore.pyqtSignal()
+    pushApplied = QtCore.pyqtSignal()
+
+    def __init__(self, args, verifier, custom_name, usb_monitor, lock_channel, run_time=None,
+                 policy_manager=None, endpoint=DEFAULT_ENDPOINT, on_ready=None, audit=None, lock_state=None,
+                 scheduler=None):
+        super().__init__(args)
+        self.verifier = verifier
+        self.custom_name = custom_name
+        self.run_time = run_time
+        self.usb_monitor = usb_monitor
+        self.policy_manager = policy_manager
+        self.endpoint = endpoint
+        self.on_ready = on_ready
+        self.audit = audit
+        self.lock_state = lock_state
+        self.scheduler = scheduler
+        self.lock_enabled = True
+        self.policy_lock_enabled = True
+        self.control_server = None
+        self.tray_icon = None
+        self.splash = None
+        self.lock_screen = None
+        self.lock_screen_displayed = False
+        self.locked_since = None
+        self.lock_latency = LatencyProbe()
+        # Lock decisions from the monitor thread are handled here, on the GUI thread
+        self.lock_bridge = LockEventBridge(self.show_lock_screen, lock_channel, parent=self)
+        self.stopRequested.connect(self.stop_app, QtCore.Qt.QueuedConnection)
+        self.unlockRequested.connect(self.unlock_screen, QtCore.Qt.QueuedConnection)
+        # Blocks the worker until the GUI thread has the pushed policy in force
+        self.pushApplied.connect(self.reload_policy, QtCore.Qt.BlockingQueuedConnection)
+
+        # Set the application name (affects window titles and metadata)
+        self.setApplicationName(self.custom_name)
+
+    def launch(self, splash_seconds=10):
+        """
+        Start the app, after a splash screen countdown unless `splash_seconds`
+        is 0. The caller then runs the event loop with exec_().
+        """
+        if not splash_seconds:
+            self.start_app()
+            return
+        # Show the splash screen with a countdown
+        self.splash = SplashScreen(countdown=splash_seconds)
+        self.splash.show()
+        # After splash, start the main app functionalities
+        QtCore.QTimer.singleShot(splash_seconds * 1000, self.start_app)
+
+    def start_app(self):
+        if self.splash:
+            self.splash.close()
+        # Build the lock screen up front; insertions only show it
+        self.build_lock_screen()
+        if self.lock_state and self.lock_state.locked and not self.lock_screen_displayed:
+            self.restore_lock()
+        # Check if the icon file exists and display a message on the console
+        icon_path = resource_path('usb_blocker_icon.png')
+        if not os.path.exists(icon_path):
+            print(f"Icon file '{icon_path}' not found. Please ensure it exists in the working directory.")
+        else:
+            print(f"Icon file '{icon_path}' found.")
+            # Create and show the system tray icon
+            icon = QtGui.QIcon(icon_path)
+            self.tray_icon = SystemTrayIcon(icon, stop_callback=self.stop_app)
+            self.tray_icon.show()
+
+        # Start the USB monitor thread to listen for USB insertion events (fast start
+        # has already armed it)
+        if self.usb_monitor.ident is None:
+            self.usb_monitor.start()
+
+        # If a run time is specified, schedule the app to stop after that duration
+        print(f"Application will run for {self.run_time} seconds." if self.run_time else "No runtime specified.")
+
+        # Schedule the app to stop after the specified run time
+        if self.run_time:
+            QtCore.QTimer.singleShot(self.run_time * 1000, lambda: self.stop_app("run_time"))
+        else:
+            print("No runtime specified. Running indefinitely...")
+
+        # Apply the policy file and reload it whenever it changes; enforcement
+        # windows switch on a single timer for the next transition
+        if self.scheduler:
+            self.schedule_timer = QtCore.QTimer(self)
+            self.schedule_timer.setSingleShot(True)
+            self.schedule_timer.timeout.connect(self.schedule_due)
+        if self.policy_manager:
+            self.apply_policy()
+            self.watch_policy()
+
+        # Accept stop/status/reload/unlock commands on the local control channel
+        self.control_server = ControlServer({
+            "status": self.control_status,
+            "stop": self.control_stop,
+            "reload": self.control_reload,
+            "push": self.control_push,
+            "unlock": self.control_unlock,
+            "metrics": metrics.control_metrics,
+        }, endpoint=self.endpoint, offload=("stop", "unlock", "push"), parent=self)
+        self.control_server.listen()
+
+        # Everything is armed: tell the launcher (client.start_blocker) we are ready
+        if self.on_ready:
+            self.on_ready()
+
+    def watch_policy(self):
+        path = os.path.abspath(self.policy_manager.path)
+        self.policy_watcher = QtCore.QFileSystemWatcher(self)
+        # Watch the directory as well: editors often save by replacing the file,
+        # which removes it from the watch list
+        self.policy_watcher.addPath(path)
+        self.policy_watcher.addPath(os.path.dirname(path))
+        self.policy_watcher.fileChanged.connect(self.schedule_policy_reload)
+        self.policy_watcher.directoryChanged.connect(self.schedule_policy_reload)
+        # Saves usually arrive as several notifications; reload once they settle
+        self.policy_reload_timer = QtCore.QTimer(self)
+        self.policy_reload_timer.setSingleShot(True)
+        self.policy_reload_timer.setInterval(100)
+        self.policy_reload_timer.timeout.connect(self.reload_policy)
+
+    def schedule_policy_reload(self, path=None):
+        self.policy_reload_timer.start()
+
+    def reload_policy(self):
+        path = os.path.abspath(self.policy_manager.path)
+        if path not in self.policy_watcher.files() and os.path.exists(path):
+            self.policy_watcher.addPath(path)
+        if self.policy_manager.changed() and self.policy_manager.reload():
+            self.apply_policy()
+
+    def apply_policy(self):
+        policy = self.policy_manager.policy
+        # Plain attribute swaps: the monitor thread sees either the old or the
+        # new allow-list, never a partially built one
+        self.usb_monitor.allow_list = self.policy_manager.allow_list
+        self.usb_monitor.coalescer.window = policy["coalesce_ms"] / 1000.0
+        if self.usb_monitor.storage_guard:
+            self.usb_monitor.storage_guard.apply_mode(policy["block_mode"])
+        self.policy_lock_enabled = policy["lock_enabled"]
+        if self.scheduler:
+            self.scheduler.load(policy["schedule"])
+            self.arm_schedule()
+        self.apply_schedule()
+
+    def arm_schedule(self):
+        delay = self.scheduler.sleep_time()
+        if delay is None:
+            self.schedule_timer.stop()
+        else:
+            self.schedule_timer.start(int(delay * 1000))
+
+    def schedule_due(self):
+        if self.scheduler.advance():
+            self.apply_schedule()
+        self.arm_schedule()
+
+    def apply_schedule(self):
+        enforcing = self.scheduler.enforcing() if self.scheduler else True
+        lock_enabled = self.policy_lock_enabled and enforcing
+        if lock_enabled != self.lock_enabled and self.scheduler:
+            state = self.scheduler.state()
+            self.audit_record("schedule", state=state)
+            print(f"Schedule: {state} from now on.")
+        self.lock_enabled = lock_enabled
+
+    def audit_record(self, event, **fields):
+        if self.audit:
+            self.audit.record(event, **fields)
+
+    def check_code(self, code, denied_event):
+        # Runs on the control server's worker thread (see ControlServer.offload)
+        ok, retry_after = self.verifier.verify(code)
+        metrics.UNLOCK_ATTEMPTS["control", "success" if ok else "failure"].inc()
+        if not ok:
+            self.audit_record(denied_event, source="control", retry_after=round(retry_after, 1))
+            if retry_after > 0:
+                raise ControlError(f"invalid override code; try again in {math.ceil(retry_after)} seconds")
+            raise ControlError("invalid override code")
+
+    def control_status(self, args):
+        status = {
+            "pid": os.getpid(),
+            "backend": self.usb_monitor.event_source.name,
+            "locked": self.lock_screen_displayed,
+            "lock_enabled": self.lock_enabled,
+            "monitoring": self.usb_monitor.is_alive(),
+            "devices_allowed": self.usb_monitor.allowed,
+        }
+        status.update(self.usb_monitor.coalescer.stats())
+        status.update(self.lock_bridge.channel.stats())
+        status.update(self.lock_latency.stats())
+        if self.usb_monitor.snapshot:
+            status.update(self.usb_monitor.snapshot.stats())
+        if self.usb_monitor.storage_guard:
+            status.update(self.usb_monitor.storage_guard.stats())
+        if self.scheduler:
+            status.update(self.scheduler.stats())
+        status.update(supervisor_stats())
+        if self.lock_screen:
+            status["lock_screens"] = len(self.lock_screen.overlays)
+        if self.policy_manager:
+            status.update(self.policy_manager.stats())
+        if self.audit:
+            status.update(self.audit.stats())
+        status.update(self.verifier.stats())
+        return status
+
+    def control_stop(self, args):
+        self.check_code(args.get("code"), "stop_denied")
+        # Reply first, then stop from the event loop
+        self.stopRequested.emit("control")
+        return "stopping"
+
+    def control_reload(self, args):
+        if not self.policy_manager:
+            raise ControlError("no policy file configured")
+        if not self.policy_manager.reload():
+            raise ControlError("policy reload failed")
+        self.apply_policy()
+        return self.policy_manager.stats()
+
+    def control_push(self, args):
+        self.check_code(args.get("code"), "push_denied")
+        if not self.policy_manager:
+            raise ControlError("no policy file configured")
+        try:
+            self.policy_manager.write(args.get("policy"))
+        except PolicyError as e:
+            raise ControlError(str(e))
+        self.audit_record("policy_pushed", source="control")
+        self.pushApplied.emit()
+        return self.policy_manager.stats()
+
+    def control_unlock(self, args):
+        self.check_code(args.get("code"), "unlock_failure")
+        if self.lock_screen_displayed:
+            self.audit_record("unlock_success", source="control")
+            self.unlockRequested.emit()
+            return "unlocked"
+        return "not locked"
+
+    def unlock_screen(self):
+        if self.lock_screen_displayed:
+            self.lock_screen.unlock()
+
+    def build_lock_screen(self):
+        if self.lock_screen is None:
+            self.lock_screen = LockScreen(self.verifier, latency_probe=self.lock_latency, audit=self.audit,
+                                          parent=self)
+            # When the lock screen is unlocked, reset the flag so it can be shown again
+            self.lock_screen.unlockedSignal.connect(self.lock_screen_closed)
+
+    def lock_screen_closed(self):
+        self.lock_screen_displayed = False
+        metrics.LOCKED.set(0)
+        metrics.LOCK_DURATION.observe(time.monotonic() - self.locked_since)
+        if self.lock_state:
+            self.lock_state.save(locked=False)
+        if self.usb_monitor.snapshot:
+            self.usb_monitor.snapshot.approve()
+
+    def show_lock_screen(self, event=None):
+        # Always runs on the GUI thread (see LockEventBridge), so the flag needs no lock
+        if not self.lock_enabled:
+            print("Lock screen disabled by policy; device insertion ignored.")
+            return
+        if not self.lock_screen_displayed:
+            self.lock_screen_displayed = True
+            self.locked_since = time.monotonic()
+            metrics.LOCKS.inc()
+            metrics.LOCKED.set(1)
+            if self.lock_state:
+                self.lock_state.save(locked=True)
+            if event:
+                self.audit_record("lock_shown", device_id=event.device_id, device=format_identity(event.identity))
+            # Only built here if an event arrives before start_app (fast start)
+            self.build_lock_screen()
+            self.lock_screen.lock(event.timestamp if event else None)
+
+    def restore_lock(self):
+        # The previous monitor process was locked when it ended (see supervisor.py)
+        self.audit_record("lock_restored")
+        self.lock_screen_displayed = True
+        self.locked_since = time.monotonic()
+        metrics.LOCKED.set(1)
+        self.lock_screen.lock()
+
+    def stop_app(self, reason="tray"):
+        self.audit_record("stop", reason=reason)
+        metrics.count_stop(reason)
+        if self.lock_state:
+            self.lock_state.stopped_by(reason)
+        # Stop serving control commands
+        if self.control_server:
+            self.control_server.close()
+        # Stop the USB monitor thread
+        if self.usb_monitor.is_alive():
+            self.usb_monitor.stop()
+            print(f"Device event counters: {self.usb_monitor.coalescer.stats()} {self.lock_bridge.channel.stats()}")
+        # Show a confirmation screen
+        self.confirmation = ConfirmationScreen("Application is stopping...")
+        self.confirmation.show()
+        # Exit the application after a short delay (3 seconds); monitor.main() then
+        # removes auto-start persistence and releases the instance lock
+        QtCore.QTimer.singleShot(3000, self.quit)
+
+
+def show_alert(text):
+    """
+    Modal information box shown before the app starts (normal start only).
+    """
+    alert = QtWidgets.QMessageBox()
+    alert.setText(text)
+    alert.setWindowTitle("USB Blocker")
+    alert.setIcon(QtWidgets.QMessageBox.Information)
+    alert.setStandardButtons(QtWidgets.QMessageBox.Ok)
+    alert.exec_()
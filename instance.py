@@ -0,0 +1,241 @@
+import os
+import json
+import stat
+import time
+import tempfile
+
+# =============================================================================
+# Instance Registry
+# One monitor (and one supervisor) per user session. The process that owns a
+# name holds an OS lock on it for as long as it runs, and publishes a record
+# of itself next to the lock:
+#
+#   <runtime dir>/usb_blocker.json
+#   {"pid": 4242, "started": 1760000000.1, "endpoint": "usb_blocker",
+#    "version": "1.1.0", "kind": "monitor", ...}
+#
+# The lock is an flock() on <runtime dir>/<name>.lock on POSIX and a named
+# mutex (Local\<name>) on Windows; both are dropped by the OS when the owner
+# dies, so a crashed monitor never blocks the next one.
+#
+# On POSIX the runtime dir is private to the user (mode 0700):
+# $TEMP/usb_blocker-<uid> when TEMP is set (tests and fleet instances use
+# their own TEMP), otherwise $XDG_RUNTIME_DIR/usb_blocker, otherwise
+# usb_blocker-<uid> in the system temp dir. Records and locks that are not
+# owned by the user, or are writable by others, are ignored: another local
+# user must not be able to point the tools (and override codes) at their
+# own endpoint, or hold the lock so the monitor cannot start. On Windows,
+# TEMP is already per user. find_instance() reads the
+# record and checks that its PID is alive (one file read and one system call,
+# no process scan), which is how the client, the supervisor and the
+# command-line tools find the running monitor's control endpoint.
+# =============================================================================
+MONITOR_NAME = "usb_blocker"
+SUPERVISOR_NAME = "usb_blocker_supervisor"
+
+# Windows API constants
+ERROR_ALREADY_EXISTS = 183
+ERROR_ACCESS_DENIED = 5
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+STILL_ACTIVE = 259
+
+
+# Open flag that refuses symlinks (0 where the OS has none)
+O_NOFOLLOW = getattr(os, "O_NOFOLLOW", 0)
+
+
+def private_dir(path):
+    """
+    Create `path` (mode 0700) if needed and check that it is a directory
+    only this user can use. Raises OSError otherwise.
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise OSError(f"Runtime directory '{path}' is not a directory owned by this user")
+    if st.st_mode & 0o077:
+        os.chmod(path, 0o700)
+    return path
+
+
+def registry_dir():
+    if os.name == "nt":
+        return os.environ.get("TEMP") or tempfile.gettempdir()
+    name = f"usb_blocker-{os.getuid()}"
+    if os.environ.get("TEMP"):
+        return private_dir(os.path.join(os.environ["TEMP"], name))
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return private_dir(os.path.join(os.environ["XDG_RUNTIME_DIR"], "usb_blocker"))
+    return private_dir(os.path.join(tempfile.gettempdir(), name))
+
+
+def trusted(fd):
+    """
+    Whether the open file `fd` is a regular file owned by this user that
+    nobody else can write (always True on Windows).
+    """
+    if os.name == "nt":
+        return True
+    st = os.fstat(fd)
+    return stat.S_ISREG(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+def record_path(name):
+    return os.path.join(registry_dir(), name + ".json")
+
+
+def _kernel32():
+    import ctypes
+    from ctypes import wintypes
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.CreateMutexW.restype = wintypes.HANDLE
+    kernel32.CreateMutexW.argtypes = (wintypes.LPVOID, wintypes.BOOL, wintypes.LPCWSTR)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+    kernel32.GetExitCodeProcess.argtypes = (wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD))
+    kernel32.ReleaseMutex.argtypes = (wintypes.HANDLE,)
+    kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+    return kernel32
+
+
+class InstanceLock:
+    """
+    Ownership of an instance name, from acquire_instance(). Release it (or
+    exit) to let another instance start.
+    """
+
+    def __init__(self, name, handle):
+        self.name = name
+        self.handle = handle
+        self.record = None
+
+    def publish(self, **details):
+        """
+        Write the record other processes find this instance by.
+        """
+        self.record = dict(details, pid=os.getpid(), started=round(time.time(), 3))
+        path = self.name
+        try:
+            path = record_path(self.name)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            # 0600 whatever the umask, or readers would not trust it
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_NOFOLLOW, 0o600)
+            with open(fd, "w", encoding="utf-8") as f:
+                json.dump(self.record, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Cannot write instance record '{path}': {e}")
+
+    def release(self):
+        if self.record is not None:
+            # Only ever remove our own record
+            current = read_record(self.name)
+            if current and current.get("pid") == os.getpid():
+                try:
+                    os.remove(record_path(self.name))
+                except OSError:
+                    pass
+            self.record = None
+        try:
+            if os.name == "nt":
+                kernel32 = _kernel32()
+                kernel32.ReleaseMutex(self.handle)
+                kernel32.CloseHandle(self.handle)
+            else:
+                import fcntl
+                fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+                self.handle.close()
+        except OSError as e:
+            print(f"Error releasing instance lock: {e}")
+
+
+def acquire_instance(name=MONITOR_NAME):
+    """
+    Take ownership of `name`. Returns an InstanceLock, or None if another
+    live process owns it.
+    """
+    if os.name == "nt":
+        import ctypes
+        kernel32 = _kernel32()
+        handle = kernel32.CreateMutexW(None, True, "Local\\" + name)
+        if not handle:
+            print(f"Cannot create instance mutex: error {ctypes.get_last_error()}")
+            return None
+        if ctypes.get_last_error() == ERROR_ALREADY_EXISTS:
+            kernel32.CloseHandle(handle)
+            return None
+        return InstanceLock(name, handle)
+    import fcntl
+    try:
+        path = os.path.join(registry_dir(), name + ".lock")
+        lock_file = open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | O_NOFOLLOW, 0o600), "a")
+    except OSError as e:
+        print(f"Cannot open instance lock file: {e}")
+        return None
+    if not trusted(lock_file.fileno()):
+        print(f"Instance lock file '{path}' is not owned by this user or is writable by others")
+        lock_file.close()
+        return None
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return InstanceLock(name, lock_file)
+
+
+def pid_alive(pid):
+    if os.name == "nt":
+        import ctypes
+        from ctypes import wintypes
+        kernel32 = _kernel32()
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return ctypes.get_last_error() == ERROR_ACCESS_DENIED
+        code = wintypes.DWORD()
+        try:
+            return bool(kernel32.GetExitCodeProcess(handle, ctypes.byref(code))) and code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # exists, owned by someone else
+    return True
+
+
+def read_record(name=MONITOR_NAME):
+    try:
+        with open(os.open(record_path(name), os.O_RDONLY | O_NOFOLLOW), "r", encoding="utf-8") as f:
+            if not trusted(f.fileno()):
+                print(f"Ignoring instance record '{record_path(name)}': not owned by this user or writable by others")
+                return None
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return record if isinstance(record, dict) and isinstance(record.get("pid"), int) else None
+
+
+def find_instance(name=MONITOR_NAME):
+    """
+    Record of the running instance of `name`, or None. A record left behind
+    by a process that died is ignored.
+    """
+    record = read_record(name)
+    if record is None or not pid_alive(record["pid"]):
+        return None
+    return record
+
+
+def find_endpoint(default, name=MONITOR_NAME):
+    """
+    Control endpoint of the running monitor, or `default` if none is
+    registered.
+    """
+    record = find_instance(name)
+    return record.get("endpoint", default) if record else default
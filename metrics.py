@@ -0,0 +1,277 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+
+# =============================================================================
+# Metrics
+# Counters, gauges and fixed-bucket histograms for the monitor, exported
+# through the control channel ("metrics" command) and as a Prometheus text
+# file for a local agent to scrape (--metrics_file).
+#
+# Updates take no locks: every thread writes to its own preallocated list of
+# cells (its shard), which only that thread ever modifies; readers add the
+# shards up. Recording a value is a thread-local lookup and an in-place add,
+# cheap enough for the USBMonitor thread and the Qt event loop.
+# =============================================================================
+class _Shards:
+    """
+    Per-thread lists of `size` numeric cells.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()  # only taken when a thread creates its shard
+
+    def mine(self):
+        try:
+            return self.local.cells
+        except AttributeError:
+            cells = [0] * self.size
+            with self.lock:
+                self.shards.append(cells)
+            self.local.cells = cells
+            return cells
+
+    def totals(self):
+        with self.lock:
+            shards = list(self.shards)
+        return [sum(cells[i] for cells in shards) for i in range(self.size)]
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.shards = _Shards(1)
+
+    def inc(self, amount=1):
+        self.shards.mine()[0] += amount
+
+    def value(self):
+        return self.shards.totals()[0]
+
+
+class Gauge:
+    """
+    A value set by one owner, or computed by `function` when exported.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels, function=None):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.function = function
+        self.current = 0
+
+    def set(self, value):
+        self.current = value
+
+    def value(self):
+        return self.function() if self.function else self.current
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels, bounds):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.bounds = tuple(bounds)
+        # One cell per bucket, one for +Inf, then the sum of observations
+        self.shards = _Shards(len(self.bounds) + 2)
+
+    def observe(self, value):
+        cells = self.shards.mine()
+        cells[bisect_left(self.bounds, value)] += 1
+        cells[-1] += value
+
+    def value(self):
+        """
+        Returns {"buckets": [(bound, cumulative count), ...], "count", "sum"}.
+        """
+        totals = self.shards.totals()
+        buckets = []
+        running = 0
+        for bound, count in zip(self.bounds + (float("inf"),), totals[:-1]):
+            running += count
+            buckets.append((bound, running))
+        return {"buckets": buckets, "count": running, "sum": totals[-1]}
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels.items()) + (list(extra.items()) if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def _add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, **labels):
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, function=None, **labels):
+        return self._add(Gauge(name, help_text, labels, function))
+
+    def histogram(self, name, help_text, bounds, **labels):
+        return self._add(Histogram(name, help_text, labels, bounds))
+
+    def snapshot(self):
+        """
+        All current values as a JSON-serialisable dict, keyed by the metric
+        name plus its labels.
+        """
+        result = {}
+        for metric in list(self.metrics):
+            key = metric.name + _format_labels(metric.labels)
+            value = metric.value()
+            if metric.kind == "histogram":
+                value = {
+                    "count": value["count"],
+                    "sum": round(value["sum"], 6),
+                    "buckets": {_format_bound(bound): count for bound, count in value["buckets"]},
+                }
+            result[key] = value
+        return result
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        described = set()
+        for metric in list(self.metrics):
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            value = metric.value()
+            if metric.kind == "histogram":
+                for bound, count in value["buckets"]:
+                    labels = _format_labels(metric.labels, {"le": _format_bound(bound)})
+                    lines.append(f"{metric.name}_bucket{labels} {count}")
+                labels = _format_labels(metric.labels)
+                lines.append(f"{metric.name}_sum{labels} {value['sum']}")
+                lines.append(f"{metric.name}_count{labels} {value['count']}")
+            else:
+                lines.append(f"{metric.name}{_format_labels(metric.labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """
+        Write render() to `path` atomically, so a scraper never reads a
+        half-written file.
+        """
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+
+class TextfileExporter(threading.Thread):
+    """
+    Rewrites the Prometheus text file every `interval` seconds until stopped.
+    """
+
+    def __init__(self, registry, path, interval=15.0):
+        super().__init__(name="metrics-exporter", daemon=True)
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self.registry.write_textfile(self.path)
+            except OSError as e:
+                print(f"Metrics: cannot write {self.path}: {e}")
+            if self.stopped.wait(self.interval):
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        # Final values, so the file reflects the shutdown state
+        try:
+            self.registry.write_textfile(self.path)
+        except OSError as e:
+            print(f"Metrics: cannot write {self.path}: {e}")
+
+
+# =============================================================================
+# Blocker metrics
+# Defined here in one place, so instrumented modules just import them.
+# =============================================================================
+REGISTRY = MetricsRegistry()
+
+# Device events as received from the backend, before any filtering
+DEVICE_EVENTS = {kind: REGISTRY.counter("usb_blocker_device_events_total",
+                                        "Device events received from the event source", kind=kind)
+                 for kind in ("add", "remove", "change", "docking", "other")}
+# What happened to each insertion
+DEVICE_DECISIONS = {decision: REGISTRY.counter("usb_blocker_device_decisions_total",
+                                               "Insertions by outcome", decision=decision)
+                    for decision in ("allowed", "lock", "coalesced", "storage_blocked", "deferred")}
+MONITOR_ERRORS = {stage: REGISTRY.counter("usb_blocker_monitor_errors_total",
+                                          "Exceptions caught in the USB monitor thread", stage=stage)
+                  for stage in ("event_source", "lock_callback")}
+LOCKS = REGISTRY.counter("usb_blocker_locks_total", "Times the lock screen was shown")
+LOCKED = REGISTRY.gauge("usb_blocker_locked", "1 while the machine is locked")
+LOCK_LATENCY = REGISTRY.histogram(
+    "usb_blocker_lock_latency_seconds", "Time from a device event being received to every screen being covered",
+    (0.001, 0.0025, 0.005, 0.01, 0.0167, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+LOCK_DURATION = REGISTRY.histogram(
+    "usb_blocker_lock_duration_seconds", "How long the machine stayed locked",
+    (1, 5, 15, 30, 60, 120, 300, 900, 1800, 3600, 14400))
+UNLOCK_ATTEMPTS = {(source, result): REGISTRY.counter("usb_blocker_unlock_attempts_total",
+                                                      "Override code checks", source=source, result=result)
+                   for source in ("lock_screen", "control") for result in ("success", "failure")}
+STORAGE_BLOCKS = {(action, result): REGISTRY.counter("usb_blocker_storage_blocks_total",
+                                                     "Mass storage block actions", action=action, result=result)
+                  for action in ("deauthorize", "unmount", "readonly", "mountvol")
+                  for result in ("success", "failure")}
+STORAGE_BLOCK_LATENCY = REGISTRY.histogram(
+    "usb_blocker_storage_block_latency_seconds",
+    "Time from a storage device event (or its volume being mounted) to the block taking effect",
+    (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+STOPS = {reason: REGISTRY.counter("usb_blocker_stops_total", "Shutdowns by trigger", reason=reason)
+         for reason in ("control", "tray", "run_time", "signal")}
+START_TIME = REGISTRY.gauge("usb_blocker_start_time_seconds", "Unix time the blocker started")
+START_TIME.set(round(time.time(), 3))
+
+
+def count_stop(reason):
+    counter = STOPS.get(reason)
+    if counter is not None:
+        counter.inc()
+
+
+def control_metrics(args):
+    """
+    Handler for the "metrics" control command: a JSON snapshot, or the
+    Prometheus text with {"format": "prometheus"}.
+    """
+    if args.get("format") == "prometheus":
+        return REGISTRY.render()
+    return REGISTRY.snapshot()
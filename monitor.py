@@ -1,23 +1,36 @@
 import sys
 import os
+import math
 import time
+import json
+import signal
+import socket
 import argparse
 import threading
-import msvcrt  # Windows-specific for file locking
-from PyQt5 import QtWidgets, QtCore, QtGui # type: ignore
-import wmi  # type: ignore # Requires: pip install wmi
-import pythoncom # type: ignore # Requires: pip install pypiwin32
-
-# Global variable for the stop flag file (used to communicate stop command)
-stop_flag_file = "usb_blocker_stop.flag"
-
-def resource_path(relative_path):
-    try:
-        # PyInstaller creates a temp folder and stores path in _MEIPASS
-        base_path = sys._MEIPASS
-    except Exception:
-        base_path = os.path.abspath(".")
-    return os.path.join(base_path, relative_path)
+from event_sources import BACKENDS, create_event_source
+from pipeline import EventChannel, EventCoalescer
+from devices import device_identity, format_identity
+from allowlist import AllowList, read_rules
+from policy import PolicyError, PolicyManager
+from audit import AuditLog
+from snapshot import DeviceSnapshot
+from storage import BLOCK_MODES, STORAGE_ACTIONS, StorageGuard, classify
+from schedule import Scheduler
+import metrics
+from supervisor import AttachedProcess, LockStateFile, Supervisor, supervisor_stats
+from instance import MONITOR_NAME, SUPERVISOR_NAME, acquire_instance, find_endpoint, find_instance, registry_dir
+from credentials import CodeVerifier, CredentialError, OneTimeCodes, hash_code, read_secret
+from control import (DEFAULT_ENDPOINT, ControlError, StreamControlServer, notify_ready,
+                     send_command)
+
+# PyQt5 (gui.py) and the WMI/COM modules (event_sources.WMIEventSource) are
+# imported only when they are needed: stop/status/reload/unlock and the
+# headless mode never load them.
+
+VERSION = "1.1.0"
+
+# Reference point for reporting how long startup took
+started_at = time.monotonic()
 
 def get_runtime_path():
     
@@ -33,239 +46,143 @@ def get_runtime_path():
         return os.path.dirname(os.path.abspath(__file__))
 
 # =============================================================================
-# Section: Instance Locking Helpers (Single-instance check)
-# These functions use a file lock in the TEMP directory.
-# =============================================================================
-def acquire_instance_lock():
-    """
-    Try to open (and exclusively lock) a lock file.
-    Returns the open file object if the lock is acquired,
-    or None if the lock cannot be acquired (another instance is running).
-    """
-    lock_path = os.path.join(os.environ["TEMP"], "usb_blocker.lock")
-    try:
-        lock_file = open(lock_path, "w")
-        # Try to lock 1 byte exclusively in non-blocking mode
-        msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
-        return lock_file
-    except (IOError, OSError):
-        return None
-
-def release_instance_lock(lock_file):
-    """
-    Release the file lock and close the file.
-    """
-    try:
-        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
-    except Exception as e:
-        print(f"Error releasing lock: {e}")
-    finally:
-        lock_file.close()
-
-
-# =============================================================================
-# Section 1: Splash Screen
-# This widget displays a full-screen splash with a 10-second countdown before
-# the main application starts.
-# =============================================================================
-class SplashScreen(QtWidgets.QWidget):
-    def __init__(self, countdown=30):
-        super().__init__()
-        self.countdown = countdown
-        self.total_time = countdown
-        self.initUI()
-
-    def initUI(self):
-        # Frameless and always on top
-        self.setWindowFlags(QtCore.Qt.FramelessWindowHint | QtCore.Qt.WindowStaysOnTopHint)
-
-        # Get screen dimensions and center the splash screen
-        screen = QtWidgets.QApplication.primaryScreen().geometry()
-        width, height = 800, 400  # Increased size for better visibility
-        self.setGeometry(
-            (screen.width() - width) // 2,
-            (screen.height() - height) // 2,
-            width,
-            height
-        )
-
-        # Logo on the left
-        self.logo = QtWidgets.QLabel(self)
-        logo_path = resource_path('tut_logo.png')  # Ensure the file exists in the working directory
-        if os.path.exists(logo_path):
-            pixmap = QtGui.QPixmap(logo_path)
-            self.logo.setPixmap(pixmap.scaled(200, 200, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation))
-            self.logo.setGeometry(50, 100, 200, 200)  # Adjusted position and size for the larger splash
-        else:
-            print(f"Logo file '{logo_path}' not found. Please ensure it exists in the working directory.")
-
-        # Label for countdown text
-        self.label = QtWidgets.QLabel(self)
-        self.label.setAlignment(QtCore.Qt.AlignCenter)
-        self.label.setStyleSheet("font-size: 32px;")
-        self.label.setGeometry(280, 100, 450, 150)  # Adjusted to leave space for the larger logo
-        self.label.setText(f"USB Blocker \nStarting in {self.countdown} seconds...")
-
-        # Progress bar
-        self.progress_bar = QtWidgets.QProgressBar(self)
-        self.progress_bar.setGeometry(280, 280, 450, 30)  # Adjusted to align with the larger label
-        self.progress_bar.setMaximum(self.total_time)
-        self.progress_bar.setValue(self.total_time - self.countdown)
-
-        # Timer to update the countdown every second
-        self.timer = QtCore.QTimer(self)
-        self.timer.timeout.connect(self.updateCountdown)
-        self.timer.start(1000)
-
-    def updateCountdown(self):
-        self.countdown -= 1
-        self.progress_bar.setValue(self.total_time - self.countdown)
-        if self.countdown <= 0:
-            self.timer.stop()
-            self.close()  # Close splash when countdown ends
-        else:
-            self.label.setText(f"USB Blocker \nStarting in {self.countdown} seconds...")
-
-
-# =============================================================================
-# Section 2: Lock Screen (Modal Overlay)
-# This full-screen window locks the UI when a USB is inserted.
-# It shows an input field to accept the override code.
-# The window is borderless, always on top, and (as far as possible) hidden
-# from Alt+Tab and normal close events.
-# =============================================================================
-class LockScreen(QtWidgets.QWidget):
-    def __init__(self, override_code):
-        super().__init__()
-        self.override_code = override_code
-        self.initUI()
-
-    def initUI(self):
-        # Create a full-screen, borderless window
-        self.setWindowFlags(QtCore.Qt.FramelessWindowHint | QtCore.Qt.WindowStaysOnTopHint | QtCore.Qt.Tool)
-        self.showFullScreen()
-        self.setStyleSheet("background-color: black;")
-        # Display a message
-        self.label = QtWidgets.QLabel(self)
-        self.label.setText("USB inserted. System is locked.\nEnter override code to unlock:")
-        self.label.setStyleSheet("font-size: 24px; color: white;")
-        self.label.setAlignment(QtCore.Qt.AlignCenter)
-        self.label.setGeometry(0, 200, self.width(), 100)
-        # Input field for the override code
-        self.input_field = QtWidgets.QLineEdit(self)
-        self.input_field.setEchoMode(QtWidgets.QLineEdit.Password)
-        self.input_field.setGeometry(self.width() // 2 - 100, 350, 200, 40)
-        self.input_field.setAlignment(QtCore.Qt.AlignCenter)
-        self.input_field.setStyleSheet("font-size: 20px;")
-        self.input_field.returnPressed.connect(self.checkOverrideCode)
-
-    def checkOverrideCode(self):
-        # Compare the entered code with the override code
-        if self.input_field.text() == self.override_code or self.input_field.text() == "release()":
-            # Correct code: close the lock screen
-            self.close()  # Correct code: unlock the screen
-        else:
-            self.input_field.clear()  # Incorrect: clear input and wait for re-entry
-
-    def keyPressEvent(self, event):
-        # Override to ignore key events for Alt+Tab or Alt+F4, etc.
-        if event.key() in (QtCore.Qt.Key_Alt, QtCore.Qt.Key_Tab):
-            pass
-        else:
-            super().keyPressEvent(event)
-
-    def closeEvent(self, event):
-        # Ensure the window only closes with the correct override code or release command
-        if self.input_field.text() != self.override_code and self.input_field.text() != "release()":
-            event.ignore()
-        else:
-            event.accept()
-            self.close()
-
-
-# =============================================================================
-# Section 3: Confirmation Screen
-# When the app is stopped (via command line or tray), this screen displays a
-# confirmation message and auto-closes after a few seconds.
-# =============================================================================
-class ConfirmationScreen(QtWidgets.QWidget):
-    def __init__(self, message="Application stopped."):
-        super().__init__()
-        self.message = message
-        self.initUI()
-
-    def initUI(self):
-        # Frameless and on top
-        self.setWindowFlags(QtCore.Qt.FramelessWindowHint | QtCore.Qt.WindowStaysOnTopHint)
-        self.setGeometry(400, 400, 300, 100)
-        label = QtWidgets.QLabel(self.message, self)
-        label.setAlignment(QtCore.Qt.AlignCenter)
-        label.setStyleSheet("font-size: 18px;")
-        label.setGeometry(0, 0, 300, 100)
-        # Auto-close after 3 seconds
-        QtCore.QTimer.singleShot(3000, self.close)
-
-
-# =============================================================================
-# Section 4: System Tray Icon
-# This class creates a system tray icon with a context menu. The menu includes a
-# "Stop" option which writes a stop flag file to signal the app to shut down.
-# =============================================================================
-class SystemTrayIcon(QtWidgets.QSystemTrayIcon):
-    def __init__(self, icon, parent=None, stop_callback=None):
-        super(SystemTrayIcon, self).__init__(icon, parent)
-        self.stop_callback = stop_callback
-        menu = QtWidgets.QMenu(parent)
-        stop_action = menu.addAction("Stop")
-        stop_action.triggered.connect(self.stop_app)
-        exit_action = menu.addAction("Exit")
-        exit_action.triggered.connect(QtWidgets.qApp.quit)
-        self.setContextMenu(menu)
-
-    def stop_app(self):
-        # Write a file to signal a stop command
-        with open(stop_flag_file, 'w') as f:
-            f.write("stop")
-        if self.stop_callback:
-            self.stop_callback()
-
-
-# =============================================================================
-# Section 5: USB Monitor Thread
-# This thread uses the wmi module to monitor USB insertion events.
-# When an event is detected, it triggers the display of the lock screen.
+# Section 1: USB Monitor Thread
+# This thread reads device events from an EventSource (WMI on Windows, kernel
+# uevents on Linux, or a replay feed) and triggers the lock screen on insertion.
+# Devices on the allow-list are let through without locking, bursts of events
+# from one insertion are collapsed by an EventCoalescer, and
+# lock decisions are posted to an EventChannel (see gui.LockEventBridge and
+# HeadlessRunner). Every insertion and its outcome goes to the audit log.
+# With --block_mode volume or both, mass storage is handed to a StorageGuard
+# (storage.py) that blocks the device or its volumes. When armed, the monitor
+# first reconciles the attached devices against the previous run's snapshot
+# (snapshot.py), so devices plugged in while it was not running are caught.
 # =============================================================================
 class USBMonitor(threading.Thread):
-    def __init__(self, lock_screen_callback):
+    def __init__(self, lock_screen_callback, event_source=None, coalesce_window=0.5, allow_list=None,
+                 audit=None, storage_guard=None, snapshot=None):
         super().__init__()
         self.lock_screen_callback = lock_screen_callback
+        self.event_source = event_source or create_event_source()
+        self.coalescer = EventCoalescer(window=coalesce_window)
+        self.allow_list = allow_list or AllowList()
+        self.allowed = 0
+        self.audit = audit
+        self.storage_guard = storage_guard
+        self.snapshot = snapshot
         self.running = True
+        self.stopped = threading.Event()
 
     def run(self):
-        # Set up a WMI watcher for device creation events (e.g., USB insertion)
-        pythoncom.CoInitialize()  # Initialize COM for the thread
-        # Use WMI to monitor USB device changes
-        c = wmi.WMI()
-        watcher = c.Win32_DeviceChangeEvent.watch_for("Creation")
-        while self.running:
-            try:
-                event = watcher(timeout_ms=500)
+        # The event source blocks until a device event arrives or stop() cancels it,
+        # so the thread does not wake up at all while nothing is happening.
+        self.event_source.open()
+        try:
+            if self.snapshot:
+                self.reconcile()
+            while self.running:
+                try:
+                    event = self.event_source.wait()
+                except Exception as e:
+                    metrics.MONITOR_ERRORS["event_source"].inc()
+                    print(f"USB monitor: error reading device events: {e}")
+                    # Back off briefly so a broken backend cannot spin the CPU
+                    self.stopped.wait(1.0)
+                    continue
                 if event:
-                    # Trigger the lock screen on USB insertion
-                    self.lock_screen_callback()
-            except Exception:
-                # Ignore timeout errors and continue looping
-                pass
+                    self.process(event)
+        finally:
+            self.event_source.close()
+
+    def process(self, event):
+        """
+        Count a device event and decide on it if it is an insertion. Also
+        used by engine.Engine, which reads the event sources itself.
+        """
+        metrics.DEVICE_EVENTS.get(event.kind, metrics.DEVICE_EVENTS["other"]).inc()
+        if event.kind == "remove" and self.storage_guard:
+            self.storage_guard.forget(event)
+        if event.kind == "add":
+            self.handle(event._replace(identity=device_identity(event)))
+
+    def attached_devices(self, event_source=None):
+        try:
+            events = (event_source or self.event_source).snapshot()
+        except Exception as e:
+            metrics.MONITOR_ERRORS["event_source"].inc()
+            print(f"USB monitor: cannot list attached devices: {e}")
+            return []
+        return [event._replace(identity=device_identity(event)) for event in events]
+
+    def reconcile(self, attached=None):
+        """
+        Send devices attached since the previous run (before the monitor was
+        armed) through the same decision as an insertion. `attached` defaults
+        to the devices the event source lists now.
+        """
+        started = time.perf_counter()
+        if attached is None:
+            attached = self.attached_devices()
+        added = self.snapshot.reconcile(attached, started=started,
+                                        allowed=lambda event: self.allow_list.allows(event.identity))
+        if added:
+            print(f"{len(added)} device(s) attached while the monitor was not running")
+        for event in added:
+            self.handle(event)
+
+    def handle(self, event):
+        """
+        Decide on an inserted device (identity filled in).
+        """
+        if self.allow_list.allows(event.identity):
+            self.allowed += 1
+            metrics.DEVICE_DECISIONS["allowed"].inc()
+            print(f"Allowed device inserted: {format_identity(event.identity)}")
+            self.audit_insertion(event, "allowed")
+            return
+        if self.storage_guard and self.storage_guard.active():
+            storage = classify(event)
+            if storage == "pending":
+                # Decided on the interface events that follow
+                metrics.DEVICE_DECISIONS["deferred"].inc()
+                return
+            if storage in ("storage", "composite"):
+                # Queued for the guard thread; this thread goes straight on.
+                # A full queue fails closed: the device locks the screen.
+                accepted = self.storage_guard.submit(event)
+                if accepted and storage == "storage" and self.storage_guard.mode == "volume":
+                    metrics.DEVICE_DECISIONS["storage_blocked"].inc()
+                    self.audit_insertion(event, "storage_blocked")
+                    return
+        if self.coalescer.accept(event):
+            metrics.DEVICE_DECISIONS["lock"].inc()
+            self.audit_insertion(event, "lock")
+            # Trigger the lock screen once per USB insertion
+            try:
+                self.lock_screen_callback(event)
+            except Exception as e:
+                metrics.MONITOR_ERRORS["lock_callback"].inc()
+                print(f"USB monitor: lock screen callback failed: {e}")
+        else:
+            metrics.DEVICE_DECISIONS["coalesced"].inc()
+            self.audit_insertion(event, "coalesced")
+
+    def audit_insertion(self, event, decision):
+        if self.audit:
+            self.audit.record("device_inserted", device_id=event.device_id,
+                              device=format_identity(event.identity), decision=decision)
 
     def stop(self):
         self.running = False
-        # Clean up WMI resources
-        pythoncom.CoUninitialize()
+        self.stopped.set()
+        # Wake the blocked event source immediately instead of waiting for a timeout
+        self.event_source.cancel()
         self.join()
 
 
+
 # =============================================================================
-# Section 6: Persistence Helpers
+# Section 2: Persistence Helpers
 # Simulated functions to add or remove the application from Windows startup.
 # In production, you would create or remove a registry entry here.
 # =============================================================================
@@ -277,129 +194,485 @@ def remove_from_startup():
 
 
 # =============================================================================
-# Section 7: Main Application Class
-# This class sets up the main functionalities: splash screen, system tray, USB
-# monitoring, and timed execution if specified.
+# Section 3: Headless Runner
+# Runs the blocker without any GUI (servers, kiosks, login scripts): lock
+# decisions are reported on the console and the control channel is served by
+# a StreamControlServer thread. Nothing here imports PyQt5.
 # =============================================================================
-class USBBlockerApp(QtWidgets.QApplication):
-    def __init__(self, args, override_code, custom_name, run_time=None):
-        super().__init__(args)
-        self.override_code = override_code
-        self.custom_name = custom_name
+class HeadlessRunner:
+    # How often the policy file is checked for changes (there is no
+    # QFileSystemWatcher without Qt)
+    POLICY_POLL_INTERVAL = 1.0
+
+    def __init__(self, verifier, usb_monitor, lock_channel, run_time=None, policy_manager=None,
+                 endpoint=DEFAULT_ENDPOINT, on_ready=None, audit=None, lock_state=None, scheduler=None):
+        self.verifier = verifier
+        self.usb_monitor = usb_monitor
+        self.lock_channel = lock_channel
         self.run_time = run_time
-        self.tray_icon = None
-        self.usb_monitor = None
-        self.lock_screen_displayed = False
-
-        # Set the application name (affects window titles and metadata)
-        self.setApplicationName(self.custom_name)
-
-        # Show the splash screen with a 10-second countdown
-        self.splash = SplashScreen(countdown=10)
-        self.splash.show()
-        # After splash, start the main app functionalities
-        QtCore.QTimer.singleShot(10000, self.start_app)
-        self.exec_()  # Start the event loop to keep the application running
-
-    def start_app(self):
-        self.splash.close()
-        # Check if the icon file exists and display a message on the console
-        icon_path = resource_path('usb_blocker_icon.png')
-        if not os.path.exists(icon_path):
-            print(f"Icon file '{icon_path}' not found. Please ensure it exists in the working directory.")
-        else:
-            print(f"Icon file '{icon_path}' found.")
-            # Create and show the system tray icon
-            icon = QtGui.QIcon(icon_path)
-            self.tray_icon = SystemTrayIcon(icon, stop_callback=self.stop_app)
-            self.tray_icon.show()
-
-        # Start the USB monitor thread to listen for USB insertion events
-        self.usb_monitor = USBMonitor(lock_screen_callback=self.show_lock_screen)
-        self.usb_monitor.start()
-
-        # If a run time is specified, schedule the app to stop after that duration
-        print(f"Application will run for {self.run_time} seconds." if self.run_time else "No runtime specified.")
-
-        # Schedule the app to stop after the specified run time
-        if self.run_time:
-            QtCore.QTimer.singleShot(self.run_time * 1000, self.stop_app)
-        else:
-            print("No runtime specified. Running indefinitely...")
+        self.policy_manager = policy_manager
+        self.endpoint = endpoint
+        self.on_ready = on_ready
+        self.audit = audit
+        self.lock_state = lock_state
+        self.scheduler = scheduler
+        self.lock_enabled = True
+        self.policy_lock_enabled = True
+        self.locked = False
+        self.locked_since = None
+        self.lock_count = 0
+        self.stop_reason = "run_time"
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        lock_channel.notify = self.wakeup.set
+        # Events posted before notify was set (fast start) did not signal anyone
+        self.wakeup.set()
+        self.control_server = StreamControlServer({
+            "status": self.control_status,
+            "stop": self.control_stop,
+            "reload": self.control_reload,
+            "push": self.control_push,
+            "unlock": self.control_unlock,
+            "metrics": metrics.control_metrics,
+        }, endpoint=endpoint)
 
-        # Periodically check for the stop flag file (set via command line or tray)
-        self.check_stop_flag()
-
-    def check_stop_flag(self):
-        if os.path.exists(stop_flag_file):
-            self.stop_app()
-        else:
-            QtCore.QTimer.singleShot(1000, self.check_stop_flag)
-
-    def show_lock_screen(self):
-        if not self.lock_screen_displayed:
-            self.lock_screen_displayed = True
-            self.lock_screen = LockScreen(self.override_code)
-            self.lock_screen.show()
-            # When the lock screen is closed, reset the flag so it can be shown again
-            self.lock_screen.destroyed.connect(lambda: setattr(self, 'lock_screen_displayed', False))
-
-    def stop_app(self):
-        # Stop the USB monitor thread
-        if self.usb_monitor:
+    def run(self):
+        """
+        Serve until stopped by the control channel, SIGINT/SIGTERM or the run
+        time. Returns the process exit code.
+        """
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: self.stop("signal"))
+        if self.usb_monitor.ident is None:
+            self.usb_monitor.start()
+        self.prepare()
+        self.control_server.listen()
+        self.ready()
+        deadline = time.monotonic() + self.run_time if self.run_time else None
+        while not self.stopping.is_set():
+            timeout = self.POLICY_POLL_INTERVAL if self.policy_manager else None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            if self.scheduler:
+                # The next enforcement window transition, if sooner
+                due = self.scheduler.sleep_time()
+                if due is not None:
+                    timeout = due if timeout is None else min(timeout, due)
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            for event in self.lock_channel.drain():
+                self.lock(event)
+            if self.policy_manager and self.policy_manager.changed() and self.policy_manager.reload():
+                self.apply_policy()
+            if self.scheduler and self.scheduler.advance():
+                self.apply_schedule()
+        self.control_server.close()
+        if self.usb_monitor.is_alive():
             self.usb_monitor.stop()
-        # Remove auto-start persistence
-        remove_from_startup()
-        # Show a confirmation screen
-        self.confirmation = ConfirmationScreen("Application is stopping...")
-        self.confirmation.show()
-        # Release the instance lock if it exists
-        if hasattr(self, "instance_lock") and self.instance_lock:
-            release_instance_lock(self.instance_lock)
-            self.instance_lock = None
-        # Exit the application after a short delay (3 seconds)
-        QtCore.QTimer.singleShot(3000, self.quit)
+        return self.finish()
+
+    # prepare(), ready() and finish() are shared with engine.Engine
+    def prepare(self):
+        if self.policy_manager:
+            self.apply_policy()
+        if self.lock_state and self.lock_state.locked:
+            self.restore_lock()
+
+    def ready(self):
+        if self.on_ready:
+            self.on_ready()
+        print(f"Running headless for {self.run_time} seconds." if self.run_time else "Running headless indefinitely...")
+
+    def finish(self):
+        self.audit_record("stop", reason=self.stop_reason)
+        metrics.count_stop(self.stop_reason)
+        if self.lock_state:
+            self.lock_state.stopped_by(self.stop_reason)
+        print(f"Device event counters: {self.usb_monitor.coalescer.stats()} {self.lock_channel.stats()}")
+        return 0
+
+    def stop(self, reason):
+        self.stop_reason = reason
+        self.stopping.set()
+        self.wakeup.set()
+
+    def lock(self, event):
+        if not self.lock_enabled:
+            print("Lock disabled by policy; device insertion ignored.")
+            return
+        if self.locked:
+            return
+        self.locked = True
+        self.locked_since = time.monotonic()
+        self.lock_count += 1
+        metrics.LOCKS.inc()
+        metrics.LOCKED.set(1)
+        # No screen to paint here: the lock takes effect when it is decided
+        metrics.LOCK_LATENCY.observe(self.locked_since - event.timestamp)
+        if self.lock_state:
+            self.lock_state.save(locked=True)
+        identity = format_identity(event.identity) if event.identity else "unknown"
+        self.audit_record("lock_shown", device_id=event.device_id, device=identity)
+        print(f"Device inserted ({identity}): locked until unlocked with the override code.")
+
+    def restore_lock(self):
+        # The previous monitor process was locked when it ended (see supervisor.py)
+        self.locked = True
+        self.locked_since = time.monotonic()
+        metrics.LOCKED.set(1)
+        self.audit_record("lock_restored")
+        print("Restored the lock of the previous monitor process.")
+
+    def audit_record(self, event, **fields):
+        if self.audit:
+            self.audit.record(event, **fields)
+
+    def apply_policy(self):
+        policy = self.policy_manager.policy
+        self.policy_lock_enabled = policy["lock_enabled"]
+        self.usb_monitor.allow_list = self.policy_manager.allow_list
+        self.usb_monitor.coalescer.window = policy["coalesce_ms"] / 1000.0
+        if self.usb_monitor.storage_guard:
+            self.usb_monitor.storage_guard.apply_mode(policy["block_mode"])
+        if self.scheduler:
+            self.scheduler.load(policy["schedule"])
+        self.apply_schedule()
+        # The next schedule transition may have moved
+        self.wakeup.set()
+
+    def apply_schedule(self):
+        enforcing = self.scheduler.enforcing() if self.scheduler else True
+        lock_enabled = self.policy_lock_enabled and enforcing
+        if lock_enabled != self.lock_enabled and self.scheduler:
+            state = self.scheduler.state()
+            self.audit_record("schedule", state=state)
+            print(f"Schedule: {state} from now on.")
+        self.lock_enabled = lock_enabled
+
+    def check_code(self, code, denied_event):
+        # Blocks this control connection's thread for the hash, nothing else
+        ok, retry_after = self.verifier.verify(code)
+        metrics.UNLOCK_ATTEMPTS["control", "success" if ok else "failure"].inc()
+        if not ok:
+            self.audit_record(denied_event, source="control", retry_after=round(retry_after, 1))
+            if retry_after > 0:
+                raise ControlError(f"invalid override code; try again in {math.ceil(retry_after)} seconds")
+            raise ControlError("invalid override code")
+
+    # Control handlers run on StreamControlServer threads (or engine.Engine's
+    # loop and executor); they only read counters, flip flags or swap whole
+    # objects, like the GUI handlers. The Scheduler locks itself.
+    def control_status(self, args):
+        status = {
+            "pid": os.getpid(),
+            "backend": self.usb_monitor.event_source.name,
+            "headless": True,
+            "locked": self.locked,
+            "lock_enabled": self.lock_enabled,
+            "monitoring": self.usb_monitor.is_alive(),
+            "devices_allowed": self.usb_monitor.allowed,
+        }
+        status.update(self.usb_monitor.coalescer.stats())
+        status.update(self.lock_channel.stats())
+        if self.usb_monitor.snapshot:
+            status.update(self.usb_monitor.snapshot.stats())
+        if self.usb_monitor.storage_guard:
+            status.update(self.usb_monitor.storage_guard.stats())
+        if self.scheduler:
+            status.update(self.scheduler.stats())
+        status.update(supervisor_stats())
+        if self.policy_manager:
+            status.update(self.policy_manager.stats())
+        if self.audit:
+            status.update(self.audit.stats())
+        status.update(self.verifier.stats())
+        return status
+
+    def control_stop(self, args):
+        self.check_code(args.get("code"), "stop_denied")
+        self.stop("control")
+        return "stopping"
+
+    def control_reload(self, args):
+        if not self.policy_manager:
+            raise ControlError("no policy file configured")
+        if not self.policy_manager.reload():
+            raise ControlError("policy reload failed")
+        self.apply_policy()
+        return self.policy_manager.stats()
+
+    def control_push(self, args):
+        self.check_code(args.get("code"), "push_denied")
+        if not self.policy_manager:
+            raise ControlError("no policy file configured")
+        try:
+            self.policy_manager.write(args.get("policy"))
+        except PolicyError as e:
+            raise ControlError(str(e))
+        self.audit_record("policy_pushed", source="control")
+        return self.control_reload(args)
+
+    def control_unlock(self, args):
+        self.check_code(args.get("code"), "unlock_failure")
+        if self.locked:
+            self.locked = False
+            metrics.LOCKED.set(0)
+            metrics.LOCK_DURATION.observe(time.monotonic() - self.locked_since)
+            if self.lock_state:
+                self.lock_state.save(locked=False)
+            if self.usb_monitor.snapshot:
+                self.usb_monitor.snapshot.approve()
+            self.audit_record("unlock_success", source="control")
+            return "unlocked"
+        return "not locked"
 
 
 # =============================================================================
-# Section 8: Command-Line Interface & Main Function
+# Section 4: Command-Line Interface & Main Function
 # Parses command-line arguments and starts or stops the app accordingly.
 # =============================================================================
 def main():
     parser = argparse.ArgumentParser(description="Windows USB Blocker App")
-    parser.add_argument("action", choices=["start", "stop"], help="Start or stop the application")
-    parser.add_argument("--override", required=True, help="Override code for stopping/unlocking")
+    parser.add_argument("action", choices=["start", "supervise", "stop", "status", "reload", "unlock", "metrics"],
+                        help="Start or stop the application, or query/control a running instance; "
+                             "supervise starts it under a supervisor that restarts it if it fails")
+    parser.add_argument("--override", help="Override code for stopping/unlocking")
+    parser.add_argument("--override_hash", help="Hash of the override code (see credentials.py), so the code "
+                                                "itself never appears on the command line")
+    parser.add_argument("--totp_secret_file", help="File with the fleet secret for one-time unlock codes (see client.py code)")
+    parser.add_argument("--machine", default=socket.gethostname(), help="Machine name one-time codes are minted for")
     parser.add_argument("--run_time", type=int, help="Time in seconds to run before auto-stop")
     parser.add_argument("--name", default="Process 101", help="Custom name for the app (as seen in Task Manager)")
+    parser.add_argument("--backend", choices=BACKENDS, default="auto", help="Device event source (auto = WMI on Windows, kernel uevents on Linux)")
+    parser.add_argument("--replay", help="Recorded device events (JSON lines) for the replay backend, or - for stdin")
+    parser.add_argument("--replay_rate", type=float, default=0, help="Replay rate in events per second (0 = as fast as possible)")
+    parser.add_argument("--allowlist", help="File of approved devices (VID:PID[:SERIAL] or class:XX, one per line)")
+    parser.add_argument("--policy", help="JSON policy file (allow-list, lock behaviour, timeouts), reloaded on change")
+    parser.add_argument("--endpoint", help="Name of the local control endpoint (named pipe / Unix socket); default: "
+                                           f"the running monitor's (see instance.py), else {DEFAULT_ENDPOINT}")
+    parser.add_argument("--notify", help="host:port:token of a launcher waiting for the ready handshake")
+    parser.add_argument("--room", help="Room this machine is in; schedule windows for other rooms are ignored")
+    parser.add_argument("--coalesce_ms", type=int, default=500, help="Window in milliseconds for collapsing bursts of events from one device")
+    parser.add_argument("--block_mode", choices=BLOCK_MODES, default="lock",
+                        help="lock: lock the screen on any unapproved device; volume: block mass storage instead "
+                             "of locking (other devices still lock); both: block and lock")
+    parser.add_argument("--storage_action", choices=STORAGE_ACTIONS, default="auto",
+                        help="How mass storage is blocked (auto = mountvol on Windows, deauthorize on Linux)")
+    parser.add_argument("--fast-start", dest="fast_start", action="store_true",
+                        help="Arm device monitoring before the GUI is built and skip the splash countdown and alert")
+    parser.add_argument("--headless", action="store_true",
+                        help="Run without a GUI (implies --fast-start); lock decisions are logged to the console")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="Headless core: a thread per concern, or one asyncio event loop (engine.py); "
+                             "asyncio implies --headless")
+    parser.add_argument("--audit_log", default=os.path.join(get_runtime_path(), "usb_blocker_audit.jsonl"),
+                        help="Audit log file (JSON lines, rotated by size and age); empty to disable")
+    parser.add_argument("--snapshot_file", default=os.path.join(get_runtime_path(), "usb_blocker_devices.snap"),
+                        help="Devices attached at the last run; devices attached since are treated as insertions "
+                             "at start. Empty to disable")
+    parser.add_argument("--metrics_file", help="Write metrics to this file in the Prometheus text format "
+                                               "(e.g. for the node_exporter textfile collector)")
+    parser.add_argument("--metrics_interval", type=float, default=15, help="Seconds between --metrics_file updates")
+    parser.add_argument("--state_file", help="Lock state file, so a restarted monitor locks again "
+                                             "(supervise: default usb_blocker_state.json in TEMP)")
+    parser.add_argument("--prometheus", action="store_true",
+                        help="'metrics': print the Prometheus text format instead of JSON")
     args = parser.parse_args()
-    
-    # Alert the user about the action being taken using pyQt5 message box
-    alert = QtWidgets.QMessageBox()
-    alert.setText(f"Action: {args.action}\nOverride Code: {args.override}\nCustom Name: {args.name}")
-    alert.setWindowTitle("USB Blocker")
-    alert.setIcon(QtWidgets.QMessageBox.Information)
-    alert.setStandardButtons(QtWidgets.QMessageBox.Ok)
-    alert.exec_()
-    
+    if args.action in ("start", "supervise") and not (args.override or args.override_hash or args.totp_secret_file):
+        parser.error(f"--override, --override_hash or --totp_secret_file is required for '{args.action}'")
+    if args.action in ("stop", "unlock") and not args.override:
+        parser.error(f"--override is required for '{args.action}'")
+    if args.engine == "asyncio":
+        args.headless = True
+    if args.headless:
+        args.fast_start = True
+    if not args.endpoint:
+        # Commands go to whichever monitor is registered as running
+        args.endpoint = DEFAULT_ENDPOINT if args.action in ("start", "supervise") else find_endpoint(DEFAULT_ENDPOINT)
+
     if args.action == "start":
-        # Try to acquire a single-instance lock
-        lock_file = acquire_instance_lock()
-        if not lock_file:
-            print("Another instance is already running. Exiting.")
+        # Single instance per session; the registry record tells clients where we are
+        instance = acquire_instance(MONITOR_NAME)
+        if not instance:
+            running = find_instance(MONITOR_NAME)
+            print(f"Another instance is already running (PID {running['pid'] if running else 'unknown'}). Exiting.")
             sys.exit(1)
+        # Only a salted hash of the override code is kept
+        try:
+            encoded = args.override_hash or (hash_code(args.override) if args.override else None)
+            one_time = None
+            if args.totp_secret_file:
+                one_time = OneTimeCodes(read_secret(args.totp_secret_file), args.machine)
+            verifier = CodeVerifier(encoded, one_time=one_time)
+        except CredentialError as e:
+            print(e)
+            sys.exit(1)
+        args.override = None
         # Simulate adding to startup for persistence
         add_to_startup()
-        # Start the Qt application and store the instance lock
-        app = USBBlockerApp(sys.argv, override_code=args.override, custom_name=args.name, run_time=args.run_time)
-        app.instance_lock = lock_file
-        
-        sys.exit(app.exec_())
+        audit = None
+        if args.audit_log:
+            try:
+                audit = AuditLog(args.audit_log)
+            except OSError as e:
+                print(f"Cannot open audit log '{args.audit_log}', running without it: {e}")
+        if audit:
+            audit.record("start", pid=os.getpid(), version=VERSION, headless=args.headless)
+        lock_state = None
+        if args.state_file:
+            # Keeps the lock of a previous (crashed or killed) process
+            lock_state = LockStateFile(os.path.abspath(args.state_file))
+            lock_state.save()
+        exporter = None
+        if args.metrics_file:
+            exporter = metrics.TextfileExporter(metrics.REGISTRY, args.metrics_file, interval=args.metrics_interval)
+            exporter.start()
+        event_source = create_event_source(args.backend, replay_path=args.replay, replay_rate=args.replay_rate)
+        base_rules = read_rules(args.allowlist) if args.allowlist else []
+        allow_list = AllowList(base_rules)
+        policy_manager = None
+        if args.policy:
+            policy_manager = PolicyManager(args.policy, base_rules=base_rules)
+            if not policy_manager.reload():
+                sys.exit(1)
+            allow_list = policy_manager.allow_list
+        # Lock decisions are queued here until the GUI (or headless runner) drains them
+        lock_channel = EventChannel()
+        # A storage device that cannot be blocked locks the screen instead
+        storage_guard = StorageGuard(args.block_mode, args.storage_action, audit=audit, fallback=lock_channel.post)
+        usb_monitor = USBMonitor(lock_channel.post, event_source=event_source,
+                                 coalesce_window=args.coalesce_ms / 1000.0, allow_list=allow_list, audit=audit,
+                                 storage_guard=storage_guard,
+                                 snapshot=DeviceSnapshot(args.snapshot_file) if args.snapshot_file else None)
+        if args.fast_start and args.engine == "threads":
+            # Protection is active from here on; insertions during GUI start-up are
+            # queued in lock_channel and shown as soon as the bridge attaches
+            usb_monitor.start()
+            print(f"Device monitoring armed after {(time.monotonic() - started_at) * 1000.0:.0f} ms")
+        instance.publish(kind="monitor", endpoint=args.endpoint, version=VERSION, backend=event_source.name,
+                         headless=args.headless, state_file=lock_state.path if lock_state else None)
+
+        def on_ready():
+            if args.notify:
+                notify_ready(args.notify, pid=os.getpid(), version=VERSION, endpoint=args.endpoint,
+                             backend=event_source.name, headless=args.headless,
+                             startup_ms=round((time.monotonic() - started_at) * 1000.0, 1))
+
+        # Enforcement windows come from the policy file
+        scheduler = Scheduler(room=args.room) if policy_manager else None
+        if args.headless:
+            runner = HeadlessRunner(verifier, usb_monitor, lock_channel, run_time=args.run_time,
+                                    policy_manager=policy_manager, endpoint=args.endpoint, on_ready=on_ready,
+                                    audit=audit, lock_state=lock_state, scheduler=scheduler)
+            if args.engine == "asyncio":
+                from engine import Engine
+                exit_code = Engine(runner).run()
+            else:
+                exit_code = runner.run()
+        else:
+            from gui import USBBlockerApp, show_alert
+            app = USBBlockerApp(sys.argv, verifier=verifier, custom_name=args.name,
+                                usb_monitor=usb_monitor, lock_channel=lock_channel, run_time=args.run_time,
+                                policy_manager=policy_manager, endpoint=args.endpoint, on_ready=on_ready,
+                                audit=audit, lock_state=lock_state, scheduler=scheduler)
+            if not args.fast_start:
+                # Alert the user about the action being taken
+                show_alert(f"Action: {args.action}\nCustom Name: {args.name}")
+            app.launch(splash_seconds=0 if args.fast_start else 10)
+            exit_code = app.exec_()
+            if usb_monitor.is_alive():
+                usb_monitor.stop()
+
+        storage_guard.close()
+        if exporter:
+            exporter.stop()
+        if audit:
+            audit.close()
+        remove_from_startup()
+        instance.release()
+        sys.exit(exit_code)
+
+    elif args.action == "supervise":
+        instance = acquire_instance(SUPERVISOR_NAME)
+        if not instance:
+            print("Another supervisor is already running. Exiting.")
+            sys.exit(1)
+        state_file = os.path.abspath(args.state_file or os.path.join(registry_dir(), "usb_blocker_state.json"))
+        # A monitor that is already running is supervised as it is, not replaced
+        running = find_instance(MONITOR_NAME)
+        if running:
+            if not running.get("state_file"):
+                # Its stops and lock state would never reach the supervisor, which
+                # would then restart a monitor stopped with the code
+                print(f"The running monitor (PID {running['pid']}) keeps no lock state file; stop it or restart it "
+                      f"with --state_file before supervising it. Exiting.")
+                instance.release()
+                sys.exit(1)
+            args.endpoint = running.get("endpoint", args.endpoint)
+            state_file = running["state_file"]
+            print(f"Supervising the running monitor (PID {running['pid']}).")
+        # Children only ever see the hash
+        encoded = args.override_hash or (hash_code(args.override) if args.override else None)
+        args.override = None
+        supervised_at = time.monotonic()
+
+        def build_command(restart):
+            command = [sys.executable] if getattr(sys, 'frozen', False) else [sys.executable, os.path.abspath(__file__)]
+            command += ["start", "--state_file", state_file, "--endpoint", args.endpoint, "--machine", args.machine,
+                        "--name", args.name, "--backend", args.backend, "--replay_rate", str(args.replay_rate),
+                        "--coalesce_ms", str(args.coalesce_ms), "--audit_log", args.audit_log,
+                        "--block_mode", args.block_mode, "--storage_action", args.storage_action,
+                        "--snapshot_file", args.snapshot_file, "--engine", args.engine,
+                        "--metrics_interval", str(args.metrics_interval)]
+            for option, value in (("--override_hash", encoded), ("--totp_secret_file", args.totp_secret_file),
+                                  ("--replay", args.replay), ("--allowlist", args.allowlist),
+                                  ("--policy", args.policy), ("--metrics_file", args.metrics_file),
+                                  ("--room", args.room)):
+                if value:
+                    command += [option, value]
+            if args.run_time:
+                # The run time covers the whole supervised session, not each process
+                remaining = args.run_time - int(time.monotonic() - supervised_at)
+                command += ["--run_time", str(max(1, remaining))]
+            if args.headless:
+                command.append("--headless")
+            # Restarts skip the splash countdown: protection must be back at once
+            if args.fast_start or restart:
+                command.append("--fast-start")
+            return command
+
+        supervisor = Supervisor(build_command, args.endpoint, state_file, notify=args.notify)
+        instance.publish(kind="supervisor", endpoint=args.endpoint, version=VERSION, state_file=state_file)
+        exit_code = supervisor.run(attach=AttachedProcess(running["pid"]) if running else None)
+        instance.release()
+        sys.exit(exit_code)
 
     elif args.action == "stop":
-        # Write the stop flag to signal a running instance to shut down
-        with open(stop_flag_file, 'w') as f:
-            f.write("stop")
+        # Ask the running instance to shut down over the control channel
+        try:
+            send_command("stop", endpoint=args.endpoint, code=args.override)
+        except ControlError as e:
+            print(f"Stop command failed: {e}")
+            sys.exit(1)
         print("Stop command issued. Use override code if required to unlock.")
 
+    else:
+        # status / reload / unlock / metrics are answered immediately by the running instance
+        options = {"code": args.override} if args.action == "unlock" else {}
+        if args.action == "metrics" and args.prometheus:
+            options["format"] = "prometheus"
+        try:
+            result = send_command(args.action, endpoint=args.endpoint, **options)
+            if options.get("format") == "prometheus":
+                sys.stdout.write(result)
+            else:
+                print(json.dumps(result))
+        except ControlError as e:
+            print(f"{args.action.capitalize()} command failed: {e}")
+            sys.exit(1)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,162 @@
+import re
+import threading
+from collections import deque
+
+# =============================================================================
+# Event Pipeline Stages
+# Stages that sit between the device event source and the lock decision.
+# They run on the USBMonitor thread, so they must never block.
+# =============================================================================
+
+# Trailing interface component of a Linux USB devpath (".../1-1/1-1:1.0")
+_USB_INTERFACE_SUFFIX = re.compile(r"/[^/]+:\d+\.\d+$")
+
+
+def physical_device_key(event):
+    """
+    Map a device event to the physical device it belongs to, so that the
+    hub/interface/storage/volume notifications of one insertion share a key.
+    Backends that carry no device identity (Win32_DeviceChangeEvent) all map
+    to the same key, which collapses each burst into one decision.
+    """
+    device_id = event.device_id
+    if not device_id:
+        return ""
+    if device_id.startswith("/devices/"):
+        return _USB_INTERFACE_SUFFIX.sub("", device_id)
+    return device_id.upper()
+
+
+# =============================================================================
+# Section 1: Coalescing / debounce
+# A burst of events for the same physical device produces a single lock
+# decision: the first event passes straight through (no added latency) and
+# every further event for that device is suppressed until it has been quiet
+# for `window` seconds.
+# =============================================================================
+class EventCoalescer:
+    # Forget quiet devices once this many keys are being tracked
+    PRUNE_THRESHOLD = 1024
+
+    def __init__(self, window=0.5, key=physical_device_key):
+        self.window = window
+        self.key = key
+        self.last_seen = {}
+        self.seen = 0
+        self.suppressed = 0
+
+    def accept(self, event):
+        """
+        Return True if `event` should reach the lock decision, False if it is
+        part of a burst that has already been reported.
+        """
+        self.seen += 1
+        key = self.key(event)
+        last = self.last_seen.get(key)
+        # Sliding window: a continuing storm keeps extending the quiet period
+        self.last_seen[key] = event.timestamp
+        if last is not None and event.timestamp - last < self.window:
+            self.suppressed += 1
+            return False
+        if len(self.last_seen) > self.PRUNE_THRESHOLD:
+            self.prune(event.timestamp)
+        return True
+
+    def prune(self, now):
+        expired = [key for key, seen in self.last_seen.items() if now - seen >= self.window]
+        for key in expired:
+            del self.last_seen[key]
+
+    def stats(self):
+        return {
+            "events_seen": self.seen,
+            "events_suppressed": self.suppressed,
+            "events_passed": self.seen - self.suppressed,
+        }
+
+
+# =============================================================================
+# Section 2: Cross-thread delivery
+# A bounded FIFO that carries lock decisions from the monitor thread to the
+# GUI thread. post() never blocks the monitor; the consumer is only notified
+# when the queue goes from empty to non-empty, so a burst costs one wakeup of
+# the GUI thread and drain() then takes every pending event in order.
+# Overflow policy: when the queue is full, the newest event is dropped and
+# counted. A full queue always has a lock decision pending already, so the
+# screen still locks.
+# =============================================================================
+class EventChannel:
+    def __init__(self, capacity=256, notify=None):
+        self.capacity = capacity
+        self.notify = notify
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.posted = 0
+        self.dropped = 0
+
+    def post(self, event):
+        """
+        Queue `event` for the consumer. Returns False if it was dropped.
+        Safe to call from any thread.
+        """
+        with self.lock:
+            if len(self.queue) >= self.capacity:
+                self.dropped += 1
+                return False
+            was_empty = not self.queue
+            self.queue.append(event)
+            self.posted += 1
+        if was_empty and self.notify:
+            self.notify()
+        return True
+
+    def drain(self):
+        """
+        Remove and return all pending events, oldest first.
+        """
+        with self.lock:
+            events = list(self.queue)
+            self.queue.clear()
+        return events
+
+    def stats(self):
+        return {"events_posted": self.posted, "events_dropped": self.dropped}
+
+
+# =============================================================================
+# Section 3: Lock latency probe
+# Records how long it takes from a device event being received (its
+# monotonic timestamp) until the lock screen is actually on screen. One frame
+# at 60 Hz is the budget: anything slower is a visible gap.
+# =============================================================================
+class LatencyProbe:
+    FRAME_BUDGET_MS = 1000.0 / 60
+
+    def __init__(self, capacity=512):
+        self.samples = deque(maxlen=capacity)
+        self.count = 0
+        self.over_budget = 0
+
+    def record(self, started, finished):
+        """
+        Record one sample between two time.monotonic() readings.
+        """
+        latency = (finished - started) * 1000.0
+        self.samples.append(latency)
+        self.count += 1
+        if latency > self.FRAME_BUDGET_MS:
+            self.over_budget += 1
+        return latency
+
+    def stats(self):
+        if not self.samples:
+            return {"lock_latency_samples": 0}
+        ordered = sorted(self.samples)
+        return {
+            "lock_latency_samples": self.count,
+            "lock_latency_last_ms": round(self.samples[-1], 3),
+            "lock_latency_p50_ms": round(ordered[len(ordered) // 2], 3),
+            "lock_latency_p95_ms": round(ordered[min(len(ordered) - 1, len(ordered) * 95 // 100)], 3),
+            "lock_latency_max_ms": round(ordered[-1], 3),
+            "lock_latency_over_frame": self.over_budget,
+        }
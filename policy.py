@@ -0,0 +1,171 @@
+import os
+import json
+import time
+
+from allowlist import AllowList, AllowListError
+from storage import BLOCK_MODES
+from schedule import ScheduleError, parse_schedule
+
+# =============================================================================
+# Policy File
+# Runtime settings that can change without restarting the blocker. The file
+# is JSON, for example:
+#
+#   {
+#       "allow": ["046D:C52B", "1050:0407:00123*", "class:03"],
+#       "lock_enabled": true,
+#       "coalesce_ms": 500,
+#       "block_mode": "volume"
+#   }
+#
+# "block_mode" (see storage.py) overrides --block_mode; null or absent keeps
+# the command-line setting. "schedule" sets enforcement windows (see
+# schedule.py); without it the blocker always enforces.
+#
+# The running app watches the file and calls PolicyManager.reload() when it
+# changes. Only rules that were added are parsed, and the new allow-list is
+# swapped in with a single assignment, so the monitor thread never waits.
+# A "push" control command (client.py fleet push) replaces the file through
+# PolicyManager.write() and reloads it.
+# =============================================================================
+DEFAULT_POLICY = {
+    "allow": [],
+    "lock_enabled": True,
+    "coalesce_ms": 500,
+    "block_mode": None,
+    "schedule": None,
+}
+
+
+class PolicyError(ValueError):
+    pass
+
+
+def load_policy(path):
+    """
+    Read and validate a policy file, returning a dict with every key of
+    DEFAULT_POLICY filled in and "schedule" parsed into (default, windows).
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        raise PolicyError(f"Cannot read policy file '{path}': {e}")
+    if not isinstance(data, dict):
+        raise PolicyError(f"Policy file '{path}' must contain a JSON object")
+    return validate_policy(data)
+
+
+def validate_policy(data):
+    """
+    Validate a policy already decoded from JSON; see load_policy().
+    """
+    if not isinstance(data, dict):
+        raise PolicyError("A policy must be a JSON object")
+    unknown = set(data) - set(DEFAULT_POLICY)
+    if unknown:
+        raise PolicyError(f"Unknown policy settings: {', '.join(sorted(unknown))}")
+    policy = dict(DEFAULT_POLICY, **data)
+    if not isinstance(policy["allow"], list) or not all(isinstance(r, str) for r in policy["allow"]):
+        raise PolicyError("'allow' must be a list of rule strings")
+    if not isinstance(policy["lock_enabled"], bool):
+        raise PolicyError("'lock_enabled' must be true or false")
+    # bool is a subclass of int: JSON true must not become a 1 ms window
+    coalesce_ms = policy["coalesce_ms"]
+    if not isinstance(coalesce_ms, int) or isinstance(coalesce_ms, bool) or coalesce_ms < 0:
+        raise PolicyError("'coalesce_ms' must be a non-negative integer")
+    if policy["block_mode"] is not None and policy["block_mode"] not in BLOCK_MODES:
+        raise PolicyError(f"'block_mode' must be one of {', '.join(BLOCK_MODES)}")
+    if policy["schedule"] is not None:
+        try:
+            policy["schedule"] = parse_schedule(policy["schedule"])
+        except ScheduleError as e:
+            raise PolicyError(f"Invalid schedule: {e}")
+    return policy
+
+
+class PolicyManager:
+    """
+    Holds the current policy and its compiled allow-list.
+    `base_rules` (e.g. from --allowlist) are always part of the allow-list.
+    A failed reload keeps the previous policy in force.
+    """
+
+    def __init__(self, path, base_rules=()):
+        self.path = path
+        self.base_rules = list(base_rules)
+        self.policy = dict(DEFAULT_POLICY)
+        self.allow_list = AllowList(self.base_rules)
+        self.signature = None
+        # Reload metrics
+        self.reloads = 0
+        self.reload_errors = 0
+        self.last_reload_ms = 0.0
+        self.last_rules_added = 0
+        self.last_rules_removed = 0
+
+    def file_signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def changed(self):
+        """
+        True if the policy file differs from the one last loaded. Used to
+        ignore directory notifications about unrelated files.
+        """
+        return self.file_signature() != self.signature
+
+    def reload(self):
+        """
+        Re-read the policy file. Returns True if the new policy is in force.
+        """
+        started = time.perf_counter()
+        self.signature = self.file_signature()
+        try:
+            policy = load_policy(self.path)
+            allow_list, added, removed = self.allow_list.updated(self.base_rules + policy["allow"])
+        except (PolicyError, AllowListError) as e:
+            self.reload_errors += 1
+            print(f"Policy reload failed, keeping the previous policy: {e}")
+            return False
+        self.policy = policy
+        self.allow_list = allow_list
+        self.reloads += 1
+        self.last_rules_added = added
+        self.last_rules_removed = removed
+        self.last_reload_ms = (time.perf_counter() - started) * 1000.0
+        print(f"Policy reloaded in {self.last_reload_ms:.2f} ms "
+              f"({len(allow_list)} rules, +{added}/-{removed})")
+        return True
+
+    def write(self, data):
+        """
+        Replace the policy file with `data` (a decoded policy, e.g. pushed by
+        client.py fleet) after validating it, rules included. The file is
+        replaced atomically; reload() then puts it in force.
+        """
+        policy = validate_policy(data)
+        try:
+            self.allow_list.updated(self.base_rules + policy["allow"])
+        except AllowListError as e:
+            raise PolicyError(str(e))
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            raise PolicyError(f"Cannot write policy file '{self.path}': {e}")
+
+    def stats(self):
+        return {
+            "policy_reloads": self.reloads,
+            "policy_reload_errors": self.reload_errors,
+            "policy_last_reload_ms": round(self.last_reload_ms, 3),
+            "policy_last_rules_added": self.last_rules_added,
+            "policy_last_rules_removed": self.last_rules_removed,
+            "policy_rules": len(self.allow_list),
+        }
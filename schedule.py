@@ -0,0 +1,300 @@
+import time
+import heapq
+import threading
+from functools import lru_cache
+from datetime import date, datetime, timedelta
+
+# =============================================================================
+# Enforcement Schedule
+# Recurring and one-off windows in which the blocker enforces (locks on
+# unapproved devices) or relaxes (lets them through), set in the policy file:
+#
+#   "schedule": {
+#       "default": "enforce",
+#       "windows": [
+#           {"name": "exams", "days": "mon-fri", "start": "08:00", "end": "17:00", "action": "enforce"},
+#           {"name": "lunch", "days": "mon-fri", "start": "12:00", "end": "13:00", "action": "relax"},
+#           {"name": "open day", "from": "2026-11-14T09:00", "until": "2026-11-14T15:00",
+#            "action": "relax", "room": "B12"}
+#       ]
+#   }
+#
+# Times are local wall-clock times; "end" before "start" runs past midnight.
+# Windows with a "room" only apply on machines started with that --room.
+# While any relax window is open the blocker relaxes, otherwise it enforces
+# while any enforce window is open, otherwise the default applies.
+#
+# The Scheduler keeps one entry per window in a heap, keyed by the time of
+# that window's next transition (open or close). The host arms a single
+# timer for the earliest one; when it fires, advance() pops the windows
+# that are due and pushes their following transition, O(log n) each. Adding
+# or removing a window is O(log n) as well (removal is lazy). The clock is
+# injectable, so schedules can be tested against a virtual clock. Methods
+# take a lock: a policy reload may load() from a control server thread while
+# the host's timer calls advance().
+# =============================================================================
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+ACTIONS = ("enforce", "relax")
+# Longest single sleep: timers run on the monotonic clock, the schedule on
+# the wall clock, so hosts re-check after clock changes and suspend
+MAX_SLEEP = 300.0
+
+
+class ScheduleError(ValueError):
+    pass
+
+
+def _parse_days(value):
+    if value is None or value == "daily":
+        return frozenset(range(7))
+    items = value.split(",") if isinstance(value, str) else value
+    if not isinstance(items, list) or not items:
+        raise ScheduleError(f"Invalid days: {value!r}")
+    days = set()
+    for item in items:
+        first, _, last = str(item).strip().lower().partition("-")
+        if first not in DAYS or (last and last not in DAYS):
+            raise ScheduleError(f"Invalid days: {value!r}")
+        start, end = DAYS.index(first), DAYS.index(last or first)
+        # "fri-mon" wraps around the weekend
+        days.update(day % 7 for day in range(start, end + 1 if end >= start else end + 8))
+    return frozenset(days)
+
+
+def _parse_minutes(value):
+    try:
+        hours, minutes = str(value).split(":")
+        hours, minutes = int(hours), int(minutes)
+    except ValueError:
+        raise ScheduleError(f"Invalid time of day: {value!r}")
+    if not (0 <= hours <= 24 and 0 <= minutes < 60) or hours * 60 + minutes > 24 * 60:
+        raise ScheduleError(f"Invalid time of day: {value!r}")
+    return hours * 60 + minutes
+
+
+@lru_cache(maxsize=65536)
+def _local_time(ordinal, minutes):
+    """
+    Unix time of `minutes` after local midnight of the day `ordinal`.
+    Windows share start times, so the (slow) conversion is cached.
+    """
+    return (datetime.fromordinal(ordinal) + timedelta(minutes=minutes)).timestamp()
+
+
+def _parse_datetime(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        raise ScheduleError(f"Invalid date and time: {value!r}")
+
+
+class Window:
+    """
+    A weekly recurring window (days, start, end) or a one-off window
+    (begins, ends as Unix times).
+    """
+    __slots__ = ("name", "action", "room", "days", "start", "duration", "begins", "ends")
+
+    def __init__(self, name, action, room=None, days=None, start=None, duration=None, begins=None, ends=None):
+        self.name = name
+        self.action = action
+        self.room = room
+        self.days = days
+        self.start = start  # minutes after midnight
+        self.duration = duration  # minutes
+        self.begins = begins
+        self.ends = ends
+
+    @classmethod
+    def parse(cls, data, index=0):
+        if not isinstance(data, dict):
+            raise ScheduleError("Each schedule window must be a JSON object")
+        name = str(data.get("name", f"window {index + 1}"))
+        action = data.get("action", "enforce")
+        if action not in ACTIONS:
+            raise ScheduleError(f"{name}: 'action' must be one of {', '.join(ACTIONS)}")
+        room = data.get("room")
+        if "from" in data or "until" in data:
+            begins, ends = _parse_datetime(data.get("from")), _parse_datetime(data.get("until"))
+            if ends <= begins:
+                raise ScheduleError(f"{name}: 'until' must be after 'from'")
+            return cls(name, action, room, begins=begins, ends=ends)
+        start, end = _parse_minutes(data.get("start")), _parse_minutes(data.get("end"))
+        # Past midnight when it ends earlier; the whole day when they are equal
+        duration = (end - start) % (24 * 60) or 24 * 60
+        return cls(name, action, room, days=_parse_days(data.get("days")), start=start, duration=duration)
+
+    def state_at(self, now):
+        """
+        (open at `now`, Unix time of the next transition or None).
+        """
+        if self.days is None:
+            if now < self.begins:
+                return False, self.begins
+            return (True, self.ends) if now < self.ends else (False, None)
+        today = date.fromtimestamp(now).toordinal()
+        # Yesterday's occurrence may still be open; one is due within a week
+        for ordinal in range(today - 1, today + 8):
+            if (ordinal - 1) % 7 not in self.days:  # ordinal 1 is a Monday
+                continue
+            opens = _local_time(ordinal, self.start)
+            if opens > now:
+                return False, opens
+            closes = _local_time(ordinal, self.start + self.duration)
+            if now < closes:
+                # Back-to-back occurrences make this a no-op wakeup, no more
+                return True, closes
+        return False, None
+
+
+def parse_schedule(data):
+    """
+    Validate the policy's "schedule" setting. Returns (default, [Window]).
+    """
+    if not isinstance(data, dict):
+        raise ScheduleError("'schedule' must be a JSON object")
+    unknown = set(data) - {"default", "windows"}
+    if unknown:
+        raise ScheduleError(f"Unknown schedule settings: {', '.join(sorted(unknown))}")
+    default = data.get("default", "enforce")
+    if default not in ACTIONS:
+        raise ScheduleError(f"'default' must be one of {', '.join(ACTIONS)}")
+    windows = data.get("windows", [])
+    if not isinstance(windows, list):
+        raise ScheduleError("'windows' must be a list")
+    return default, [Window.parse(window, index) for index, window in enumerate(windows)]
+
+
+class Scheduler:
+    def __init__(self, room=None, clock=time.time):
+        self.room = room
+        self.clock = clock
+        self.default = "enforce"
+        self.windows = {}  # id -> Window
+        self.active = {}  # id -> bool
+        self.heap = []  # (when, id), stale entries skipped when popped
+        self.due = {}  # id -> the time its live heap entry is due
+        self.open = {"enforce": 0, "relax": 0}
+        self.next_id = 0
+        self.lock = threading.RLock()
+        # Counters
+        self.transitions = 0
+        self.changes = 0
+        self.last_change = None
+
+    def load(self, schedule):
+        """
+        Replace all windows with `schedule`, a (default, windows) tuple from
+        parse_schedule(), or None for no schedule.
+        """
+        with self.lock:
+            self.default, windows = schedule or ("enforce", [])
+            self.windows.clear()
+            self.active.clear()
+            self.heap = []
+            self.due.clear()
+            self.open = {"enforce": 0, "relax": 0}
+            now = self.clock()
+            for window in windows:
+                self.add(window, now)
+
+    def add(self, window, now=None):
+        """
+        Add a window. Returns its id, or None if it is for another room.
+        """
+        with self.lock:
+            if window.room is not None and window.room != self.room:
+                return None
+            now = self.clock() if now is None else now
+            window_id = self.next_id
+            self.next_id += 1
+            self.windows[window_id] = window
+            active, when = window.state_at(now)
+            self.active[window_id] = active
+            if active:
+                self.open[window.action] += 1
+            self.push(window_id, when)
+            return window_id
+
+    def remove(self, window_id):
+        with self.lock:
+            window = self.windows.pop(window_id, None)
+            if window is None:
+                return
+            if self.active.pop(window_id):
+                self.open[window.action] -= 1
+            self.due.pop(window_id, None)
+
+    def push(self, window_id, when):
+        if when is None:
+            self.due.pop(window_id, None)
+            return
+        self.due[window_id] = when
+        heapq.heappush(self.heap, (when, window_id))
+
+    def advance(self, now=None):
+        """
+        Apply every transition due by `now`. Returns True if the state
+        (enforce/relax) changed.
+        """
+        with self.lock:
+            now = self.clock() if now is None else now
+            before = self.state()
+            while self.heap and self.heap[0][0] <= now:
+                when, window_id = heapq.heappop(self.heap)
+                if self.due.get(window_id) != when:
+                    continue  # removed, or superseded
+                window = self.windows[window_id]
+                active, following = window.state_at(now)
+                if active != self.active[window_id]:
+                    self.open[window.action] += 1 if active else -1
+                    self.active[window_id] = active
+                    self.transitions += 1
+                self.push(window_id, following)
+            if self.state() != before:
+                self.changes += 1
+                self.last_change = now
+                return True
+            return False
+
+    def state(self):
+        with self.lock:
+            if self.open["relax"]:
+                return "relax"
+            if self.open["enforce"]:
+                return "enforce"
+            return self.default
+
+    def enforcing(self):
+        return self.state() == "enforce"
+
+    def next_due(self):
+        """
+        Unix time of the next transition, or None.
+        """
+        with self.lock:
+            while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            return self.heap[0][0] if self.heap else None
+
+    def sleep_time(self, now=None):
+        """
+        Seconds a host should wait before calling advance(), or None if the
+        schedule never changes again.
+        """
+        when = self.next_due()
+        if when is None:
+            return None
+        now = self.clock() if now is None else now
+        return min(MAX_SLEEP, max(0.0, when - now))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "schedule_state": self.state(),
+                "schedule_windows": len(self.windows),
+                "schedule_open_windows": self.open["enforce"] + self.open["relax"],
+                "schedule_next_transition": self.next_due(),
+                "schedule_transitions": self.transitions,
+                "schedule_changes": self.changes,
+            }
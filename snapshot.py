@@ -0,0 +1,135 @@
+import os
+import time
+import hashlib
+from array import array
+
+# =============================================================================
+# Device Snapshot
+# The event sources only report devices attached after the monitor is armed.
+# Anything plugged in before that (during the splash, before login, while the
+# monitor was not running) is caught by reconciling against the devices that
+# were attached the last time the monitor ran.
+#
+# A snapshot is the sorted array of 64-bit hashes of the attached devices'
+# keys (device ID plus VID:PID:serial, so a different stick in the same port
+# is a different device), stored as a small binary file: an 8-byte header
+# and 8 bytes per device. Loading it is one read, and the new devices are
+# found with a single merge walk over the two sorted arrays.
+#
+# At start the snapshot is rewritten with the previously known devices that
+# are still attached plus the new ones the allow-list accepts. Other new
+# devices are only added once the lock they caused is unlocked (approve()),
+# so a device that was locked out is never waved through because the monitor
+# restarted before anyone unlocked it. A device plugged in while the monitor
+# runs is likewise new again at the next start if it is still attached.
+# =============================================================================
+SNAPSHOT_MAGIC = b"USBSNAP1"
+
+
+def snapshot_key(event):
+    identity = event.identity
+    if identity is None:
+        return event.device_id
+    return f"{event.device_id}|{identity.vid}:{identity.pid}:{identity.serial}"
+
+
+def device_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def new_hashes(previous, current):
+    """
+    Hashes in `current` that are not in `previous`; both sorted.
+    """
+    result = []
+    i, count = 0, len(previous)
+    for value in current:
+        while i < count and previous[i] < value:
+            i += 1
+        if i == count or previous[i] != value:
+            result.append(value)
+    return result
+
+
+class DeviceSnapshot:
+    def __init__(self, path):
+        self.path = path
+        self.stored = array("Q")
+        self.pending = set()  # new devices' hashes, stored once unlocked
+        # Counters
+        self.devices = 0
+        self.new_devices = 0
+        self.scan_ms = 0.0
+        self.baseline = False
+
+    def load(self):
+        """
+        The stored sorted hashes, or None if there is no usable snapshot.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                    return None
+                hashes = array("Q")
+                hashes.frombytes(f.read())
+        except (OSError, ValueError):
+            return None
+        return hashes
+
+    def save(self, hashes):
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(SNAPSHOT_MAGIC)
+                f.write(hashes.tobytes())
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Cannot write device snapshot '{self.path}': {e}")
+
+    def reconcile(self, events, started=None, allowed=None):
+        """
+        Return the attached devices `events` (with identities) that were not
+        in the previous snapshot, and store the new snapshot: the known
+        devices still attached plus the new ones `allowed(event)` accepts.
+        Without a previous snapshot nothing is reported: the attached devices
+        become the baseline. `started` (perf_counter) is when enumerating the
+        devices began, for the reported scan time.
+        """
+        started = started or time.perf_counter()
+        previous = self.load()
+        keyed = [(device_hash(snapshot_key(event)), event) for event in events]
+        current = array("Q", sorted({value for value, _ in keyed}))
+        self.devices = len(current)
+        self.baseline = previous is None
+        if previous is None:
+            added = []
+            self.stored = current
+        else:
+            fresh = set(new_hashes(previous, current))
+            added = [event for value, event in keyed if value in fresh]
+            self.pending = {value for value, event in keyed
+                            if value in fresh and not (allowed and allowed(event))}
+            self.stored = array("Q", (value for value in current if value not in self.pending))
+        self.save(self.stored)
+        self.new_devices = len(added)
+        self.scan_ms = (time.perf_counter() - started) * 1000.0
+        return added
+
+    def approve(self):
+        """
+        The lock was unlocked: store the new devices found at start.
+        """
+        if not self.pending:
+            return
+        self.stored = array("Q", sorted(set(self.stored) | self.pending))
+        self.pending = set()
+        self.save(self.stored)
+
+    def stats(self):
+        return {
+            "snapshot_devices": self.devices,
+            "snapshot_new_devices": self.new_devices,
+            "snapshot_pending": len(self.pending),
+            "snapshot_baseline": self.baseline,
+            "snapshot_reconcile_ms": round(self.scan_ms, 3),
+        }
@@ -0,0 +1,535 @@
+import os
+import re
+import time
+import struct
+import ctypes
+import select
+import threading
+import subprocess
+from collections import deque
+from pipeline import physical_device_key
+import metrics
+
+# =============================================================================
+# Storage Blocking
+# Blocks USB mass storage at the device or volume level instead of (or as
+# well as) locking the screen, so an approved keyboard or mouse keeps working
+# and nothing on an unapproved stick can be read or run.
+#
+# Block modes (--block_mode, or "block_mode" in the policy file):
+#   lock    every unapproved insertion shows the lock screen (the default)
+#   volume  mass storage is blocked by the StorageGuard without locking; any
+#           other unapproved device (HID, composite) still locks the screen
+#   both    mass storage is blocked and the screen is locked
+#
+# Storage actions (--storage_action):
+#   deauthorize  Linux: write 0 to the USB interface's (or device's) sysfs
+#                "authorized" file; the driver unbinds before any volume is
+#                mounted
+#   unmount      Linux: lazily unmount volumes of the device as soon as they
+#                appear in /proc/self/mounts
+#   readonly     Linux: remount those volumes read-only instead
+#   mountvol     Windows: remove the mount points of the device's volumes
+#                (mountvol X:\ /P), matched to it by USB serial number
+#
+# Classification and queueing run on the USBMonitor thread and never block;
+# the actions run on the guard's own thread. Each block is timed (event or
+# mount seen -> blocked) and counted in the metrics.
+# =============================================================================
+BLOCK_MODES = ("lock", "volume", "both")
+STORAGE_ACTIONS = ("auto", "deauthorize", "unmount", "readonly", "mountvol")
+
+MASS_STORAGE_CLASS = "08"
+# Class codes that say nothing about the function (per-interface, hub)
+NEUTRAL_CLASSES = frozenset({"00", "09"})
+
+SYSFS_ROOT = "/sys"
+MOUNTS_PATH = "/proc/self/mounts"
+# Linux mount(2) / umount2(2) flags
+MS_RDONLY = 1
+MS_REMOUNT = 32
+MNT_DETACH = 2
+
+
+# =============================================================================
+# Section 1: Classification
+# =============================================================================
+def _interface_class(properties):
+    # Linux interface uevents carry their own class, in decimal: INTERFACE=8/6/80
+    code = properties.get("INTERFACE", "").split("/")[0]
+    try:
+        return format(int(code), "02X") if code else None
+    except ValueError:
+        return None
+
+
+def classify(event):
+    """
+    "storage"    mass storage only
+    "composite"  mass storage plus other functions (e.g. storage + keyboard)
+    "other"      no mass storage (HID, vendor specific, ...)
+    "pending"    a Linux USB device event whose interfaces are not known yet,
+                 or are mixed; the interface events that follow are
+                 classified instead
+    "unknown"    no class information at all
+    """
+    properties = event.properties or {}
+    interface = _interface_class(properties)
+    if interface is not None:
+        classes = {interface}
+    else:
+        classes = set(event.identity.classes) if event.identity else set()
+    classes -= NEUTRAL_CLASSES
+    device_level = properties.get("DEVTYPE") == "usb_device"
+    if MASS_STORAGE_CLASS in classes:
+        if len(classes) == 1:
+            return "storage"
+        # Block per interface, so the rest of the device is still vetted
+        return "pending" if device_level else "composite"
+    if classes:
+        return "other"
+    return "pending" if device_level else "unknown"
+
+
+# =============================================================================
+# Section 2: Blocking actions
+# block() runs on the guard thread and must not wait. Actions that wait for
+# a volume to appear either report later from their own thread (MountAction)
+# or are polled by the guard loop between queued blocks (MountvolAction).
+# =============================================================================
+class StorageAction:
+    name = "base"
+
+    def __init__(self, guard):
+        self.guard = guard
+
+    def block(self, key, event):
+        raise NotImplementedError
+
+    def poll(self):
+        """
+        Called on the guard thread after each batch of blocks. Returns the
+        seconds until it should be called again, or None.
+        """
+        return None
+
+    def forget(self, key):
+        pass
+
+    def close(self):
+        pass
+
+
+class DeauthorizeAction(StorageAction):
+    name = "deauthorize"
+
+    def __init__(self, guard, sysfs_root=SYSFS_ROOT):
+        super().__init__(guard)
+        self.sysfs_root = sysfs_root
+
+    def block(self, key, event):
+        # Interface events block just that interface (kernel 4.4+), so the
+        # other functions of a composite device keep working
+        devpath = event.device_id if event.device_id.startswith("/devices/") else ""
+        if not devpath:
+            self.guard.report(key, False, event.timestamp, "no sysfs path for this event")
+            return
+        path = os.path.join(self.sysfs_root, devpath.lstrip("/"), "authorized")
+        try:
+            with open(path, "w") as f:
+                f.write("0")
+            self.guard.report(key, True, event.timestamp, f"deauthorized {devpath}")
+        except OSError as e:
+            self.guard.report(key, False, event.timestamp, f"cannot write {path}: {e}")
+
+
+def _unescape_mount(field):
+    # /proc/mounts escapes space, tab, newline and backslash as \ooo
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+
+class MountAction(StorageAction):
+    """
+    Watches the mount table (poll() on /proc/self/mounts wakes up on every
+    change) and unmounts, or remounts read-only, any volume whose block
+    device belongs to a blocked USB device.
+    """
+    name = "unmount"
+
+    def __init__(self, guard, readonly=False, mounts_path=MOUNTS_PATH, sysfs_root=SYSFS_ROOT):
+        super().__init__(guard)
+        self.readonly = readonly
+        if readonly:
+            self.name = "readonly"
+        self.sysfs_root = sysfs_root
+        self.denied = {}  # sysfs directory of the USB device -> guard key
+        self.handled = set()  # (source, target) already acted on
+        self.lock = threading.Lock()
+        self.scan_lock = threading.Lock()
+        # The system calls directly: spawning umount(8) would take longer than the block itself
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.mounts = open(mounts_path, "r")
+        self.wake_r, self.wake_w = os.pipe()
+        self.poller = select.poll()
+        self.poller.register(self.mounts, select.POLLPRI | select.POLLERR)
+        self.poller.register(self.wake_r, select.POLLIN)
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="storage-mounts", daemon=True)
+        self.thread.start()
+
+    def block(self, key, event):
+        with self.lock:
+            self.denied[os.path.join(self.sysfs_root, key.lstrip("/"))] = key
+        # The volume may be mounted already
+        self.scan()
+
+    def forget(self, key):
+        with self.lock:
+            self.denied = {path: k for path, k in self.denied.items() if k != key}
+
+    def _run(self):
+        while not self.closed:
+            events = self.poller.poll()
+            if self.closed or any(fd == self.wake_r for fd, _ in events):
+                return
+            self.scan()
+
+    def owner(self, source):
+        """
+        Guard key of the blocked device `source` (/dev/sdb1) belongs to, if any.
+        """
+        name = os.path.basename(os.path.realpath(source))
+        device = os.path.realpath(os.path.join(self.sysfs_root, "class", "block", name))
+        with self.lock:
+            for path, key in self.denied.items():
+                if device == path or device.startswith(path + os.sep):
+                    return key
+        return None
+
+    def scan(self):
+        # Called from the watcher thread and, on block(), the guard thread
+        with self.scan_lock:
+            self._scan()
+
+    def _scan(self):
+        seen = time.monotonic()
+        with self.lock:
+            if not self.denied:
+                return
+        self.mounts.seek(0)
+        lines = self.mounts.read().splitlines()
+        mounted = set()
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 4 or not fields[0].startswith("/dev/"):
+                continue
+            source, target = fields[0], _unescape_mount(fields[1])
+            mounted.add((source, target))
+            if (source, target) in self.handled:
+                continue
+            key = self.owner(source)
+            if key is None:
+                continue
+            self.handled.add((source, target))
+            if self.readonly:
+                if "ro" in fields[3].split(","):
+                    continue
+                detail = f"remounted {target} read-only ({source})"
+                result = self.libc.mount(source.encode(), target.encode(), None, MS_REMOUNT | MS_RDONLY, None)
+            else:
+                # Lazy: detached at once even while files are open
+                detail = f"unmounted {target} ({source})"
+                result = self.libc.umount2(target.encode(), MNT_DETACH)
+            if result:
+                detail += f": {os.strerror(ctypes.get_errno())}"
+            self.guard.report(key, result == 0, seen, detail)
+        # A volume mounted again at the same place is acted on again
+        self.handled &= mounted
+
+    def close(self):
+        self.closed = True
+        os.write(self.wake_w, b"\0")
+        self.thread.join()
+        self.mounts.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+
+class MountvolAction(StorageAction):
+    """
+    Removes the mount points of the blocked device's volumes (mountvol X:\\
+    /P). Each drive is matched to the device by the USB serial number its
+    storage descriptor reports, so no other drive is touched, allow-listed
+    ones included. Volumes appear a moment after the device: a blocked device
+    is checked again from the guard loop every POLL_INTERVAL until
+    VOLUME_WAIT has passed, and fails (locking the screen instead) if none of
+    its volumes showed up. A device without a serial number cannot be
+    matched and fails at once.
+    """
+    name = "mountvol"
+    VOLUME_WAIT = 10.0
+    POLL_INTERVAL = 0.02
+    IOCTL_STORAGE_QUERY_PROPERTY = 0x2D1400
+    BUS_TYPE_USB = 7
+    FILE_SHARE_READ_WRITE = 3
+    OPEN_EXISTING = 3
+
+    def __init__(self, guard):
+        super().__init__(guard)
+        from ctypes import wintypes
+        self.kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        self.kernel32.CreateFileW.restype = wintypes.HANDLE
+        self.kernel32.CreateFileW.argtypes = (wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD, wintypes.LPVOID,
+                                              wintypes.DWORD, wintypes.DWORD, wintypes.HANDLE)
+        self.kernel32.DeviceIoControl.argtypes = (wintypes.HANDLE, wintypes.DWORD, wintypes.LPVOID, wintypes.DWORD,
+                                                  wintypes.LPVOID, wintypes.DWORD, wintypes.LPDWORD, wintypes.LPVOID)
+        self.kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+        self.waiting = {}  # key -> [serial, event, deadline, volumes removed]
+        # poll() runs on the guard thread, forget() on the monitor thread
+        self.lock = threading.Lock()
+
+    def usb_serial(self, letter):
+        """
+        Serial number of the USB device behind drive `letter`, or None.
+        """
+        from ctypes import wintypes
+        handle = self.kernel32.CreateFileW(f"\\\\.\\{letter}:", 0, self.FILE_SHARE_READ_WRITE, None,
+                                           self.OPEN_EXISTING, 0, None)
+        if handle in (None, wintypes.HANDLE(-1).value):
+            return None
+        try:
+            # STORAGE_PROPERTY_QUERY: StorageDeviceProperty, PropertyStandardQuery
+            query = (ctypes.c_uint32 * 3)(0, 0, 0)
+            buffer = ctypes.create_string_buffer(1024)
+            returned = wintypes.DWORD()
+            if not self.kernel32.DeviceIoControl(handle, self.IOCTL_STORAGE_QUERY_PROPERTY, query,
+                                                 ctypes.sizeof(query), buffer, len(buffer), ctypes.byref(returned),
+                                                 None):
+                return None
+        finally:
+            self.kernel32.CloseHandle(handle)
+        # STORAGE_DEVICE_DESCRIPTOR up to BusType
+        fields = struct.unpack_from("<IIBBBBIIIII", buffer.raw)
+        serial_offset, bus_type = fields[9], fields[10]
+        if bus_type != self.BUS_TYPE_USB or not serial_offset:
+            return None
+        return buffer.raw[serial_offset:].split(b"\0", 1)[0].decode("ascii", "replace").strip().upper()
+
+    def block(self, key, event):
+        serial = event.identity.serial if event.identity else ""
+        if not serial:
+            self.guard.report(key, False, event.timestamp, "no serial number to match its volumes by")
+            return
+        with self.lock:
+            self.waiting[key] = [serial, event, time.monotonic() + self.VOLUME_WAIT, 0]
+        self.poll()
+
+    def poll(self):
+        if not self.waiting:
+            return None
+        seen = time.monotonic()
+        mask = self.kernel32.GetLogicalDrives()
+        drives = {}
+        for i in range(26):
+            if mask & (1 << i):
+                serial = self.usb_serial(chr(65 + i))
+                if serial:
+                    drives.setdefault(serial, []).append(chr(65 + i))
+        with self.lock:
+            waiting = list(self.waiting.items())
+        for key, entry in waiting:
+            serial, event, deadline, removed = entry
+            for letter in drives.get(serial, ()):
+                result = subprocess.run(["mountvol", f"{letter}:\\", "/P"], stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+                self.guard.report(key, result.returncode == 0, seen, f"mountvol {letter}: /P")
+                entry[3] += result.returncode == 0
+            if seen >= deadline:
+                # Keep watching for further partitions until then
+                with self.lock:
+                    forgotten = self.waiting.pop(key, None) is None
+                if not forgotten and not entry[3]:
+                    self.guard.report(key, False, event.timestamp, "no volume of the device appeared")
+        return self.POLL_INTERVAL if self.waiting else None
+
+    def forget(self, key):
+        with self.lock:
+            self.waiting.pop(key, None)
+
+
+def create_action(guard, name):
+    if name == "auto":
+        name = "mountvol" if os.name == "nt" else "deauthorize"
+    if name == "deauthorize":
+        return DeauthorizeAction(guard)
+    if name in ("unmount", "readonly"):
+        return MountAction(guard, readonly=name == "readonly")
+    if name == "mountvol":
+        return MountvolAction(guard)
+    raise ValueError(f"Unknown storage action: {name}")
+
+
+# =============================================================================
+# Section 3: Storage guard
+# The pipeline stage USBMonitor hands storage insertions to.
+# =============================================================================
+class StorageGuard:
+    # Events for a device blocked less than this long ago are not acted on again
+    REPEAT_WINDOW = 2.0
+
+    def __init__(self, mode="lock", action="auto", audit=None, fallback=None, capacity=256):
+        """
+        `fallback(event)` is called when blocking a device fails, so the
+        device locks the screen instead of being readable.
+        """
+        self.mode = mode
+        self.default_mode = mode
+        self.action_name = action
+        self.fallback = fallback
+        self.events = {}  # key -> event, for the fallback
+        self.action = None
+        self.audit = audit
+        self.capacity = capacity
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.closing = False
+        self.recent = {}  # key -> monotonic time queued
+        self.samples = deque(maxlen=512)
+        # Counters
+        self.queued = 0
+        self.blocked = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def active(self):
+        return self.mode != "lock"
+
+    def apply_mode(self, mode):
+        """
+        Mode from the policy file; None returns to the command-line mode.
+        """
+        self.mode = mode or self.default_mode
+
+    def submit(self, event):
+        """
+        Queue a storage insertion for blocking. Called on the USBMonitor
+        thread; never blocks. Returns False if the queue is full and the
+        device will not be blocked, so the caller must lock instead.
+        """
+        key = physical_device_key(event)
+        with self.lock:
+            last = self.recent.get(key)
+            if last is not None and event.timestamp - last < self.REPEAT_WINDOW:
+                return True  # being blocked already
+            if len(self.queue) >= self.capacity:
+                self.dropped += 1
+                return False
+            self.recent[key] = event.timestamp
+            self.events[key] = event
+            if len(self.events) > self.capacity:
+                # Backends without remove events never forget; drop the oldest
+                oldest = next(iter(self.events))
+                self.events.pop(oldest)
+                self.recent.pop(oldest, None)
+            self.queue.append((key, event))
+            self.queued += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="storage-guard", daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+        return True
+
+    def forget(self, event):
+        """
+        The device was removed: a re-insertion is blocked again.
+        """
+        key = physical_device_key(event)
+        with self.lock:
+            self.recent.pop(key, None)
+            self.events.pop(key, None)
+        if self.action:
+            self.action.forget(key)
+
+    def _run(self):
+        try:
+            self.action = create_action(self, self.action_name)
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"Storage guard: cannot use the '{self.action_name}' action: {e}")
+            self.action_name = "unavailable"
+            # Nothing can be blocked: lock for everything queued from now on
+            while not self.closing:
+                with self.lock:
+                    pending = list(self.queue)
+                    self.queue.clear()
+                for key, event in pending:
+                    self.report(key, False, event.timestamp, "no storage action available")
+                self.wakeup.wait()
+                self.wakeup.clear()
+            return
+        timeout = None
+        while not self.closing:
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            while True:
+                with self.lock:
+                    if not self.queue:
+                        break
+                    key, event = self.queue.popleft()
+                try:
+                    self.action.block(key, event)
+                except Exception as e:
+                    self.report(key, False, event.timestamp, f"{self.action.name} failed: {e}")
+            # Devices whose volumes have not appeared yet are re-checked
+            # between blocks, never by sleeping in block()
+            try:
+                timeout = self.action.poll()
+            except Exception as e:
+                print(f"Storage guard: {self.action.name} poll failed: {e}")
+                timeout = None
+
+    def report(self, key, ok, started, detail):
+        """
+        Called by the actions when a block completed (or failed). `started`
+        is the monotonic time the event or the mount was seen.
+        """
+        elapsed = time.monotonic() - started
+        action = self.action.name if self.action else self.action_name
+        counter = metrics.STORAGE_BLOCKS.get((action, "success" if ok else "failure"))
+        if counter is not None:
+            counter.inc()
+        if ok:
+            self.blocked += 1
+            self.samples.append(elapsed * 1000.0)
+            metrics.STORAGE_BLOCK_LATENCY.observe(elapsed)
+            print(f"Storage blocked in {elapsed * 1000.0:.1f} ms: {detail}")
+        else:
+            self.failures += 1
+            print(f"Storage block failed: {detail}")
+            event = self.events.get(key)
+            # In "both" mode the device has locked the screen already
+            if self.fallback and event is not None and self.mode == "volume":
+                self.fallback(event)
+        if self.audit:
+            self.audit.record("storage_blocked" if ok else "storage_block_failed", device_id=key, action=action,
+                              detail=detail, elapsed_ms=round(elapsed * 1000.0, 1))
+
+    def close(self):
+        self.closing = True
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+        if self.action:
+            self.action.close()
+
+    def stats(self):
+        return {
+            "storage_block_mode": self.mode,
+            "storage_action": self.action.name if self.action else self.action_name,
+            "storage_queued": self.queued,
+            "storage_blocked": self.blocked,
+            "storage_block_failures": self.failures,
+            "storage_dropped": self.dropped,
+            "storage_last_block_ms": round(self.samples[-1], 1) if self.samples else None,
+        }
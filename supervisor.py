@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import signal
+import threading
+import subprocess
+from control import ControlError, MonitorClient, ReadyListener, notify_ready
+from instance import pid_alive
+
+# =============================================================================
+# Supervisor
+# `monitor.py supervise` runs the monitor as a child process and keeps it
+# alive. The child is restarted (with --fast-start) when:
+#   - the process exits without a legitimate stop (crash, kill),
+#   - its control channel misses heartbeats (hung GUI or control thread),
+#   - its status reports the USBMonitor thread is no longer running.
+#
+# The monitor keeps its lock state in a small JSON file (LockStateFile). A
+# restarted monitor reads it and locks again straight away, so killing the
+# process does not get anyone past the lock screen. Legitimate stops (the
+# control channel with the override code, the run time) are written to the
+# same file, which tells the supervisor not to restart. The tray's Stop asks
+# for no code, so under supervision it only restarts the monitor, still
+# locked if it was.
+# =============================================================================
+# Stop reasons that end supervision; any other exit is restarted
+FINAL_STOP_REASONS = ("control", "run_time")
+# Supervisor counters handed to the child, reported in its status
+SUPERVISOR_ENV = "USB_BLOCKER_SUPERVISOR"
+
+
+class LockStateFile:
+    """
+    {"locked": bool, "stopped": null or stop reason, "pid": int, "ts": float}
+    written atomically by the monitor whenever the lock state changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.locked = False
+        self.stopped = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        if not isinstance(state, dict):
+            state = {}
+        self.locked = bool(state.get("locked"))
+        self.stopped = state.get("stopped")
+        return self
+
+    def save(self, locked=None, stopped=None):
+        if locked is not None:
+            self.locked = locked
+        self.stopped = stopped
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"locked": self.locked, "stopped": stopped, "pid": os.getpid(),
+                           "ts": round(time.time(), 3)}, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Cannot write lock state '{self.path}': {e}")
+
+    def stopped_by(self, reason):
+        # A legitimate stop ends the lock along with the session
+        self.save(locked=False if reason in FINAL_STOP_REASONS else None, stopped=reason)
+
+
+def supervisor_stats():
+    """
+    Counters of the supervisor that started this process, as they were when
+    it was started, for status.
+    """
+    try:
+        return json.loads(os.environ.get(SUPERVISOR_ENV, "{}"))
+    except ValueError:
+        return {}
+
+
+class AttachedProcess:
+    """
+    The parts of subprocess.Popen the supervisor uses, for a monitor it did
+    not start itself (found through the instance registry). Its exit code
+    is unknown.
+    """
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        return None if pid_alive(self.pid) else 0
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while pid_alive(self.pid):
+            if deadline is not None and time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(f"PID {self.pid}", timeout)
+            time.sleep(self.POLL_INTERVAL)
+        return self.returncode
+
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    kill = terminate
+
+
+class Supervisor:
+    HEARTBEAT_INTERVAL = 0.25
+    HEARTBEAT_TIMEOUT = 0.5
+    MISSED_HEARTBEATS = 2
+    READY_TIMEOUT = 30
+    # Delay before retrying a child that failed to start, doubled per failure
+    RETRY_DELAY = 0.25
+    MAX_RETRY_DELAY = 5.0
+
+    def __init__(self, build_command, endpoint, state_path, notify=None):
+        """
+        `build_command(restart)` returns the child's command line, without
+        --notify. `notify` is the launcher's ready address, answered once
+        the first child is ready.
+        """
+        self.build_command = build_command
+        self.endpoint = endpoint
+        self.state_path = state_path
+        self.notify = notify
+        self.stopping = threading.Event()
+        self.client = None
+        self.last_healthy = None
+        # Counters
+        self.restarts = 0
+        self.failed_starts = 0
+        self.reasons = {}
+        self.last_detect_ms = 0.0
+        self.last_recover_ms = 0.0
+        self.max_recover_ms = 0.0
+
+    def spawn(self, restart):
+        """
+        Start a child and wait for its ready handshake. Returns the process,
+        or None if it did not become ready.
+        """
+        listener = ReadyListener()
+        command = self.build_command(restart) + ["--notify", listener.address]
+        env = dict(os.environ, **{SUPERVISOR_ENV: json.dumps(self.stats())})
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, env=env)
+        listener.watch_process(process)
+        ready = listener.wait(self.READY_TIMEOUT)
+        if not ready:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            print(f"Supervisor: monitor did not become ready (exit code {process.returncode})")
+            return None
+        if self.notify and not restart:
+            ready.pop("ready_ms", None)
+            notify_ready(self.notify, supervisor_pid=os.getpid(), **ready)
+            self.notify = None
+        self.last_healthy = time.monotonic()
+        return process
+
+    def heartbeat(self):
+        """
+        Ask the child for its status. Returns None if healthy, otherwise the
+        reason it is not.
+        """
+        if self.client is None:
+            self.client = MonitorClient(self.endpoint, timeout=self.HEARTBEAT_TIMEOUT)
+        try:
+            status = self.client.call("status")
+        except ControlError:
+            # Start from a fresh connection; a late reply must not be mistaken
+            # for the next one
+            self.client.close()
+            self.client = None
+            return "heartbeat_missed"
+        if not status.get("monitoring", True):
+            return "monitor_thread_died"
+        return None
+
+    def watch(self, process):
+        """
+        Wait until `process` needs replacing. Returns the reason, or None
+        when it stopped legitimately (or the supervisor is stopping).
+        """
+        missed = 0
+        while True:
+            try:
+                process.wait(self.HEARTBEAT_INTERVAL)
+                if LockStateFile(self.state_path).stopped in FINAL_STOP_REASONS or self.stopping.is_set():
+                    return None
+                return "exited"
+            except subprocess.TimeoutExpired:
+                pass
+            if self.stopping.is_set():
+                # Pass the signal on; the child keeps its lock state
+                process.terminate()
+                continue
+            problem = self.heartbeat()
+            if problem is None:
+                missed = 0
+                self.last_healthy = time.monotonic()
+                continue
+            if LockStateFile(self.state_path).stopped in FINAL_STOP_REASONS:
+                continue  # shutting down on request; wait for it to exit
+            if problem == "heartbeat_missed":
+                missed += 1
+                if missed < self.MISSED_HEARTBEATS:
+                    continue
+            return problem
+
+    def run(self, attach=None):
+        """
+        Supervise until the monitor is stopped legitimately. Returns its
+        exit code. `attach` is an AttachedProcess for a monitor that is
+        already running, which is then watched instead of starting one.
+        """
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: self.stopping.set())
+        if attach:
+            process = attach
+            self.last_healthy = time.monotonic()
+            if self.notify:
+                notify_ready(self.notify, supervisor_pid=os.getpid(), pid=attach.pid, attached=True)
+                self.notify = None
+        else:
+            process = self.spawn(restart=False)
+        if process is None:
+            return 1
+        while True:
+            reason = self.watch(process)
+            if reason is None:
+                print(f"Supervisor: monitor stopped (exit code {process.returncode}). {self.stats()}")
+                return process.returncode or 0
+            detected = time.monotonic()
+            self.last_detect_ms = (detected - self.last_healthy) * 1000.0
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            self.restarts += 1
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+            process = self.spawn(restart=True)
+            while process is None:
+                if not self.wait_retry():
+                    return 1
+                process = self.spawn(restart=True)
+            self.failed_starts = 0
+            self.last_recover_ms = (time.monotonic() - detected) * 1000.0
+            self.max_recover_ms = max(self.max_recover_ms, self.last_recover_ms)
+            print(f"Supervisor: restarted the monitor ({reason}) in {self.last_recover_ms:.0f} ms")
+
+    def wait_retry(self):
+        """
+        Back off after a failed start. Returns False if the supervisor is
+        stopping instead.
+        """
+        self.failed_starts += 1
+        delay = min(self.MAX_RETRY_DELAY, self.RETRY_DELAY * 2 ** (self.failed_starts - 1))
+        return not self.stopping.wait(delay)
+
+    def stats(self):
+        # detect: from the last healthy heartbeat to noticing the failure
+        # recover: from noticing the failure to the new monitor being ready
+        return {
+            "supervisor_restarts": self.restarts,
+            "supervisor_restart_reasons": dict(self.reasons),
+            "supervisor_failed_starts": self.failed_starts,
+            "supervisor_last_detect_ms": round(self.last_detect_ms, 1),
+            "supervisor_last_recover_ms": round(self.last_recover_ms, 1),
+            "supervisor_max_recover_ms": round(self.max_recover_ms, 1),
+        }